@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the hot paths of clu.
+
+The real subcommand functions are run against synthetic inventories and ssh configs of
+different sizes (10, 100 and 1000 hosts by default), inside a sandbox: a copy of the
+repository with its own hosts.yaml, caches, mounts directory and HOME, so nothing of your
+installation is touched.
+
+Benchmarks that need a host (syncing scripts, querying and submitting jobs) connect to a
+local sshd, by default the fakeserver on port 2222 that `tests/run_tests` uses (see
+`benchmarks/run_benchmarks`, which starts it). Fake `sbatch` and `squeue` are installed
+there. If the sshd can't be reached, these benchmarks are skipped.
+
+Results are written as JSON, so that they can be compared between commits:
+
+    benchmarks/bench.py -o before.json
+    (change things)
+    benchmarks/bench.py -o after.json --compare before.json
+"""
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+FAKEBIN = Path(__file__).resolve().parent / "fakebin"
+
+SIZES = (10, 100, 1000)
+# Name of the host that points to the local sshd
+SSH_HOST = "clu-bench-sshd"
+# Directory (in the host) where the benchmarks install cluster-utils
+REMOTE_CLU_DIR = ".cluster-utils-bench"
+# Directory (in the host, inside REMOTE_CLU_DIR) with the fake scheduler. It goes first in the PATH of the
+# commands that the benchmarks run there, so nothing outside REMOTE_CLU_DIR needs to be touched.
+REMOTE_FAKEBIN = f"{REMOTE_CLU_DIR}/.bench-bin"
+
+_benchmarks = []
+
+def benchmark(name, sizes=(None,), needs_ssh=False, repeat=None):
+    """
+    Registers a benchmark.
+
+    The decorated function receives the size and returns a tuple (function to time, setup function or None).
+    The setup function is run before each repetition, outside of the timed region.
+    """
+    def decorator(function):
+        _benchmarks.append({"name": name, "function": function, "sizes": sizes, "needs_ssh": needs_ssh, "repeat": repeat})
+        return function
+    return decorator
+
+@contextmanager
+def quiet():
+    """Silences everything that is printed, also by child processes"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in (*saved, devnull):
+            os.close(fd)
+
+def measure(function, setup=None, repeat=5):
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with quiet():
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    return times
+
+# -------------------------------------------
+#              The sandbox
+# -------------------------------------------
+
+def create_sandbox(root, sshd=None, identity=None):
+    """
+    Copies the repository to `root` and points cluster-utils (and HOME) to it.
+
+    If an sshd is given (user@host:port), an ssh wrapper that knows how to reach it
+    (and that puts REMOTE_FAKEBIN first in the PATH of the remote commands) is put first in the PATH.
+    """
+    clu_root = root / "cluster-utils"
+    clu_root.mkdir(parents=True)
+    for name in ("activate", "install", "uninstall", "cli", "scripts", "bin"):
+        source = REPO / name
+        if source.is_dir():
+            shutil.copytree(source, clu_root / name, ignore=shutil.ignore_patterns("__pycache__", ".registry*"))
+        elif source.exists():
+            shutil.copy2(source, clu_root / name)
+
+    home = root / "home"
+    (home / ".ssh").mkdir(parents=True)
+
+    os.environ.update({
+        "HOME": str(home),
+        "CLUSTER_UTILS_ROOT": str(clu_root),
+        "CLUSTER_UTILS_MOUNTS": str(root / "mounts"),
+        "CLUSTER_UTILS_USERSCRIPTS": str(clu_root / "user-scripts"),
+        # Unix sockets have a maximum path length, keep it short
+        "CLUSTER_UTILS_CONTROL_DIR": str(root / "ctl"),
+    })
+
+    if sshd is not None:
+        user, _, address = sshd.rpartition("@")
+        hostname, _, port = address.partition(":")
+        ssh_config = root / "ssh_config"
+        ssh_config.write_text("\n".join([
+            f"Host {SSH_HOST}",
+            f"  HostName {hostname}",
+            f"  Port {port or 22}",
+            f"  User {user or 'root'}",
+            "  StrictHostKeyChecking no",
+            "  UserKnownHostsFile /dev/null",
+            "  LogLevel ERROR",
+            "  BatchMode yes",
+            "  ConnectTimeout 5",
+            *([f"  IdentityFile {identity}"] if identity else []),
+        ]) + "\n")
+
+        # ssh reads the config of the real home, not $HOME, so we tell it explicitly
+        bin_dir = root / "bin"
+        bin_dir.mkdir()
+        real_ssh = shutil.which("ssh")
+        (bin_dir / "ssh").write_text("\n".join([
+            "#!/bin/bash",
+            "options=()",
+            "while [ $# -gt 0 ]; do",
+            "\tcase $1 in",
+            "\t\t-[BbcDEeFIiJLlmOopQRSWw]) options+=(\"$1\" \"$2\"); shift 2;;",
+            "\t\t-*) options+=(\"$1\"); shift;;",
+            "\t\t*) break;;",
+            "\tesac",
+            "done",
+            # A command (not a subsystem, e.g. sftp) after the host
+            "if [ $# -gt 1 ] && [ \"${2:0:1}\" != - ]; then",
+            f"\thost=$1; shift; set -- \"$host\" 'PATH=\"$HOME/{REMOTE_FAKEBIN}:$PATH\";' \"$@\"",
+            "fi",
+            f'exec "{real_ssh}" -F "{ssh_config}" "${{options[@]}}" "$@"',
+        ]) + "\n")
+        (bin_dir / "ssh").chmod(0o755)
+        os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+
+    sys.path.insert(0, str(clu_root / "cli"))
+
+    return clu_root
+
+def synthetic_hosts(n):
+    """Hosts similar to real ones: some groups and tags, and a tenth of them jumping through a gateway"""
+    hosts = {}
+    for i in range(n):
+        config = {
+            "user": f"user{i % 7}", "hostname": f"node{i}.cluster{i % 13}.example.org",
+            "clusterutils_dir": "~/.cluster-utils", "mount_target": "", "mount_profile": "default",
+            "groups": [f"group{i % 5}"], "tags": [f"tag{i % 3}", f"tag{i % 11}"],
+        }
+        if i % 10 == 9:
+            config["jump_through"] = f"bench-{i - 9:04d}"
+        hosts[f"bench-{i:04d}"] = config
+    return hosts
+
+def synthetic_ssh_config(n):
+    """An ssh config with a block per host, some comments and a shared block every 50 hosts"""
+    lines = ["# ssh config generated by the clu benchmarks", "Host *", "  ServerAliveInterval 60", ""]
+    for i in range(n):
+        lines += [f"Host bench-{i:04d}", f"  User user{i % 7}", f"  HostName node{i}.example.org"]
+        if i % 10 == 9:
+            lines.append(f"  ProxyJump bench-{i - 9:04d}")
+        lines.append("")
+        if i % 50 == 49:
+            lines += ["# Shared options", f"Host bench-{i - 1:04d} bench-{i:04d} other-{i}", "  Compression yes", ""]
+    return "\n".join(lines)
+
+def write_hosts(hosts):
+    from subcommands import inventory
+
+    inventory.write_hosts_file(hosts, Path(os.environ["CLUSTER_UTILS_ROOT"]) / "hosts.yaml")
+
+def clear_inventory_caches(disk=True):
+    from subcommands import inventory
+
+    inventory._memory_cache.clear()
+    inventory._inventories.clear()
+    if disk:
+        shutil.rmtree(Path(os.environ["CLUSTER_UTILS_ROOT"]) / ".cache" / "inventory", ignore_errors=True)
+
+def ssh(command, input=None):
+    return subprocess.run(["ssh", SSH_HOST, command], input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+# -------------------------------------------
+#              Local benchmarks
+# -------------------------------------------
+
+@benchmark("startup.lshosts", sizes=SIZES)
+def _startup_lshosts(n):
+    write_hosts(synthetic_hosts(n))
+    command = [sys.executable, os.path.join(os.environ["CLUSTER_UTILS_ROOT"], "cli", "clu"), "lshosts"]
+    # The first call generates the registry and the inventory cache
+    subprocess.run(command, stdout=subprocess.DEVNULL)
+    return lambda: subprocess.run(command, stdout=subprocess.DEVNULL), None
+
+@benchmark("startup.complete_subcommand")
+def _startup_complete(n):
+    env = {**os.environ, "_ARGCOMPLETE": "1", "COMP_LINE": "clu mo", "COMP_POINT": "6"}
+    command = [sys.executable, os.path.join(os.environ["CLUSTER_UTILS_ROOT"], "cli", "clu")]
+    return lambda: subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL), None
+
+@benchmark("get_hosts.cold", sizes=SIZES)
+def _get_hosts_cold(n):
+    from subcommands.host_management import get_hosts
+
+    write_hosts(synthetic_hosts(n))
+    return get_hosts, clear_inventory_caches
+
+@benchmark("get_hosts.disk_cache", sizes=SIZES)
+def _get_hosts_disk(n):
+    from subcommands.host_management import get_hosts
+
+    write_hosts(synthetic_hosts(n))
+    get_hosts()
+    return get_hosts, lambda: clear_inventory_caches(disk=False)
+
+@benchmark("get_hosts.memory_cache", sizes=SIZES)
+def _get_hosts_memory(n):
+    from subcommands.host_management import get_hosts
+
+    write_hosts(synthetic_hosts(n))
+    get_hosts()
+    return get_hosts, None
+
+@benchmark("inventory.select", sizes=SIZES)
+def _inventory_select(n):
+    from subcommands.inventory import get_inventory
+
+    write_hosts(synthetic_hosts(n))
+    return lambda: get_inventory().select(groups=["group1"], tags=["tag2"]), None
+
+@benchmark("remove_host_ssh_config", sizes=SIZES)
+def _remove_host_ssh_config(n):
+    from subcommands.host_management import remove_host_ssh_config
+
+    path = Path(os.environ["HOME"]) / ".ssh" / "config"
+    text = synthetic_ssh_config(n)
+    return lambda: remove_host_ssh_config(f"bench-{n // 2 - 1:04d}", ssh_config=path), lambda: path.write_text(text)
+
+@benchmark("write_host_ssh", sizes=SIZES)
+def _write_host_ssh(n):
+    from subcommands.host_management import write_host_ssh
+
+    path = Path(os.environ["HOME"]) / ".ssh" / "config"
+    text = synthetic_ssh_config(n)
+    config = {"host": f"bench-{n // 2:04d}", "user": "someone", "hostname": "somewhere.example.org"}
+    return lambda: write_host_ssh(config, ssh_config=path), lambda: path.write_text(text)
+
+def _mounted_child(n, repeat):
+    """Runs in a private mount namespace (see `_get_mounted`), where it can mount as much as it wants"""
+    from subcommands.mounting import get_mounted, get_mount_status, get_mounts_dir
+
+    mounts_dir = get_mounts_dir()
+    hosts = synthetic_hosts(n)
+    for host in hosts:
+        (mounts_dir / host).mkdir(parents=True, exist_ok=True)
+        subprocess.run(["mount", "-t", "tmpfs", "-o", "size=1m", "none", str(mounts_dir / host)], check=True)
+
+    results = {
+        "get_mounted": measure(get_mounted, repeat=repeat),
+        "get_mount_status": measure(lambda: get_mount_status(list(hosts)), repeat=repeat),
+    }
+    print(json.dumps(results))
+
+@benchmark("get_mounted", sizes=SIZES)
+def _get_mounted(n):
+    # Mounting needs privileges, so we do it in a private mount namespace (as a fake root if we are not root).
+    # The mounts disappear with it.
+    command = ["unshare", "--mount", *([] if os.geteuid() == 0 else ["--user", "--map-root-user"]),
+        sys.executable, __file__, "--mounted-child", str(n)]
+    return command, None
+
+# -------------------------------------------
+#         Benchmarks that need a host
+# -------------------------------------------
+
+def _install_fakes():
+    """Installs the fake scheduler in the host, and prepares it for the benchmarks"""
+    for name in ("sbatch", "squeue"):
+        completed = ssh(f"mkdir -p {REMOTE_FAKEBIN} && cat > {REMOTE_FAKEBIN}/{name} && chmod +x {REMOTE_FAKEBIN}/{name}",
+            input=(FAKEBIN / name).read_bytes())
+        if completed.returncode != 0:
+            raise RuntimeError(f"Could not install the fake {name}: {completed.stderr.decode().strip()}")
+
+    write_hosts({SSH_HOST: {"user": "", "hostname": "", "clusterutils_dir": REMOTE_CLU_DIR, "mount_target": ""}})
+
+def _ensure_remote_scripts():
+    from subcommands.script_management import setup_host_scripts
+
+    write_hosts({SSH_HOST: {"user": "", "hostname": "", "clusterutils_dir": REMOTE_CLU_DIR, "mount_target": ""}})
+    with quiet():
+        setup_host_scripts(SSH_HOST)
+
+@benchmark("setup_host_scripts.full", needs_ssh=True, repeat=3)
+def _setup_host_scripts_full(n):
+    from subcommands.script_management import setup_host_scripts
+
+    def setup():
+        # Everything but the fakes
+        ssh(f"find {REMOTE_CLU_DIR} -mindepth 1 -maxdepth 1 ! -name {os.path.basename(REMOTE_FAKEBIN)} -exec rm -rf {{}} +")
+        shutil.rmtree(Path(os.environ["CLUSTER_UTILS_ROOT"]) / ".cache", ignore_errors=True)
+
+    return lambda: setup_host_scripts(SSH_HOST), setup
+
+@benchmark("setup_host_scripts.up_to_date", needs_ssh=True)
+def _setup_host_scripts_noop(n):
+    from subcommands.script_management import setup_host_scripts
+
+    _ensure_remote_scripts()
+    return lambda: setup_host_scripts(SSH_HOST), None
+
+@benchmark("setup_host_scripts.check_host", needs_ssh=True)
+def _setup_host_scripts_force(n):
+    from subcommands.script_management import setup_host_scripts
+
+    _ensure_remote_scripts()
+    return lambda: setup_host_scripts(SSH_HOST, force=True), None
+
+@benchmark("get_jobs.query", sizes=SIZES, needs_ssh=True)
+def _get_jobs_query(n):
+    from subcommands.jobs import get_jobs
+
+    queue = "".join(f"{1000 + i}\tjob{i}\t{'RUNNING' if i % 3 else 'PENDING'}\t1:00\tnode{i % 50}\t/root/bench/run{i}\n"
+        for i in range(n))
+    ssh("cat > .clu_bench_queue", input=queue.encode())
+    return lambda: get_jobs([SSH_HOST], ttl=0), None
+
+@benchmark("get_jobs.cached", sizes=SIZES, needs_ssh=True)
+def _get_jobs_cached(n):
+    from subcommands.jobs import get_jobs
+
+    _get_jobs_query(n)[0]()
+    return lambda: get_jobs([SSH_HOST], ttl=3600), None
+
+@benchmark("submit", sizes=(10, 100), needs_ssh=True, repeat=3)
+def _submit(n):
+    from subcommands.jobs import submit
+
+    _ensure_remote_scripts()
+    ssh(f"rm -rf bench_submit && mkdir bench_submit && cd bench_submit && for i in $(seq {n}); do"\
+        " mkdir run$i && echo '%include basis.fdf' > run$i/system.fdf && touch run$i/basis.fdf; done")
+    return lambda: submit(["bench_submit/run*"], host=SSH_HOST), None
+
+# -------------------------------------------
+#                 Running
+# -------------------------------------------
+
+def _summary(times):
+    return {"median": statistics.median(times), "min": min(times), "mean": statistics.mean(times), "times": times}
+
+def run(names=None, sizes=None, repeat=5, sshd=None):
+    results = []
+
+    ssh_ready = False
+    if sshd is not None and any(b["needs_ssh"] for b in _benchmarks):
+        ssh_ready = ssh("true").returncode == 0
+        if ssh_ready:
+            _install_fakes()
+        else:
+            print(f"(benchmarks) Could not connect to {sshd}, skipping the benchmarks that need a host.", file=sys.stderr)
+
+    for bench in _benchmarks:
+        if names and not any(bench["name"].startswith(name) for name in names):
+            continue
+        if bench["needs_ssh"] and not ssh_ready:
+            continue
+
+        for size in bench["sizes"]:
+            if sizes and size is not None and size not in sizes:
+                continue
+
+            function, setup = bench["function"](size)
+            if isinstance(function, list):
+                # The benchmark runs in a child process, which gives us the results of several measurements
+                child = subprocess.run([*function, str(bench["repeat"] or repeat)], stdout=subprocess.PIPE)
+                if child.returncode != 0:
+                    print(f"(benchmarks) {bench['name']} failed, skipping it.", file=sys.stderr)
+                    continue
+                measured = json.loads(child.stdout)
+            else:
+                measured = {bench["name"]: measure(function, setup, repeat=bench["repeat"] or repeat)}
+
+            for name, times in measured.items():
+                result = {"name": name, "size": size, **_summary(times)}
+                results.append(result)
+                print(f"{name:<32} {'' if size is None else size:>6} {result['median'] * 1000:10.2f} ms", flush=True)
+
+    return results
+
+def _git_commit():
+    completed = subprocess.run(["git", "-C", str(REPO), "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return completed.stdout.decode().strip() or None
+
+def compare(results, base_results, threshold):
+    """
+    Prints the change with respect to previous results. Returns the number of regressions.
+
+    The best time of each benchmark is compared, since it is the least affected by noise.
+    """
+    base = {(r["name"], r["size"]): r for r in base_results}
+
+    regressions = 0
+    print(f"\n{'':<32} {'size':>6} {'before':>10} {'after':>10} {'ratio':>7}")
+    for result in results:
+        previous = base.get((result["name"], result["size"]))
+        if previous is None:
+            continue
+        ratio = result["min"] / previous["min"] if previous["min"] else float("inf")
+        flag = ""
+        if ratio > threshold:
+            flag = "  <- slower"
+            regressions += 1
+        elif ratio < 1 / threshold:
+            flag = "  <- faster"
+        print(f"{result['name']:<32} {'' if result['size'] is None else result['size']:>6} "\
+            f"{previous['min'] * 1000:8.2f}ms {result['min'] * 1000:8.2f}ms {ratio:7.2f}{flag}")
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the hot paths of clu.")
+    parser.add_argument("-o", "--output", help="File where the results are written (JSON).")
+    parser.add_argument("-k", "--only", action="append", help="Only run the benchmarks whose name starts with this."\
+        " Can be passed multiple times.")
+    parser.add_argument("-s", "--size", type=int, action="append", help=f"Only run these sizes (default: {SIZES}).")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Number of repetitions of each benchmark.")
+    parser.add_argument("--sshd", default=os.environ.get("CLU_BENCH_SSHD", "root@localhost:2222"),
+        help="The sshd used by the benchmarks that need a host (user@host:port). 'none' to skip them.")
+    parser.add_argument("-i", "--identity", default=os.environ.get("CLU_BENCH_IDENTITY"),
+        help="Private key to connect to the sshd.")
+    parser.add_argument("--compare", help="Results of a previous run (JSON) to compare with.")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Ratio from which a change is reported as a"\
+        " regression when comparing. If there are regressions, the exit code is 1.")
+    parser.add_argument("--mounted-child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("child_repeat", nargs="?", type=int, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.mounted_child is not None:
+        # We are the child process of the get_mounted benchmark, the sandbox is already in the environment
+        sys.path.insert(0, str(Path(os.environ["CLUSTER_UTILS_ROOT"]) / "cli"))
+        _mounted_child(args.mounted_child, args.child_repeat)
+        return 0
+
+    sshd = None if args.sshd == "none" else args.sshd
+
+    with tempfile.TemporaryDirectory(prefix="clu-bench-") as root:
+        create_sandbox(Path(root), sshd=sshd, identity=args.identity)
+        results = run(names=args.only, sizes=args.size, repeat=args.repeat, sshd=sshd)
+
+        if sshd is not None:
+            subprocess.run(["ssh", "-O", "exit", "-o", f"ControlPath={os.environ['CLUSTER_UTILS_CONTROL_DIR']}/%r@%h:%p",
+                SSH_HOST], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    report = {
+        "commit": _git_commit(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(), "platform": platform.platform(),
+        "repeat": args.repeat, "results": results,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=1))
+
+    if args.compare:
+        base = json.loads(Path(args.compare).read_text())
+        if compare(results, base["results"], args.threshold):
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,16 @@
-import sys
-from pathlib import Path
+import importlib
 
 from .subcommand import SubCommand
-from .mounting import *
-from .path import *
-from .host_management import *
-from .script_management import *
-from .port_forwarding import *
+from .registry import load_registry, get_subcommand
 
+def __getattr__(name):
+    # The modules are only imported when something that they define is requested,
+    # so that calling one subcommand doesn't need to import all the others.
+    for module_name, names in load_registry()["exports"].items():
+        if name in names:
+            return getattr(importlib.import_module(f".{module_name}", __name__), name)
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted({*globals(), *(name for names in load_registry()["exports"].values() for name in names)})
@@ -0,0 +1,274 @@
+import os
+from pathlib import Path
+import subprocess
+
+from .host_management import get_hosts, _multiple_hosts
+from .inventory import get_inventory
+from .subcommand import SubCommand
+from . import processes
+
+__all__ = ["connections"]
+
+def get_control_dir():
+    """
+    Directory where the sockets of the master connections live.
+
+    It is kept short on purpose, since unix sockets paths have a maximum length (~100 characters).
+    """
+    control_dir = Path(os.environ.get("CLUSTER_UTILS_CONTROL_DIR", "~/.ssh/clu-control")).expanduser()
+
+    if not control_dir.exists():
+        control_dir.mkdir(mode=0o700, parents=True)
+
+    return control_dir
+
+def get_control_persist():
+    """Time that a master connection is kept alive after its last use (as understood by ssh's ControlPersist)"""
+    return os.environ.get("CLUSTER_UTILS_CONTROL_PERSIST", "10m")
+
+def multiplexing_enabled():
+    return get_control_persist().lower() not in ("", "0", "no", "false")
+
+def get_tunnels_control_path():
+    """
+    ControlPath of the masters that carry the tunnels.
+
+    They are separate from the shared masters, since they must stay alive until their tunnels
+    are closed (ControlPersist=yes) instead of going away after CLUSTER_UTILS_CONTROL_PERSIST.
+    """
+    tunnels_dir = get_control_dir() / "tunnels"
+    tunnels_dir.mkdir(mode=0o700, exist_ok=True)
+
+    return tunnels_dir / "%r@%h:%p"
+
+def multiplexing_options(master="auto", persist=None, control_path=None):
+    """
+    Options that make ssh (and scp) reuse a master connection for each host.
+
+    The first connection to a host becomes the master and stays alive in the background
+    for CLUSTER_UTILS_CONTROL_PERSIST (default: 10m), all other connections go through it.
+
+    Parameters
+    -----------
+    master: str, optional
+        The value for the ControlMaster option.
+    persist: str, optional
+        The value for the ControlPersist option, if it should not be CLUSTER_UTILS_CONTROL_PERSIST.
+    control_path: str or Path, optional
+        The value for the ControlPath option, if the master should not be the shared one (see
+        `get_tunnels_control_path`).
+    """
+    if not multiplexing_enabled():
+        return []
+
+    return [
+        "-o", f"ControlMaster={master}",
+        "-o", f"ControlPath={control_path or get_control_dir() / '%r@%h:%p'}",
+        "-o", f"ControlPersist={persist or get_control_persist()}",
+    ]
+
+def ssh_command(host, *command, tty=False, options=()):
+    """
+    Builds an ssh command that goes through the host's master connection.
+
+    Parameters
+    -----------
+    host: str
+        The name of the host, as understood by ssh (and cluster-utils).
+    *command: str
+        The command to execute in the host. If not provided, an interactive session is opened.
+    tty: bool, optional
+        Whether to force the allocation of a pseudo-terminal.
+    options: list of str, optional
+        Extra options for ssh.
+    """
+    return ["ssh", *multiplexing_options(), *(["-t"] if tty else []), *options, host, *command]
+
+def quote_remote_path(path):
+    """
+    Quotes a path to use it in a command that runs in the host.
+
+    Unlike `shlex.quote`, it keeps a leading '~' unquoted so that the shell of the host expands it.
+    Empty paths refer to the home directory.
+    """
+    import shlex
+
+    path = str(path)
+    if path in ("", "~"):
+        return "~"
+    if path.startswith("~/"):
+        return "~/" + shlex.quote(path[2:])
+    return shlex.quote(path)
+
+def scp_command(*args, options=()):
+    """Builds an scp command that goes through the master connections."""
+    return ["scp", *multiplexing_options(), *options, *args]
+
+def sshfs_ssh_option(shared=True):
+    """
+    The `ssh_command` option for sshfs, so that mounts also reuse the master connections.
+
+    sshfs splits the command on whitespace, so we don't use it if the control dir contains spaces.
+
+    Parameters
+    -----------
+    shared: bool, optional
+        If `False`, the mount gets a connection of its own instead (e.g. because it needs its own
+        ssh options, which would be ignored when going through a master).
+    """
+    if not shared:
+        return ["-o", "ssh_command=ssh -o ControlPath=none"]
+
+    command = " ".join(["ssh", *multiplexing_options()])
+    if not multiplexing_enabled() or len(command.split()) != 1 + len(multiplexing_options()):
+        return []
+
+    return ["-o", f"ssh_command={command}"]
+
+def master_alive(host, control_path=None):
+    """Checks whether there is a master connection running for this host (at `control_path`, if given)"""
+    if not multiplexing_enabled():
+        return False
+
+    completed = processes.run(["ssh", *multiplexing_options(control_path=control_path), "-O", "check", host],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return completed.returncode == 0
+
+def open_master(host, persist=None, control_path=None):
+    """
+    Makes sure that there is a master connection running for this host.
+
+    Parameters
+    -----------
+    host: str
+        The name of the host, as understood by ssh (and cluster-utils).
+    persist: str, optional
+        How long the master should be kept alive after its last use, if it needs to be started
+        (defaults to CLUSTER_UTILS_CONTROL_PERSIST). Masters that are already running are not modified.
+    control_path: str or Path, optional
+        Where the socket of the master is, if it should not be the shared one.
+    """
+    if not multiplexing_enabled() or master_alive(host, control_path=control_path):
+        return True
+
+    completed = processes.run(["ssh", *multiplexing_options(master="yes", persist=persist, control_path=control_path),
+        "-N", "-f", host])
+    return completed.returncode == 0
+
+def close_master(host=None, socket=None):
+    """
+    Closes the master connection of a host.
+
+    Parameters
+    -----------
+    host: str, optional
+        The name of the host, as understood by ssh (and cluster-utils).
+    socket: str or Path, optional
+        Path to the control socket, if you want to close a specific one instead.
+    """
+    if socket is not None:
+        command = ["ssh", "-o", f"ControlPath={socket}", "-O", "exit", "clu-master"]
+    else:
+        command = ssh_command(host, options=["-O", "exit"])
+
+    completed = processes.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return completed.returncode == 0
+
+def get_masters():
+    """
+    Gets all the master connections that have a socket in the control dir.
+
+    Returns
+    ---------
+    list of dict
+        Contains the "socket", the "address" (user@hostname:port), the clu "hosts" that
+        use this address and whether the master is "alive".
+    """
+    addresses = {}
+    for host, config in get_inventory().hosts.items():
+        config = config or {}
+        address = f"{config.get('user', '')}@{config.get('hostname', host)}"
+        addresses.setdefault(address, []).append(host)
+
+    masters = []
+    for socket in sorted(get_control_dir().glob("*")):
+        if socket.is_dir():
+            # The masters of the tunnels (see `get_tunnels_control_path`)
+            continue
+        check = processes.run(["ssh", "-o", f"ControlPath={socket}", "-O", "check", "clu-master"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        address = socket.name
+        masters.append({
+            "socket": socket,
+            "address": address,
+            "hosts": addresses.get(address.rpartition(":")[0], []),
+            "alive": check.returncode == 0,
+        })
+
+    return masters
+
+def connections(host=None, all=False, close=False, open=False):
+    """
+    Lists, opens or closes the shared ssh connections (one master connection per host).
+
+    All ssh, scp and sshfs calls made by cluster-utils reuse these connections, so that
+    you only need to go through the handshake (and 2FA, jumps...) once.
+
+    Parameters
+    -----------
+    host: list of str, optional
+        The hosts to act on. If not provided, all connections are listed.
+    all: bool, optional
+        If `True`, act on all connections.
+    close: bool, optional
+        Close the master connections.
+    open: bool, optional
+        Open master connections for the hosts (if not already running).
+    """
+    host = host or []
+
+    if open:
+        _open_masters(host, all=all and not host)
+        return
+
+    masters = get_masters()
+    if host:
+        masters = [m for m in masters if set(m["hosts"]).intersection(host)]
+
+    if close:
+        if host:
+            for h in host:
+                if close_master(h):
+                    print(f"Closed connection to {h}")
+        elif all:
+            for master in masters:
+                close_master(socket=master["socket"])
+                print(f"Closed connection to {master['address']}")
+        return
+
+    for master in masters:
+        if not master["alive"]:
+            # Leftover socket from a master that died.
+            master["socket"].unlink()
+            continue
+        print(f"{' '.join(master['hosts']) or '?':<20} {master['address']}")
+
+@_multiple_hosts()
+def _open_masters(host):
+    return open_master(host)
+
+def _arguments_connections(subparser):
+    subparser.add_argument("host", metavar="H", nargs="*",
+        help="The name(s) of the host(s), as understood by ssh (and cluster-utils)").completer = lambda *args, **kwargs: get_hosts()
+
+    subparser.add_argument("--all", action="store_true", help="Act on all hosts/connections.")
+
+    group = subparser.add_mutually_exclusive_group()
+    group.add_argument("--close", action="store_true", help="Close the master connection of the hosts.")
+    group.add_argument("--open", action="store_true", help="Open a master connection for the hosts, so that the next"\
+        " commands don't need to go through the handshake.")
+
+    subparser.epilog = "The time that connections are kept alive after their last use is controlled by the"\
+        " CLUSTER_UTILS_CONTROL_PERSIST environment variable (default: 10m). Set it to 'no' to disable connection sharing."
+
+SubCommand(connections, _arguments_connections)
@@ -0,0 +1,434 @@
+"""
+A daemon that runs the quick commands of clu (and tab completion) without starting python each time.
+
+Most of the time of commands like `clu lshosts` or a TAB press goes to starting the interpreter,
+importing modules and reading hosts.yaml. The daemon is a long-lived `clu` process that keeps all
+that in memory (together with the state of the mounts and the master connections) and listens on
+a unix socket. When the socket exists, the clu script starts python without the site packages (which
+is much faster) and just forwards the command to the daemon. Commands that the daemon doesn't serve
+(see `served` in `SubCommand`), or any problem talking to it, make clu run the command itself as usual.
+
+Messages are marshalled dicts, preceded by their length (4 bytes, big endian). Only what the client
+needs is imported at the top of this module, since it runs in a bare interpreter.
+
+The socket lives in a directory that only the user can access, and both sides check that the other
+one belongs to the same user. Even so, the client only sends the environment variables that clu reads.
+"""
+import marshal
+import os
+import sys
+
+from .subcommand import SubCommand
+
+__all__ = ["daemon"]
+
+# Seconds between refreshes of what the daemon keeps in memory
+DEFAULT_INTERVAL = 30
+# Mount states are reused for this long (unless the mounted hosts change)
+_STATUS_TTL = 2 * DEFAULT_INTERVAL
+# Seconds that the client waits for the daemon before running the command itself
+DEFAULT_TIMEOUT = 5
+
+# The environment variables that are sent to the daemon (the ones that clu and argcomplete read)
+_FORWARDED_PREFIXES = ("CLUSTER_UTILS_", "_ARGCOMPLETE", "COMP_")
+_FORWARDED_VARS = ("HOME", "PATH", "SHELL", "XDG_RUNTIME_DIR")
+
+def socket_path():
+    """
+    Where the daemon listens. The clu script computes the same path to know whether it is running.
+
+    It is in XDG_RUNTIME_DIR, which is private, or otherwise in ~/.cache/clu (see `_private_dir`).
+    The name includes the machine, since the home directory may be shared by many of them.
+    """
+    if os.environ.get("CLUSTER_UTILS_DAEMON_SOCKET"):
+        return os.environ["CLUSTER_UTILS_DAEMON_SOCKET"]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], f"clu-{os.getuid()}.sock")
+    return os.path.join(os.path.expanduser("~"), ".cache", "clu", f"daemon-{os.uname().nodename}.sock")
+
+def _private_dir(path):
+    """Makes sure that the directory of the socket exists and that only we can access it"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if os.stat(directory).st_uid != os.getuid():
+        raise PermissionError(f"{directory} doesn't belong to us, refusing to put the socket of the daemon there")
+    os.chmod(directory, 0o700)
+
+def _forwarded_env():
+    return {key: value for key, value in os.environ.items()
+        if key.startswith(_FORWARDED_PREFIXES) or key in _FORWARDED_VARS}
+
+def _peer_uid(sock):
+    """The user of the process on the other side of a unix socket, or None if the platform can't tell"""
+    import _socket
+
+    if not hasattr(_socket, "SO_PEERCRED"):
+        return None
+    # struct ucred: pid, uid and gid, as native ints
+    credentials = sock.getsockopt(_socket.SOL_SOCKET, _socket.SO_PEERCRED, 12)
+    return int.from_bytes(credentials[4:8], sys.byteorder)
+
+def _send(sock, message):
+    data = marshal.dumps(message)
+    sock.sendall(len(data).to_bytes(4, "big") + data)
+
+def _receive(sock):
+    data = b""
+    size = None
+    while size is None or len(data) < size + 4:
+        chunk = sock.recv(1 << 16)
+        if not chunk:
+            raise ConnectionError("the connection was closed before the end of the message")
+        data += chunk
+        if size is None and len(data) >= 4:
+            size = int.from_bytes(data[:4], "big")
+    return marshal.loads(data[4:])
+
+def _request(message, path=None, timeout=None):
+    """
+    Sends a message to the daemon and returns its reply.
+
+    Raises OSError if it can't be reached, if it doesn't answer in `timeout` seconds or if the
+    socket (or the process listening on it) doesn't belong to us.
+    """
+    # The socket module takes longer to import than all the rest of the client.
+    import _socket
+
+    path = path or socket_path()
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        if os.stat(path).st_uid != os.getuid() or _peer_uid(sock) not in (None, os.getuid()):
+            raise PermissionError(f"{path} doesn't belong to us")
+        _send(sock, message)
+        return _receive(sock)
+    finally:
+        sock.close()
+
+# ---------------------------------------------
+#                   Client
+# ---------------------------------------------
+
+def _write_completions(completions):
+    filename = os.environ.get("_ARGCOMPLETE_STDOUT_FILENAME")
+    if filename:
+        with open(filename, "w") as f:
+            f.write(completions)
+    else:
+        # Where argcomplete's shell code reads the completions from
+        os.write(8, completions.encode())
+
+def forward(argv):
+    """
+    Asks the daemon to run a command.
+
+    Parameters
+    -----------
+    argv: list of str
+        The arguments of clu.
+
+    Returns
+    ---------
+    int or None
+        The exit code of the command, or None if it must be run in this process instead.
+    """
+    completing = "_ARGCOMPLETE" in os.environ
+    if not completing:
+        from .main import _requested_subcommand
+        from .registry import load_registry
+
+        registry = load_registry()
+        requested = _requested_subcommand(argv, registry)
+        if requested is None or "--profile" in argv or not registry["commands"][requested].get("served"):
+            return None
+
+    path = socket_path()
+    timeout = float(os.environ.get("CLUSTER_UTILS_DAEMON_TIMEOUT", DEFAULT_TIMEOUT))
+    try:
+        reply = _request({"argv": list(argv), "cwd": os.getcwd(), "env": _forwarded_env()}, path, timeout=timeout)
+    except ConnectionRefusedError:
+        # The daemon died without removing its socket, don't make the next calls try again.
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return None
+    except (OSError, ValueError, EOFError):
+        return None
+
+    if reply.get("fallback"):
+        return None
+
+    sys.stdout.write(reply["stdout"])
+    sys.stderr.write(reply["stderr"])
+    if completing and reply["completion"]:
+        _write_completions(reply["completion"])
+
+    return reply["returncode"]
+
+# ---------------------------------------------
+#                   Server
+# ---------------------------------------------
+
+def _code_mtime():
+    """Last modification of the code of clu, so that the daemon notices that it is outdated"""
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    mtimes = [entry.stat().st_mtime_ns for entry in os.scandir(package_dir) if entry.name.endswith(".py")]
+    return max(mtimes + [os.stat(os.path.join(package_dir, os.pardir, "clu")).st_mtime_ns])
+
+def _same_user(connection):
+    """Whether the process on the other side of the connection belongs to us (when the platform can tell)"""
+    # If it can't tell, the socket can only be used by us anyway (see `_listen`).
+    return _peer_uid(connection) in (None, os.getuid())
+
+def _run_command(argv, cwd, env):
+    """
+    Runs a command as if it was called from `cwd` with the environment `env`, capturing its output.
+
+    `env` only contains the forwarded variables (see `_forwarded_env`), they replace those of the daemon.
+    """
+    import io
+    import traceback
+
+    from .main import main
+
+    saved_env, saved_cwd = dict(os.environ), os.getcwd()
+    stdout, stderr = sys.stdout, sys.stderr
+    output, errors, completion = io.StringIO(), io.StringIO(), io.StringIO()
+    try:
+        os.chdir(cwd)
+        for key in [key for key in os.environ if key.startswith(_FORWARDED_PREFIXES) or key in _FORWARDED_VARS]:
+            del os.environ[key]
+        os.environ.update(env)
+        sys.stdout, sys.stderr = output, errors
+
+        main(argv, completion_output=completion)
+        returncode = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            returncode = e.code or 0
+        else:
+            print(e.code, file=errors)
+            returncode = 1
+    except Exception:
+        traceback.print_exc(file=errors)
+        returncode = 1
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        os.environ.clear()
+        os.environ.update(saved_env)
+        os.chdir(saved_cwd)
+
+    return {"stdout": output.getvalue(), "stderr": errors.getvalue(), "completion": completion.getvalue(),
+        "returncode": returncode}
+
+def _refresh(session):
+    """
+    Gets what the served commands need warm: the inventory, the state of the mounts and their connections.
+
+    It can take a while (stale mounts, handshakes...), so it is done in a new session that can then
+    replace the state of `session` in one go (see `_adopt`), without blocking the requests meanwhile.
+    """
+    from .session import Session
+
+    fresh = Session(status_ttl=session.status_ttl)
+    fresh.inventory
+    for mount in fresh.mounts(refresh=True):
+        if mount.healthy:
+            fresh.connect(mount.host)
+    return fresh
+
+def _adopt(session, fresh):
+    """Takes the state of a session built by `_refresh`"""
+    session._status = fresh._status
+    session._connected.update(fresh._connected)
+
+def _listen(path):
+    import socket
+
+    if not os.environ.get("CLUSTER_UTILS_DAEMON_SOCKET"):
+        _private_dir(path)
+
+    try:
+        _request({"ping": True}, path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    else:
+        raise RuntimeError(f"There is already a daemon listening on {path}")
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+    return server
+
+def serve(interval=None):
+    """
+    Serves requests until it is asked to stop (or its code changes).
+
+    Requests are handled one at a time, since each of them takes over the environment, the
+    current directory and the output of the process while it runs.
+    """
+    import signal
+    import threading
+    import time
+
+    from .session import default_session
+
+    interval = float(os.environ.get("CLUSTER_UTILS_DAEMON_INTERVAL", DEFAULT_INTERVAL)) if interval is None else interval
+
+    path = socket_path()
+    server = _listen(path)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    lock = threading.Lock()
+    started, code_mtime = time.time(), _code_mtime()
+    root = os.path.realpath(os.environ["CLUSTER_UTILS_ROOT"])
+    session = default_session()
+    session.status_ttl = max(_STATUS_TTL, 2 * interval)
+    served = 0
+
+    def log(message):
+        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {message}", flush=True)
+
+    def refresh_loop():
+        while True:
+            try:
+                fresh = _refresh(session)
+            except Exception as e:
+                log(f"Refresh failed: {e}")
+            else:
+                with lock:
+                    _adopt(session, fresh)
+            time.sleep(interval)
+
+    threading.Thread(target=refresh_loop, daemon=True).start()
+    log(f"Listening on {path} (pid {os.getpid()})")
+
+    try:
+        while True:
+            connection, _ = server.accept()
+            stop = False
+            with connection:
+                try:
+                    if not _same_user(connection):
+                        continue
+                    request = _receive(connection)
+
+                    if request.get("ping"):
+                        reply = {"pid": os.getpid(), "uptime": time.time() - started, "served": served}
+                    elif request.get("stop"):
+                        reply, stop = {"pid": os.getpid()}, True
+                    elif _code_mtime() != code_mtime:
+                        reply, stop = {"fallback": True}, True
+                        log("The code of clu changed, stopping")
+                    elif os.path.realpath(request["env"].get("CLUSTER_UTILS_ROOT", "")) != root:
+                        # Another installation of cluster-utils
+                        reply = {"fallback": True}
+                    else:
+                        with lock:
+                            reply = _run_command(request["argv"], request["cwd"], request["env"])
+                        served += 1
+
+                    _send(connection, reply)
+                except (OSError, ValueError, EOFError, KeyError) as e:
+                    log(f"Bad request: {e!r}")
+            if stop:
+                break
+    finally:
+        server.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        session.close()
+        log("Stopped")
+
+def daemon(stop=False, status=False, foreground=False, interval=None):
+    """
+    Starts a daemon that serves the quick commands and tab completion, to make them (much) faster.
+
+    The daemon keeps the hosts, the state of the mounts and their connections in memory. Only commands
+    that just report information (lshosts, lsmounts, where, path, jobs, jobdir) and tab completion
+    go through it. It stops by itself when the code of cluster-utils changes.
+
+    Parameters
+    -----------
+    stop: bool, optional
+        Stop the running daemon instead.
+    status: bool, optional
+        Show whether the daemon is running.
+    foreground: bool, optional
+        Run the daemon in this process instead of in the background.
+    interval: float, optional
+        Seconds between refreshes of what the daemon keeps in memory. Defaults to
+        CLUSTER_UTILS_DAEMON_INTERVAL (or 30).
+    """
+    import subprocess
+    import time
+
+    from .path import get_path
+    from . import processes
+
+    path = socket_path()
+
+    def ping():
+        try:
+            return _request({"ping": True}, path)
+        except (OSError, ValueError, EOFError):
+            return None
+
+    if stop or status:
+        info = ping()
+        if info is None:
+            print("(cluster-utils) The daemon is not running")
+        elif stop:
+            _request({"stop": True}, path)
+            print(f"(cluster-utils) Stopped the daemon (pid {info['pid']})")
+        else:
+            print(f"(cluster-utils) The daemon is running (pid {info['pid']}), listening on {path}."\
+                f" It has served {info['served']} commands in {info['uptime']:.0f}s.")
+        return
+
+    if foreground:
+        serve(interval)
+        return
+
+    info = ping()
+    if info is not None:
+        print(f"(cluster-utils) The daemon is already running (pid {info['pid']})")
+        return
+
+    log_dir = get_path(".cache")
+    log_dir.mkdir(parents=True, exist_ok=True)
+    with open(log_dir / "daemon.log", "ab") as log:
+        command = [sys.executable, str(get_path("cli") / "clu"), "daemon", "--foreground"]
+        if interval is not None:
+            command += ["--interval", str(interval)]
+        processes.Popen(command, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    for _ in range(50):
+        info = ping()
+        if info is not None:
+            print(f"(cluster-utils) Started the daemon (pid {info['pid']}), listening on {path}")
+            return
+        time.sleep(0.1)
+
+    print(f"(cluster-utils) The daemon didn't start, see {log_dir / 'daemon.log'}", file=sys.stderr)
+
+def _arguments_daemon(subparser):
+    group = subparser.add_mutually_exclusive_group()
+    group.add_argument("--stop", action="store_true", help="Stop the daemon that is running in the background.")
+    group.add_argument("--status", action="store_true", help="Show whether the daemon is running.")
+    group.add_argument("--foreground", action="store_true", help="Run the daemon in this process.")
+
+    subparser.add_argument("--interval", type=float, help="Seconds between refreshes of the hosts, the state of the"\
+        f" mounts and their connections. Defaults to CLUSTER_UTILS_DAEMON_INTERVAL, or {DEFAULT_INTERVAL} if it is not set.")
+
+SubCommand(daemon, _arguments_daemon)
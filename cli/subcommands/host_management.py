@@ -1,15 +1,35 @@
+from contextlib import contextmanager, nullcontext
 from functools import wraps
+import copy
 from pathlib import Path
 import getpass
+import hashlib
+import json
+import os
 import subprocess
 import shutil
-import yaml
+import sys
+import threading
+import time
 
+from .inventory import get_inventory, load_hosts_file, write_hosts_file
+from .inventory import editing as hosts_editing, batch as hosts_batch, flush as flush_hosts
 from .path import get_path
+from .ssh_config import editing as ssh_config_editing, batch as ssh_config_batch, flush as flush_ssh_config
+from .processes import host_context, routed_output
+from . import processes
 from .subcommand import SubCommand
 
 __all__ = ["send_keys", "setup_host", "remove_host"]
 
+# Default number of hosts that commands with multiple hosts process concurrently
+DEFAULT_JOBS = 8
+# Default maximum number of concurrent connections through the same jump host
+DEFAULT_JOBS_PER_JUMP = 4
+
+# Taken while something may ask the user for input (e.g. a password)
+_INTERACTIVE_LOCK = threading.Lock()
+
 KNOWN_CONFIG_KEYS = {
     "host": {
         "description": "This is the alias that the host will have. It doesn't need to be the real name"\
@@ -37,6 +57,12 @@ KNOWN_CONFIG_KEYS = {
             " you have a good reason, this is by default the home directory (leave it empty)",
         "default": lambda key, config: ""
     },
+    "mount_profile": {
+        "description": "The set of sshfs options used to mount this host, depending on the link to it: 'default',"\
+            " 'lan' (fast local network), 'wan' (internet, e.g. through a VPN) or 'bastion' (high latency, jumping through"\
+            " other servers). Run 'clu mountbench <host>' to find out which one works best.",
+        "default": lambda key, config: "default"
+    },
     "host_auth_keys": {
         "description": "The path to the file where the host keeps register of authorized keys. The default should be fine"\
             " unless the cluster administrators are doing some fancy non-standard stuff",
@@ -46,6 +72,12 @@ KNOWN_CONFIG_KEYS = {
         "description": "The directory that clusterutils will use to save scripts and commands in this host.",
         "default": lambda key, config: "~/.cluster-utils"
     },
+    "scratch_dir": {
+        "description": "Directory of the host where calculations should run (e.g. /scratch/$USER), runners stage their"\
+            " inputs there and copy back the results. Leave it empty to run calculations in the directory where they are"\
+            " submitted.",
+        "default": lambda key, config: ""
+    },
     "jump_through":{
         "description": "In some occasions, you can not ssh directly to your host, but you need to jump through another"\
             " server. This is the NAME OF THE HOST TO USE AS AN INTERMEDIATE STEP. If you set this to a not known host,"\
@@ -53,6 +85,16 @@ KNOWN_CONFIG_KEYS = {
             " Notice that you can use as many jumping steps as you need. Also, you can use a host normally and as a 'jump_through'"\
             " at the same time.",
         "default": lambda key, config: ""
+    },
+    "groups": {
+        "description": "Groups that this host belongs to (separated by commas), e.g. the institution or project that"\
+            " gives you access to it. Commands that act on multiple hosts accept --group to select hosts by group.",
+        "default": lambda key, config: ""
+    },
+    "tags": {
+        "description": "Tags for this host (separated by commas), e.g. 'gpu' or 'slurm'. Commands that act on multiple"\
+            " hosts accept --tag to select hosts by tag.",
+        "default": lambda key, config: ""
     }
 }
 
@@ -61,6 +103,17 @@ def add_config_arguments(subparser):
         subparser.add_argument(f"--{key}", help=KNOWN_CONFIG_KEYS[key].get("description", ""))
 
 def get_hosts(files=None):
+    """
+    Gets the configuration of hosts.
+
+    Files are only parsed if they changed since the last time they were read (see the `inventory` module),
+    and a new copy of the hosts is returned on each call, so it can be modified freely.
+
+    Parameters
+    -----------
+    files: str, Path, dict or list of them, optional
+        The yaml files (or dicts) with the hosts. If not provided, the known hosts are returned.
+    """
 
     if files is None:
         files = [get_path("hosts.yaml")]
@@ -75,107 +128,323 @@ def get_hosts(files=None):
     if isinstance(files, dict):
         return files
 
-    yaml_file = Path(files)
-    if not yaml_file.is_file():
-        return {}
-
-    with yaml_file.open() as f:
-        hosts_dict = yaml.safe_load(f)
-
-    return hosts_dict
+    return load_hosts_file(files)
 
 def write_hosts(hosts, filepath=None):
 
     if filepath is None:
         filepath = get_path("hosts.yaml")
     
-    with open(filepath, "w") as f:
-        yaml.dump(hosts, f)
+    write_hosts_file(hosts, filepath)
 
 def add_hosts(hosts_dict):
 
-    hosts = get_hosts()
+    with hosts_editing() as hosts:
+        hosts.update(hosts_dict)
 
-    hosts.update(hosts_dict)
+def remove_hosts_yaml(hosts):
 
-    write_hosts(hosts)
+    with hosts_editing() as hosts_dict:
+        for host in hosts:
+            if host not in hosts_dict:
+                raise KeyError(f"'{host}' is not a host known by cluster-utils")
+            del hosts_dict[host]
 
-def remove_hosts_yaml(hosts):
+# The options of the ssh config that cluster-utils writes for each host
+_MANAGED_SSH_OPTIONS = ("User", "HostName", "ProxyJump")
 
-    hosts_dict = get_hosts()
+def _host_ssh_options(config):
+    options = [("User", config["user"]), ("HostName", config["hostname"])]
+    if config.get("jump_through"):
+        options.append(("ProxyJump", config["jump_through"]))
+    return options
 
-    for host in hosts:
-        del hosts_dict[host]
-
-    write_hosts(hosts_dict) 
-
-def write_host_ssh(config):
-    # Write the parameters to the ssh config file
-    ssh_config = Path("~/.ssh/config").expanduser()
-    with ssh_config.open("a") as f:
-        f.write("\n".join([
-            f"\n\nHost {config['host']}",
-            f" User {config['user']}",
-            f" HostName {config['hostname']}"
-        ]))
-        if config.get("jump_through"):
-            f.write(f"\n ProxyJump {config['jump_through']}")
+def write_host_ssh(config, ssh_config=None):
+    """
+    Writes the parameters of a host to the ssh config file.
+
+    If the host already has its own block in the file, only the options that cluster-utils
+    manages are updated there.
+    """
+    with ssh_config_editing(ssh_config) as parsed_config:
+        parsed_config.set_host(config["host"], _host_ssh_options(config), managed=_MANAGED_SSH_OPTIONS)
 
 def remove_host_ssh_config(host, ssh_config=None):
+    """
+    Removes a host from the ssh config file.
 
-    if ssh_config is None:
-        ssh_config = Path("~") / ".ssh" / "config"
+    Note that if the host shares a Host line with other hosts, only the host name is
+    removed from that line.
+    """
+    with ssh_config_editing(ssh_config) as parsed_config:
+        parsed_config.remove_host(host)
 
-    ssh_config = Path(ssh_config).expanduser()
+@contextmanager
+def host_transaction():
+    """
+    Groups changes to hosts.yaml and the ssh config.
 
-    with ssh_config.open("r") as f:
-        lines = f.readlines()
-    
-    host_block = False
-    empty_lines = 0
-    new_lines = []
-    line = ""
-    for line in lines:
-        line = line.rstrip()
-        if f"Host {host}" == line:
-            host_block = True
-        elif line.startswith("Host"):
-            host_block = False
-
-        if line == "":
-            empty_lines += 1
-            host_block = False
-        else: 
-            empty_lines = 0
-        
-        if not host_block and empty_lines <= 1:
-            new_lines.append(line)
-    if line != "":
-        new_lines.append("")
-    
-    with ssh_config.open("w") as f:
-        f.write("\n".join(new_lines))
+    Each file is written only once, when the transaction finishes. If an exception is
+    raised inside the transaction, none of them is written.
+    """
+    with hosts_batch(), ssh_config_batch():
+        yield
 
-def _multiple_hosts(all_getter=get_hosts):
+# Marks hosts that were not in hosts.yaml
+_MISSING = object()
+
+@contextmanager
+def _host_savepoint(host):
+    """
+    Undoes the changes to the configuration of a host (in hosts.yaml and the ssh config) if something fails.
+
+    Hosts that are processed in the same transaction share it, so this keeps the failure of one of them
+    from leaving its configuration half modified, while the changes of the others are still written.
+    """
+    with hosts_editing() as hosts, ssh_config_editing() as ssh_config:
+        saved_config = copy.deepcopy(hosts[host]) if host in hosts else _MISSING
+        saved_blocks = ssh_config.snapshot(host)
+    try:
+        yield
+    except BaseException:
+        with hosts_editing() as hosts, ssh_config_editing() as ssh_config:
+            if saved_config is _MISSING:
+                hosts.pop(host, None)
+            else:
+                hosts[host] = saved_config
+            ssh_config.restore(host, saved_blocks)
+        raise
+
+def flush_host_transaction():
+    """Writes the pending changes of an open transaction, e.g. because we need to connect to a new host."""
+    flush_hosts()
+    flush_ssh_config()
+
+class HostResult:
+    """
+    Stores the outcome of running a function for a given host.
+
+    `status` is one of "ok", "failed" or "timed out".
+    """
+
+    def __init__(self, host, status, value=None, error=None, output="", elapsed=0.):
+        self.host = host
+        self.status = status
+        self.value = value
+        self.error = error
+        self.output = output
+        self.elapsed = elapsed
+
+def _run_for_host(function, host, kwargs, timeout=None, buffer=None):
+    start = time.monotonic()
+    status, value, error = "ok", None, None
+    with host_context(host, timeout=timeout, buffer=buffer), processes.phase(function.__name__.strip("_")):
+        try:
+            value = function(host, **kwargs)
+            if value is False:
+                status = "failed"
+        except subprocess.TimeoutExpired as e:
+            status, error = "timed out", e
+        except Exception as e:
+            status, error = "failed", e
+
+    return HostResult(host, status, value=value, error=error, output="".join(buffer or []),
+        elapsed=time.monotonic() - start)
+
+def _order_by_jump(hosts, configs):
+    """
+    Interleaves hosts that jump through different servers, so that the workers
+    don't all end up waiting for the same jump host.
+    """
+    groups = {}
+    for host in hosts:
+        groups.setdefault(configs.get(host, {}).get("jump_through") or "", []).append(host)
+
+    ordered = []
+    while any(groups.values()):
+        for group in groups.values():
+            if group:
+                ordered.append(group.pop(0))
+    return ordered
+
+def _jump_levels(hosts, jump_of):
+    """
+    Splits hosts in levels, so that each host comes in a later level than the host it jumps through.
+
+    Parameters
+    -----------
+    hosts: list of str
+        The hosts to sort. Jump hosts that are not in the list are considered ready.
+    jump_of: callable
+        Returns the host that a host jumps through (or None).
+
+    Returns
+    -----------
+    list of list of str
+        The levels, hosts of the same level can be processed at the same time.
+    list of str
+        The hosts that can't be placed in any level, because their jump hosts form a cycle
+        (or they jump through one of those).
+    """
+    levels, pending = [], list(hosts)
+    while pending:
+        level = [host for host in pending if jump_of(host) not in pending]
+        if not level:
+            break
+        pending = [host for host in pending if host not in level]
+        levels.append(level)
+
+    return levels, pending
+
+def _print_host_output(result):
+    for line in result.output.splitlines():
+        print(f"[{result.host}] {line}")
+    sys.stdout.flush()
+
+def _print_summary(results):
+    counts = {status: 0 for status in ("ok", "failed", "timed out")}
+    for result in results:
+        counts[result.status] += 1
+
+    print(f"(cluster-utils) {', '.join(f'{n} {status}' for status, n in counts.items())}")
+    for result in results:
+        line = f"   {result.status:<10} {result.host}  ({result.elapsed:.1f}s)"
+        if result.error is not None:
+            line += f": {result.error}"
+        print(line)
+
+def run_for_hosts(function, hosts, jobs=1, jobs_per_jump=DEFAULT_JOBS_PER_JUMP, timeout=None, **kwargs):
+    """
+    Runs a function for multiple hosts, possibly concurrently.
+
+    Parameters
+    -----------
+    function: callable
+        The function to run. It receives the host as the first argument.
+    hosts: list of str
+        The hosts for which the function should be run.
+    jobs: int, optional
+        Maximum number of hosts that are processed at the same time. If 1, hosts
+        are processed one after the other and their output is not buffered (so
+        that interactive prompts work).
+    jobs_per_jump: int, optional
+        Maximum number of hosts that jump through the same server that are processed
+        at the same time. 
+    timeout: float, optional
+        Maximum time (in seconds) that the commands run for each host can take.
+    **kwargs:
+        Passed directly to the function.
+
+    Returns
+    -----------
+    list of HostResult
+        The results, in the same order as `hosts`.
+    """
+    if jobs is None or jobs <= 1 or len(hosts) <= 1:
+        return [_run_for_host(function, host, kwargs, timeout=timeout) for host in hosts]
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    configs = get_inventory().hosts
+    jump_locks = {}
+    for host in hosts:
+        jump = configs.get(host, {}).get("jump_through")
+        if jump and jump not in jump_locks:
+            jump_locks[jump] = threading.BoundedSemaphore(max(jobs_per_jump or jobs, 1))
+
+    def _worker(host):
+        lock = jump_locks.get(configs.get(host, {}).get("jump_through"))
+        if lock is None:
+            return _run_for_host(function, host, kwargs, timeout=timeout, buffer=[])
+        with lock:
+            return _run_for_host(function, host, kwargs, timeout=timeout, buffer=[])
+
+    results = {}
+    with routed_output(), ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_worker, host) for host in _order_by_jump(hosts, configs)]
+        for future in as_completed(futures):
+            result = future.result()
+            results[result.host] = result
+            _print_host_output(result)
+
+    return [results[host] for host in hosts]
+
+def _multiple_hosts(all_getter=get_hosts, jobs=DEFAULT_JOBS, edits_config=False):
+    """
+    Decorator that makes a function that works on one host accept multiple hosts.
+
+    Parameters
+    -----------
+    all_getter: callable, optional
+        Function that returns all hosts, used when the `all` flag is passed.
+    jobs: int, optional
+        Default number of hosts that are processed concurrently. Functions that
+        need user interaction should set this to 1.
+    edits_config: bool, optional
+        Whether the function modifies hosts.yaml or the ssh config. If so, the changes for
+        all hosts are written at once at the end (see `host_transaction`), except the changes
+        of the hosts that fail, which are undone.
+    """
 
     def wrapper(function):
 
         @wraps(function)
-        def wrapped(host=None, all=False, **kwargs):
+        def wrapped(host=None, all=False, group=None, tag=None, via=None,
+            jobs=None, jobs_per_jump=DEFAULT_JOBS_PER_JUMP, timeout=None, only_reachable=False,
+            exit_on_failure=False, **kwargs):
 
             if all and all_getter is not None:
-                hosts = all_getter()
-            elif host is None:
+                hosts = list(all_getter())
+            elif host is None and not (group or tag or via):
                 return
             else:
-                hosts = [host] if isinstance(host, str) else host
+                hosts = [host] if isinstance(host, str) else list(host or [])
+
+            if group or tag or via:
+                selected = get_inventory().select(groups=group, tags=tag, jump_through=via)
+                if all_getter is not None and all_getter is not get_hosts:
+                    available = set(all_getter())
+                    selected = [h for h in selected if h in available]
+                hosts += [h for h in selected if h not in hosts]
+
+            if only_reachable:
+                from .liveness import reachable_hosts
+
+                hosts = reachable_hosts(hosts)
+
+            results = None
+            with host_transaction() if edits_config else nullcontext():
+                if len(hosts) == 1 and timeout is None:
+                    with host_context(hosts[0]):
+                        returns = function(hosts[0], **kwargs)
+                else:
+                    if jobs is None:
+                        jobs = wrapped.default_jobs
+
+                    results = run_for_hosts(isolated if edits_config else function, hosts,
+                        jobs=jobs, jobs_per_jump=jobs_per_jump, timeout=timeout, **kwargs)
+
+            if results is None:
+                failed = returns is False
+            else:
+                if len(results) > 1:
+                    _print_summary(results)
 
-            returns = [function(host, **kwargs) for host in hosts]
-            
-            if len(returns) == 1:
-                returns = returns[0]
+                failed = any(result.status != "ok" for result in results)
+                returns = [result.value for result in results]
+                if len(returns) == 1:
+                    returns = returns[0]
+
+            if failed and exit_on_failure:
+                sys.exit(1)
 
             return returns
+
+        @wraps(function)
+        def isolated(host, **kwargs):
+            # The hosts share the transaction, each of them undoes its own changes if it fails.
+            with _host_savepoint(host):
+                return function(host, **kwargs)
         
         def argument_gen(subparser):
             subparser.add_argument(
@@ -187,19 +456,60 @@ def _multiple_hosts(all_getter=get_hosts):
                 subparser.add_argument("--all", action="store_true", help="If set, the command"\
                 f"is repeated for all hosts returned by {all_getter.__name__}.")
 
+            subparser.add_argument("--group", action="append", help="Also act on the hosts of this group. Can be"\
+                " passed multiple times.").completer = lambda *args, **kwargs: get_inventory().values("groups")
+            subparser.add_argument("--tag", action="append", help="Also act on the hosts with this tag. Can be"\
+                " passed multiple times. If combined with --group, hosts need to match both."
+                ).completer = lambda *args, **kwargs: get_inventory().values("tags")
+            subparser.add_argument("--via", action="append", help="Also act on the hosts that jump through this host."
+                ).completer = lambda *args, **kwargs: get_inventory().values("jump_through")
+
+            subparser.add_argument("-j", "--jobs", type=int, help="Maximum number of hosts to process at the same"\
+                f" time. Defaults to {wrapped.default_jobs}, or CLUSTER_UTILS_JOBS if it is set.")
+            subparser.add_argument("--jobs-per-jump", type=int, default=DEFAULT_JOBS_PER_JUMP, help="Maximum number"\
+                " of hosts that jump through the same server that are processed at the same time.")
+            subparser.add_argument("--timeout", type=float, help="Maximum time (in seconds) that each host is given."\
+                " Hosts that take longer are reported as timed out.")
+            subparser.add_argument("--only-reachable", action="store_true", help="Skip the hosts that are not reachable"\
+                " right now, instead of waiting for each of them to time out. All hosts are probed at the same time and"\
+                " the result is reused for a while (see clu status).")
+
+            # When it is run from the CLI, clu exits with an error if any host failed.
+            subparser.set_defaults(exit_on_failure=True)
+
         wrapped.argument_gen = argument_gen
+        wrapped.default_jobs = int(os.environ.get("CLUSTER_UTILS_JOBS", jobs)) if jobs > 1 else 1
     
         return wrapped
 
     return wrapper
 
-def lshosts():
+def lshosts(group=None, tag=None, via=None):
     """
     Prints the list of hosts that are known by cluster-utils
+
+    Parameters
+    -----------
+    group: list of str, optional
+        Only list hosts that belong to one of these groups.
+    tag: list of str, optional
+        Only list hosts that have one of these tags.
+    via: list of str, optional
+        Only list hosts that jump through one of these hosts.
     """
-    print(" ".join(list(get_hosts())))
+    from .session import default_session
 
-@_multiple_hosts()
+    print(" ".join(host.name for host in default_session().hosts(group=group, tag=tag, via=via)))
+
+def _arguments_lshosts(subparser):
+    subparser.add_argument("--group", action="append", help="Only list the hosts of this group."
+        ).completer = lambda *args, **kwargs: get_inventory().values("groups")
+    subparser.add_argument("--tag", action="append", help="Only list the hosts with this tag."
+        ).completer = lambda *args, **kwargs: get_inventory().values("tags")
+    subparser.add_argument("--via", action="append", help="Only list the hosts that jump through this host."
+        ).completer = lambda *args, **kwargs: get_inventory().values("jump_through")
+
+@_multiple_hosts(jobs=1)
 def send_keys(host, t="rsa", bits=None):
     """
     Sends the SSH key of this computer to the host. 
@@ -213,31 +523,61 @@ def send_keys(host, t="rsa", bits=None):
 
         See https://www.ssh.com/ssh/keygen/.
     """
-    public_keys = Path("~").expanduser() / ".ssh" / f"id_{t}.pub"
+    public_keys = _ensure_key(t, bits)
+    if public_keys is None:
+        return
 
-    if not public_keys.exists():
-        if bits is None:
-            bits = {"rsa": "4096", "ecdsa": "521"}.get(t)
-        subprocess.run(["ssh-keygen", "-t", t, *(["-b", str(bits)] if bits else [])])
-        if not public_keys.exists():
-            return
+    from .connections import ssh_command, multiplexing_options
 
     config = get_hosts()[host]
 
+    if _key_accepted(host):
+        print(f"(cluster-utils) {host} already accepts our key.")
+        return True
+
     try:
-        if config["host_auth_keys"] != "~/.ssh/authorized_keys" or shutil.which("ssh-copy-id") is None:
-            process = subprocess.Popen(('cat', public_keys), stdout=subprocess.PIPE)
-            output = subprocess.check_output(('ssh', host, f"cat >> {config['host_auth_keys']}"), stdin=process.stdout)
-            process.wait()
-        else:
-            process = subprocess.run(["ssh-copy-id", "-i", public_keys, host])
-            process.check_returncode()
+        # Password prompts of different hosts would get mixed, so we ask one at a time.
+        with _INTERACTIVE_LOCK:
+            if config["host_auth_keys"] != "~/.ssh/authorized_keys" or shutil.which("ssh-copy-id") is None:
+                processes.run(ssh_command(host, f"cat >> {config['host_auth_keys']}"), input=public_keys.read_bytes()).check_returncode()
+            else:
+                process = processes.run(["ssh-copy-id", *multiplexing_options(), "-i", public_keys, host])
+                process.check_returncode()
         return True
+    except subprocess.TimeoutExpired:
+        raise
     except:
         return False
 
+def _ensure_key(t="rsa", bits=None):
+    """Returns the path to the public key with the requested encryption, creating the key if needed"""
+    public_keys = Path("~").expanduser() / ".ssh" / f"id_{t}.pub"
+
+    with _INTERACTIVE_LOCK:
+        if not public_keys.exists():
+            if bits is None:
+                bits = {"rsa": "4096", "ecdsa": "521"}.get(t)
+            processes.run(["ssh-keygen", "-t", t, *(["-b", str(bits)] if bits else [])])
+            if not public_keys.exists():
+                return None
+
+    return public_keys
+
+def _key_accepted(host):
+    """
+    Checks whether the host lets us in without asking for anything.
+
+    The shared connection is not used on purpose, since it could have been
+    authenticated with a password.
+    """
+    completed = processes.run(["ssh", "-o", "BatchMode=yes", "-o", "ControlPath=none", "-o", "ConnectTimeout=10",
+        host, "true"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return completed.returncode == 0
+
 def move_key_in_host(host, path):
-    subprocess.run(["ssh", host, f"cp ~/.ssh/authorized_keys {path}"])
+    from .connections import ssh_command
+
+    processes.run(ssh_command(host, f"cp ~/.ssh/authorized_keys {path}"))
 
 def _arguments_sendkey(subparser):
     send_keys.argument_gen(subparser)
@@ -245,24 +585,12 @@ def _arguments_sendkey(subparser):
     subparser.add_argument("-t", default="rsa",
         help="The encryption algorithm used to generate the key. See https://www.ssh.com/ssh/keygen/.")
 
-def setup_host(config=None, use_defaults=False, no_conn=False, **kwargs):
-    from .script_management import setup_host_scripts
-
-    if config is None or config == []:
-        config = {}
-
-    if not isinstance(config, dict) :
-        hosts_dict = get_hosts(config)
-
-        for name, config_vals in hosts_dict.items():
-            if "host" not in config_vals:
-                config_vals["host"] = name
-            setup_host(config=config_vals, use_defaults=use_defaults, no_conn=no_conn, **kwargs)
-        return
-
-    current_hosts = get_hosts()
+def _complete_config(config, use_defaults=False):
+    """
+    Makes sure that the configuration has a value for all KNOWN_CONFIG_KEYS.
 
-    config.update({key: val for key, val in kwargs.items() if val is not None})
+    Missing values are asked for, unless `use_defaults` is `True` and there is a default.
+    """
 
     def _ask_for_value(key, specs):
 
@@ -288,6 +616,23 @@ def setup_host(config=None, use_defaults=False, no_conn=False, **kwargs):
     for key, specs in KNOWN_CONFIG_KEYS.items():
         _ask_for_value(key, specs)
 
+    return config
+
+def setup_host(config=None, use_defaults=False, no_conn=False, resume=False, jobs=None, **kwargs):
+    from .script_management import setup_host_scripts
+
+    if config is None or config == []:
+        config = {}
+
+    if not isinstance(config, dict) :
+        return setup_hosts(get_hosts(config), use_defaults=use_defaults, no_conn=no_conn, resume=resume, jobs=jobs, **kwargs)
+
+    current_hosts = get_hosts()
+
+    config.update({key: val for key, val in kwargs.items() if val is not None})
+
+    _complete_config(config, use_defaults=use_defaults)
+
     jump_through = config.get("jump_through")
     if jump_through and jump_through not in current_hosts:
         setup_host(host=jump_through)
@@ -299,13 +644,176 @@ def setup_host(config=None, use_defaults=False, no_conn=False, **kwargs):
     if no_conn:
         return True
 
+    # ssh (and the rest of clu) needs to know about the host before we connect to it
+    flush_host_transaction()
+
     if send_keys(config["host"]):
         setup_host_scripts(config["host"])
     else:
-        print("(cluster-utils) WE COULD NOT SEND THE KEYS. Therefore we will not try to setup scripts in the host.")
-        print(" When there is connection, you can try again:")
-        print(f"     clu sendkeys {config['host']}")
-        print(f"     clu setuphost {config['host']}")
+        _print_keys_failed(config["host"])
+
+def _print_keys_failed(host):
+    print("(cluster-utils) WE COULD NOT SEND THE KEYS. Therefore we will not try to setup scripts in the host.")
+    print(" When there is connection, you can try again:")
+    print(f"     clu sendkeys {host}")
+    print(f"     clu setuphost {host}")
+
+class SetupStatus:
+    """
+    Keeps track of the setup steps that succeeded for each host.
+
+    It is stored in CLUSTER_UTILS_ROOT/.setup_status.json, so that a bulk setup that partially
+    failed can be resumed. Steps are only considered done if the configuration of the host
+    hasn't changed since they were done.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path or get_path(".setup_status.json"))
+        self._lock = threading.Lock()
+        try:
+            self.data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            self.data = {}
+
+    @staticmethod
+    def config_id(config):
+        return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+    def is_done(self, host, step, config):
+        entry = self.data.get(host, {})
+        return entry.get("config") == self.config_id(config) and step in entry.get("done", {})
+
+    def mark_done(self, host, step, config):
+        with self._lock:
+            config_id = self.config_id(config)
+            entry = self.data.get(host, {})
+            if entry.get("config") != config_id:
+                entry = {"config": config_id, "done": {}}
+            entry["done"][step] = time.time()
+            self.data[host] = entry
+
+            tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}")
+            tmp_path.write_text(json.dumps(self.data, indent=1))
+            os.replace(tmp_path, self.path)
+
+def _connect_host(host, configs, status, resume=False):
+    """Connection steps of the bulk setup: sending the keys and setting up the scripts."""
+    from .script_management import setup_host_scripts
+
+    config = configs[host]
+
+    if not (resume and status.is_done(host, "keys", config)):
+        if not send_keys(host):
+            _print_keys_failed(host)
+            return False
+        status.mark_done(host, "keys", config)
+
+    if not (resume and status.is_done(host, "scripts", config)):
+        if not setup_host_scripts(host):
+            return False
+        status.mark_done(host, "scripts", config)
+
+    return True
+
+def setup_hosts(hosts_dict, use_defaults=False, no_conn=False, resume=False, jobs=None, **kwargs):
+    """
+    Sets up many hosts at once.
+
+    It works in three phases:
+        1. The configuration of every host is completed (asking for the missing values
+        or using the defaults), before anything is written.
+        2. All hosts are added to hosts.yaml and the ssh config in a single transaction.
+        3. Keys are sent and scripts are set up in the hosts, concurrently. Hosts that jump
+        through other hosts of the batch are connected after them.
+
+    Parameters
+    -----------
+    hosts_dict: dict
+        The configuration of each host, as read from a yaml file.
+    use_defaults: bool, optional
+        Don't ask for values that have a default.
+    no_conn: bool, optional
+        Skip the connection phase.
+    resume: bool, optional
+        Skip the steps that already succeeded for each host (in a previous run with the
+        same configuration).
+    jobs: int, optional
+        Maximum number of hosts to connect to at the same time.
+    **kwargs:
+        Values that override the configuration of all hosts.
+    """
+    status = SetupStatus()
+    current_hosts = get_hosts()
+    overrides = {key: val for key, val in kwargs.items() if val is not None}
+
+    # 1. Validation
+    configs = {}
+    for name, config_vals in hosts_dict.items():
+        config = {"host": name}
+        if resume and name in current_hosts:
+            # Don't ask again for the values that we asked in the previous run
+            config.update(current_hosts[name] or {})
+        config.update(config_vals or {})
+        config.update(overrides)
+        configs[config["host"]] = _complete_config(config, use_defaults=use_defaults)
+
+    missing_jumps = [c["jump_through"] for c in configs.values() if c.get("jump_through")]
+    while missing_jumps:
+        jump = missing_jumps.pop(0)
+        if jump in current_hosts or jump in configs:
+            continue
+        configs = {jump: _complete_config({"host": jump}, use_defaults=use_defaults), **configs}
+        if configs[jump].get("jump_through"):
+            missing_jumps.append(configs[jump]["jump_through"])
+
+    # Hosts that would jump through themselves (possibly after some jumps) can't be set up.
+    def jump_of(host):
+        return (configs.get(host) or current_hosts.get(host) or {}).get("jump_through") or None
+
+    _, cyclic = _jump_levels([*configs, *(host for host in current_hosts if host not in configs)], jump_of)
+    failed = {host for host in cyclic if host in configs}
+    if failed:
+        print(f"(cluster-utils) The jump_through hosts of {' '.join(sorted(failed))} form a cycle, they will not be set up.")
+        configs = {host: config for host, config in configs.items() if host not in failed}
+
+    # 2. Registration
+    print(f"(cluster-utils) Registering {len(configs)} hosts...")
+    with processes.phase("register hosts"), host_transaction():
+        for config in configs.values():
+            write_host_ssh(config)
+        add_hosts(configs)
+
+    if no_conn:
+        return not failed
+
+    # 3. Connection. The key is created before, since ssh-keygen is interactive.
+    # Then hosts are connected by levels, so that jump hosts are ready before the
+    # hosts that jump through them.
+    if _ensure_key() is None:
+        print("(cluster-utils) There is no ssh key to send, the hosts can't be set up.")
+        return False
+
+    levels, _ = _jump_levels(list(configs), jump_of)
+    for level in levels:
+        skipped = [host for host in level if configs[host].get("jump_through") in failed]
+        if skipped:
+            print(f"(cluster-utils) Skipping {' '.join(skipped)}, their jump host could not be set up.")
+            failed.update(skipped)
+
+        results = run_for_hosts(_connect_host, [h for h in level if h not in skipped],
+            jobs=jobs or _connect_host_jobs(), status=status, resume=resume,
+            configs=configs)
+        failed.update(result.host for result in results if result.status != "ok")
+
+    if failed:
+        print(f"(cluster-utils) The setup failed for: {' '.join(sorted(failed))}")
+        print(" Once the problem is solved, you can continue with:")
+        print("     clu setuphost --config <same files> --resume")
+
+    return not failed
+
+def _connect_host_jobs():
+    return int(os.environ.get("CLUSTER_UTILS_JOBS", DEFAULT_JOBS))
 
 def _file_extension_completer_gen(extension=""):
 
@@ -329,20 +837,26 @@ def _arguments_setuphost(subparser):
         " have a working connection to them or for testing"
     )
 
-@_multiple_hosts()
+    subparser.add_argument("--resume", action="store_true", help="When setting up hosts from yaml files, skip the steps that"\
+        " already succeeded for each host in a previous run (as long as its configuration didn't change).")
+
+    subparser.add_argument("-j", "--jobs", type=int, help="When setting up hosts from yaml files, maximum number of hosts"\
+        f" to connect to at the same time. Defaults to {DEFAULT_JOBS}, or CLUSTER_UTILS_JOBS if it is set.")
+
+@_multiple_hosts(edits_config=True)
 def remove_host(host):
     # There are 3 steps:
     # 1. Remove the mountpoint for that host
     from .mounting import remove_mount_point
     remove_mount_point(host)
 
-    # 2. SSH config: Remove from the Host definition to the next empty line
+    # 2. SSH config: Remove the Host definition
     remove_host_ssh_config(host)
 
     # 3. Remove host from the yaml file
     remove_hosts_yaml([host])
 
-@_multiple_hosts()
+@_multiple_hosts(jobs=1, edits_config=True)
 def update_host_config(host, **kwargs):
     """
     Updates the host configuration with the new values provided.
@@ -371,7 +885,7 @@ def _arguments_update_host(subparser):
 
     add_config_arguments(subparser) 
 
-SubCommand(lshosts)
+SubCommand(lshosts, _arguments_lshosts, served=True)
 SubCommand(send_keys, _arguments_sendkey, name="sendkeys")
 SubCommand(setup_host, _arguments_setuphost, name="setuphost")
 SubCommand(remove_host, remove_host.argument_gen, name="removehost")
@@ -0,0 +1,422 @@
+"""
+Local index of the files of the hosts.
+
+Walking a mounted host (e.g. with `find` or `du`) needs one round trip per file. Instead, `clu index`
+runs a single `find` in the host and stores what it prints in a small sqlite database (one per host, in
+CLUSTER_UTILS_ROOT/.cache/index). `clu find`, `clu ls` and `clu du` then answer from the database.
+
+Paths in the index are relative to the directory that is mounted (the `mount_target` of the host),
+so that they map directly to the local mountpoint.
+"""
+from pathlib import Path, PurePosixPath
+import shlex
+import sqlite3
+import subprocess
+import time
+
+from .host_management import get_hosts
+from .inventory import get_inventory
+from .mounting import get_host_from_path, get_mounts_dir
+from .path import get_path
+from .sizes import human_size, parse_size
+from .subcommand import SubCommand
+from .connections import ssh_command, quote_remote_path
+from . import processes
+
+__all__ = ["index", "find", "ls", "du"]
+
+# Format of each entry printed by find: kind of record, type, size, mtime and path
+_FIND_FORMAT = r"\t%y\t%s\t%T@\t%p\0"
+# Number of entries inserted in the database at once
+_BATCH_SIZE = 10000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY, parent TEXT NOT NULL, name TEXT NOT NULL,
+    type TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_parent ON entries(parent);
+CREATE TABLE IF NOT EXISTS roots (path TEXT PRIMARY KEY, indexed_at REAL NOT NULL);
+"""
+
+def _index_path(host):
+    return get_path(".cache") / "index" / f"{host}.sqlite"
+
+def _connect(host, create=False):
+    db_path = _index_path(host)
+    if not db_path.exists():
+        if not create:
+            raise ValueError(f"{host} has not been indexed yet. Run 'clu index {host}' first.")
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+
+    db = sqlite3.connect(str(db_path))
+    db.executescript(_SCHEMA)
+    return db
+
+def _normalize(path):
+    """Paths relative to the mount root, without './' and with '' for the root itself"""
+    path = str(PurePosixPath(path))
+    return "" if path == "." else path
+
+def _parent(path):
+    return _normalize(PurePosixPath(path).parent) if path else ""
+
+def _subtree_condition(path):
+    """SQL condition (and its parameters) that matches a path and everything below it"""
+    if not path:
+        return "1", ()
+    escaped = path.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return "(path = ? OR path LIKE ? ESCAPE '\\')", (path, f"{escaped}/%")
+
+def _remote_cd(mount_target):
+    """Shell command that goes to the directory that is mounted"""
+    return f"cd {quote_remote_path(mount_target)}"
+
+def _resolve(host=None, path=None):
+    """
+    Gets the host and the path relative to its mount root.
+
+    If no host is given, `path` is a local path inside a mountpoint (by default, the current directory).
+    Otherwise, it is relative to the mount root of the host.
+    """
+    if host is None:
+        host, remote_dir = get_host_from_path(path or "")
+        mount_target = (get_inventory().hosts.get(host) or {}).get("mount_target", "")
+        return host, _normalize(Path(remote_dir).relative_to(mount_target))
+
+    if host not in get_inventory():
+        raise ValueError(f"{host} is not a known host")
+
+    return host, _normalize((path or "").strip("/"))
+
+def _local_path(host, path):
+    return get_mounts_dir() / host / path
+
+def _stream_entries(host, script):
+    """
+    Runs a script in the host and parses the entries that it prints.
+
+    Yields
+    ---------
+    tuple
+        (kind of record, fields). Fields are (path, parent, name, type, size, mtime) for entries
+        and (remote time,) for the "N" record.
+    """
+    process = processes.Popen(ssh_command(host, script), stdout=subprocess.PIPE)
+
+    remainder = b""
+    while True:
+        chunk = process.stdout.read(1 << 20)
+        if not chunk:
+            break
+        records = (remainder + chunk).split(b"\0")
+        remainder = records.pop()
+        for record in records:
+            fields = record.decode(errors="surrogateescape").split("\t", 4)
+            if fields[0] == "N":
+                yield "N", (float(fields[1]),)
+            elif len(fields) == 5:
+                kind, type_, size, mtime, path = fields
+                path = _normalize(path)
+                yield kind, (path, _parent(path), PurePosixPath(path).name, type_, int(size), float(mtime))
+
+    if process.wait() != 0:
+        raise RuntimeError(f"Listing the files of {host} failed (the host needs GNU find).")
+
+def _find_script(mount_target, roots, since=None):
+    """
+    Script that lists everything under some paths.
+
+    If `since` is given, only what changed after it is listed ("C" records), and for each directory that
+    changed, all its children are also listed ("L" records) so that we can find out what was removed.
+    """
+    lines = [_remote_cd(mount_target) + " || exit 1", "printf 'N\\t%s\\0' \"$(date +%s)\""]
+
+    roots = " ".join(shlex.quote(root or ".") for root in roots)
+    if since is None:
+        lines.append(f"find {roots} -printf 'C{_FIND_FORMAT}'")
+    else:
+        lines.append(f"find {roots} -newermt @{int(since)} -printf 'C{_FIND_FORMAT}'"
+            f" -type d -exec find {{}} -mindepth 1 -maxdepth 1 -printf 'L{_FIND_FORMAT}' \\;")
+
+    return "\n".join(lines)
+
+def _insert(db, entries):
+    # The root of the host is not stored, only what is inside it.
+    db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", (entry for entry in entries if entry[0]))
+
+def _full_index(db, host, mount_target, root):
+    condition, params = _subtree_condition(root)
+    db.execute(f"DELETE FROM entries WHERE {condition}", params)
+
+    remote_time, batch, count = None, [], 0
+    for kind, fields in _stream_entries(host, _find_script(mount_target, [root])):
+        if kind == "N":
+            remote_time = fields[0]
+            continue
+        batch.append(fields)
+        if len(batch) >= _BATCH_SIZE:
+            _insert(db, batch)
+            count += len(batch)
+            batch = []
+    _insert(db, batch)
+
+    return remote_time, count + len(batch)
+
+def _incremental_index(db, host, mount_target, root, since):
+    remote_time, changed, listed = None, [], {}
+    for kind, fields in _stream_entries(host, _find_script(mount_target, [root], since=since)):
+        if kind == "N":
+            remote_time = fields[0]
+        elif kind == "C":
+            changed.append(fields)
+        else:
+            listed.setdefault(fields[1], []).append(fields)
+
+    changed_paths = {entry[0] for entry in changed}
+    _insert(db, changed)
+
+    # Entries that are no longer in the directories that changed have been removed.
+    removed = 0
+    for entry in changed:
+        if entry[3] != "d":
+            continue
+        children = {child[0] for child in listed.get(entry[0], [])}
+        for (path,) in db.execute("SELECT path FROM entries WHERE parent = ?", (entry[0],)).fetchall():
+            if path not in children:
+                condition, params = _subtree_condition(path)
+                removed += db.execute(f"DELETE FROM entries WHERE {condition}", params).rowcount
+
+    # Directories that were moved here keep their mtime, so we need to list them completely.
+    new_dirs = []
+    for children in listed.values():
+        for child in children:
+            known = db.execute("SELECT 1 FROM entries WHERE path = ?", (child[0],)).fetchone()
+            if child[3] == "d" and child[0] not in changed_paths and known is None:
+                new_dirs.append(child[0])
+        _insert(db, children)
+
+    added = 0
+    if new_dirs:
+        entries = [fields for kind, fields in _stream_entries(host, _find_script(mount_target, new_dirs)) if kind == "C"]
+        _insert(db, entries)
+        added = len(entries)
+
+    return remote_time, len(changed) + added + removed
+
+def index(host=None, path=None, full=False):
+    """
+    Indexes the files of a host, so that `clu find`, `clu ls` and `clu du` can answer without going through the mount.
+
+    A single `find` runs in the host and its output is stored locally. If the path (or a parent of it)
+    was already indexed, only what changed since then is listed.
+
+    Parameters
+    -----------
+    host: str, optional
+        The name of the host, as understood by ssh (and cluster-utils).
+
+        If not provided, it is inferred from your current path (you must be inside a mountpoint).
+    path: str, optional
+        The directory to index. If a host is provided, it is relative to the mounted directory of the
+        host. Otherwise, it is a local path inside the mountpoint. Defaults to everything that is mounted.
+    full: bool, optional
+        List everything again, even if it was indexed before.
+    """
+    if host is not None and path is None and host not in get_inventory():
+        # Only a path was given
+        host, path = None, host
+
+    host, root = _resolve(host, path)
+    mount_target = (get_inventory().hosts.get(host) or {}).get("mount_target", "")
+
+    start = time.perf_counter()
+    with _connect(host, create=True) as db:
+        # The last time that this path was indexed (as a whole or as part of a parent)
+        since = None
+        for indexed_root, indexed_at in db.execute("SELECT path, indexed_at FROM roots"):
+            if indexed_root == root or not indexed_root or root.startswith(f"{indexed_root}/"):
+                since = indexed_at if since is None else max(since, indexed_at)
+
+        if full or since is None:
+            remote_time, count = _full_index(db, host, mount_target, root)
+            what = f"{count} entries"
+        else:
+            # Margin for changes that happened during the second of the last index
+            remote_time, count = _incremental_index(db, host, mount_target, root, since - 1)
+            what = f"{count} changes"
+
+        condition, params = _subtree_condition(root)
+        db.execute(f"DELETE FROM roots WHERE {condition}", params)
+        db.execute("INSERT OR REPLACE INTO roots VALUES (?, ?)", (root, remote_time or time.time()))
+
+    print(f"(cluster-utils) Indexed {host}:{root or '.'} ({what}) in {time.perf_counter() - start:.1f}s")
+
+def _arguments_index(subparser):
+    subparser.add_argument("host", nargs="?", help="The host to index. If not provided, it will be inferred from"\
+        " your current path (you must be inside a mountpoint)").completer = lambda *args, **kwargs: get_hosts()
+
+    subparser.add_argument("path", nargs="?", help="The directory to index. If a host is provided, relative to the"\
+        " mounted directory of the host. Otherwise, a local path inside the mountpoint.")
+
+    subparser.add_argument("--full", action="store_true", help="List everything again instead of only what changed.")
+
+def _open_index(host=None, path=None, refresh=False):
+    """Resolves the path and opens the index of its host, checking that the path is indexed"""
+    host, path = _resolve(host, path)
+
+    if refresh:
+        index(host, path)
+
+    db = _connect(host)
+    covered = any(root == path or not root or path.startswith(f"{root}/")
+        for (root,) in db.execute("SELECT path FROM roots"))
+    if not covered:
+        raise ValueError(f"{_local_path(host, path)} is not indexed. Run 'clu index {host} {path}' first.")
+
+    return host, path, db
+
+def find(path=None, host=None, name=None, type=None, size=None, mtime=None, refresh=False):
+    """
+    Finds files in a host using its index (see `clu index`).
+
+    Parameters
+    -----------
+    path: str, optional
+        Where to search. A local path inside a mountpoint (the current directory by default) or,
+        if a host is given, a path relative to its mounted directory.
+    host: str, optional
+        The name of the host, as understood by ssh (and cluster-utils).
+    name: str, optional
+        Glob pattern that the name of the files must match.
+    type: str, optional
+        'f' for files, 'd' for directories, 'l' for symbolic links.
+    size: str, optional
+        Size of the files, as understood by `find -size`, e.g. +10M (more than 10 MiB) or -1k (less than 1 KiB).
+    mtime: float, optional
+        Days since the last modification. +N for more than N days ago and -N for less than N days ago.
+    refresh: bool, optional
+        Update the index before searching.
+    """
+    host, path, db = _open_index(host, path, refresh=refresh)
+
+    condition, params = _subtree_condition(path)
+    conditions, params = [condition], list(params)
+    if name:
+        conditions.append("name GLOB ?")
+        params.append(name)
+    if type:
+        conditions.append("type = ?")
+        params.append(type)
+    for column, value, factor in (("size", size, None), ("mtime", mtime, 86400)):
+        if not value:
+            continue
+        sign = value[0] if value[0] in "+-" else ""
+        value = value.lstrip("+-")
+        if column == "size":
+            threshold = parse_size(value)
+            operator = {"+": ">", "-": "<", "": "="}[sign]
+        else:
+            threshold = time.time() - float(value) * factor
+            operator = {"+": "<", "-": ">", "": ">="}[sign]
+        conditions.append(f"{column} {operator} ?")
+        params.append(threshold)
+
+    for (found,) in db.execute(f"SELECT path FROM entries WHERE {' AND '.join(conditions)} ORDER BY path", params):
+        print(_local_path(host, found))
+
+def _arguments_find(subparser):
+    subparser.add_argument("path", nargs="?", help="Where to search. A local path inside a mountpoint (the current"\
+        " directory by default) or, if --host is given, a path relative to the mounted directory of the host.")
+
+    subparser.add_argument("--host", help="The host where to search, if you are not inside its mountpoint."
+        ).completer = lambda *args, **kwargs: get_hosts()
+
+    subparser.add_argument("--name", help="Glob pattern that the names must match (e.g. '*.fdf').")
+    subparser.add_argument("--type", choices=["f", "d", "l"], help="f: files, d: directories, l: symbolic links.")
+    subparser.add_argument("--size", help="Size, as understood by find: +10M (more than 10 MiB), -1k (less than 1 KiB)...")
+    subparser.add_argument("--mtime", help="Days since the last modification: +N (more than N days ago) or -N (less than N).")
+    subparser.add_argument("-r", "--refresh", action="store_true", help="Update the index before searching.")
+
+def ls(path=None, host=None, long=False, refresh=False):
+    """
+    Lists the contents of a directory of a host using its index (see `clu index`).
+
+    Parameters
+    -----------
+    path: str, optional
+        The directory. A local path inside a mountpoint (the current directory by default) or,
+        if a host is given, a path relative to its mounted directory.
+    host: str, optional
+        The name of the host, as understood by ssh (and cluster-utils).
+    long: bool, optional
+        Show also the type, size and modification date of each entry.
+    refresh: bool, optional
+        Update the index before listing.
+    """
+    host, path, db = _open_index(host, path, refresh=refresh)
+
+    rows = db.execute("SELECT name, type, size, mtime FROM entries WHERE parent = ? AND path != '' ORDER BY name", (path,))
+    for name, type_, size, mtime in rows:
+        if long:
+            date = time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime))
+            print(f"{type_} {human_size(size):>7} {date} {name}")
+        else:
+            print(name)
+
+def _arguments_ls(subparser):
+    subparser.add_argument("path", nargs="?", help="The directory to list. A local path inside a mountpoint (the current"\
+        " directory by default) or, if --host is given, a path relative to the mounted directory of the host.")
+
+    subparser.add_argument("--host", help="The host, if you are not inside its mountpoint."
+        ).completer = lambda *args, **kwargs: get_hosts()
+
+    subparser.add_argument("-l", "--long", action="store_true", help="Show the type, size and modification date.")
+    subparser.add_argument("-r", "--refresh", action="store_true", help="Update the index before listing.")
+
+def du(path=None, host=None, summarize=False, refresh=False):
+    """
+    Shows the disk usage of a directory of a host using its index (see `clu index`).
+
+    Parameters
+    -----------
+    path: str, optional
+        The directory. A local path inside a mountpoint (the current directory by default) or,
+        if a host is given, a path relative to its mounted directory.
+    host: str, optional
+        The name of the host, as understood by ssh (and cluster-utils).
+    summarize: bool, optional
+        Show only the total, not the usage of each entry in the directory.
+    refresh: bool, optional
+        Update the index before computing the usage.
+    """
+    host, path, db = _open_index(host, path, refresh=refresh)
+
+    condition, params = _subtree_condition(path)
+    prefix_length = len(path) + 1 if path else 0
+
+    total, per_child = 0, {}
+    for found, size in db.execute(f"SELECT path, size FROM entries WHERE type = 'f' AND {condition}", params):
+        total += size
+        if not summarize and found != path:
+            child = found[prefix_length:].partition("/")[0]
+            per_child[child] = per_child.get(child, 0) + size
+
+    for child, size in sorted(per_child.items(), key=lambda item: item[1], reverse=True):
+        print(f"{human_size(size):>8}  {_local_path(host, path) / child}")
+    print(f"{human_size(total):>8}  {_local_path(host, path)}")
+
+def _arguments_du(subparser):
+    subparser.add_argument("path", nargs="?", help="The directory. A local path inside a mountpoint (the current"\
+        " directory by default) or, if --host is given, a path relative to the mounted directory of the host.")
+
+    subparser.add_argument("--host", help="The host, if you are not inside its mountpoint."
+        ).completer = lambda *args, **kwargs: get_hosts()
+
+    subparser.add_argument("-s", "--summarize", action="store_true", help="Show only the total.")
+    subparser.add_argument("-r", "--refresh", action="store_true", help="Update the index before computing the usage.")
+
+SubCommand(index, _arguments_index)
+SubCommand(find, _arguments_find)
+SubCommand(ls, _arguments_ls)
+SubCommand(du, _arguments_du)
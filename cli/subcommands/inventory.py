@@ -0,0 +1,288 @@
+"""
+Cached access to the host inventory.
+
+Parsing yaml is slow (and so is importing PyYAML), so the parsed contents of each
+hosts file are kept:
+    - In memory, for the rest of the process.
+    - On disk (in CLUSTER_UTILS_ROOT/.cache/inventory), for the next processes.
+Both are invalidated whenever the yaml file changes (mtime, size or inode).
+"""
+from contextlib import contextmanager
+import hashlib
+import marshal
+import os
+import threading
+
+from .path import get_path
+from .processes import phase
+
+__all__ = []
+
+# Keys of the host configuration that hosts can be selected by
+INDEXED_KEYS = ("groups", "tags", "jump_through")
+
+_memory_cache = {}
+_lock = threading.RLock()
+
+def _file_key(filepath):
+    st = os.stat(filepath)
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _disk_cache_path(filepath):
+    name = hashlib.sha1(os.path.abspath(filepath).encode()).hexdigest()[:16]
+    return get_path(".cache") / "inventory" / name
+
+def _read_disk_cache(filepath, key):
+    try:
+        with open(_disk_cache_path(filepath), "rb") as f:
+            cached_key, hosts = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    return hosts if tuple(cached_key) == key else None
+
+def _write_disk_cache(filepath, key, hosts):
+    cache = _disk_cache_path(filepath)
+    try:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache.with_name(f"{cache.name}.{os.getpid()}.{threading.get_ident()}")
+        with open(tmp_file, "wb") as f:
+            marshal.dump((key, hosts), f)
+        os.replace(tmp_file, cache)
+    except (OSError, ValueError):
+        # ValueError: the yaml contains objects that marshal doesn't understand, we just don't cache it.
+        pass
+
+def _parse_yaml(filepath):
+    with phase("parse yaml", file=os.path.basename(filepath)):
+        import yaml
+
+        with open(filepath) as f:
+            return yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)) or {}
+
+def _copy_hosts(hosts):
+    # Callers are free to modify what they receive, so they get their own copy of the configs.
+    return {name: dict(config) if isinstance(config, dict) else config for name, config in hosts.items()}
+
+def load_hosts_file(filepath):
+    """
+    Reads a yaml file containing hosts, using the caches if possible.
+
+    Parameters
+    -----------
+    filepath: str or Path
+        The path to the yaml file.
+
+    Returns
+    ---------
+    dict
+        The hosts, as a copy that can be freely modified. Empty if the file doesn't exist.
+    """
+    filepath = os.fspath(filepath)
+    try:
+        key = _file_key(filepath)
+    except OSError:
+        return {}
+
+    with _lock:
+        cached = _memory_cache.get(filepath)
+        if cached is not None and cached[0] == key:
+            return _copy_hosts(cached[1])
+
+        hosts = _read_disk_cache(filepath, key)
+        if hosts is None:
+            hosts = _parse_yaml(filepath)
+            _write_disk_cache(filepath, key, hosts)
+
+        _memory_cache[filepath] = (key, hosts)
+
+    return _copy_hosts(hosts)
+
+def write_hosts_file(hosts, filepath):
+    """
+    Writes hosts to a yaml file (atomically) and updates the caches.
+
+    Parameters
+    -----------
+    hosts: dict
+        The hosts to write.
+    filepath: str or Path
+        The path to the yaml file.
+    """
+    import yaml
+
+    filepath = os.fspath(filepath)
+    tmp_file = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    with _lock, phase("write yaml", file=os.path.basename(filepath)):
+        with open(tmp_file, "w") as f:
+            yaml.dump(hosts, f, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper))
+        os.replace(tmp_file, filepath)
+
+        hosts = _copy_hosts(hosts)
+        key = _file_key(filepath)
+        _memory_cache[filepath] = (key, hosts)
+        _write_disk_cache(filepath, key, hosts)
+
+_open_registries = {}
+_open_lock = threading.Lock()
+
+@contextmanager
+def _open_registry(filepath, load):
+    filepath = os.fspath(filepath or get_path("hosts.yaml"))
+
+    with _open_lock:
+        entry = _open_registries.get(filepath)
+        if entry is None:
+            # [hosts, hosts as they were read, number of users, whether something failed]
+            entry = _open_registries[filepath] = [None, None, 0, False]
+        entry[2] += 1
+
+    try:
+        if load:
+            with _open_lock:
+                if entry[0] is None:
+                    entry[0] = load_hosts_file(filepath)
+                    entry[1] = _copy_hosts(entry[0])
+        yield entry[0]
+    except BaseException:
+        # Only an exception that leaves the last user cancels the write. Inside a batch, an
+        # exception that is handled before the batch ends (e.g. the failure of one of many
+        # hosts) doesn't throw away the changes of the others.
+        with _open_lock:
+            if entry[2] == 1:
+                entry[3] = True
+        raise
+    finally:
+        with _open_lock:
+            entry[2] -= 1
+            if entry[2] == 0:
+                del _open_registries[filepath]
+                if not entry[3] and entry[0] is not None and entry[0] != entry[1]:
+                    write_hosts_file(entry[0], filepath)
+
+@contextmanager
+def editing(filepath=None):
+    """
+    Gives access to the hosts of a yaml file (hosts.yaml by default) to modify them.
+
+    Nested (or concurrent) uses for the same file share the same dictionary, and the file
+    is only written when the last of them exits, if something changed and it didn't exit
+    with an exception.
+    """
+    with _open_registry(filepath, load=True) as hosts:
+        yield hosts
+
+@contextmanager
+def batch(filepath=None):
+    """
+    Groups all the edits done inside it, so that the hosts file is written only once at the end.
+
+    If an exception leaves the batch, nothing is written. Exceptions that are handled inside it don't
+    prevent the changes from being written, so code that handles them must undo its own changes
+    (see `host_management._host_savepoint`).
+    """
+    with _open_registry(filepath, load=False):
+        yield
+
+def flush(filepath=None):
+    """Writes the pending changes of an open batch now."""
+    filepath = os.fspath(filepath or get_path("hosts.yaml"))
+
+    with _open_lock:
+        entry = _open_registries.get(filepath)
+        if entry is not None and entry[0] is not None and entry[0] != entry[1]:
+            write_hosts_file(entry[0], filepath)
+            entry[1] = _copy_hosts(entry[0])
+
+def _as_list(value):
+    """Indexed values can be given as lists or as comma/space separated strings"""
+    if value is None or value == "":
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return [str(v) for v in value]
+    return str(value).replace(",", " ").split()
+
+class Inventory:
+    """
+    Set of hosts, with indexes to select them by group, tag or jump host.
+
+    Parameters
+    -----------
+    hosts: dict
+        The configuration of the hosts, as stored in hosts.yaml
+    """
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self._indexes = None
+
+    def __contains__(self, host):
+        return host in self.hosts
+
+    def __iter__(self):
+        return iter(self.hosts)
+
+    def __len__(self):
+        return len(self.hosts)
+
+    @property
+    def indexes(self):
+        """Dictionary with an index {value: [hosts]} for each of the INDEXED_KEYS"""
+        if self._indexes is None:
+            indexes = {key: {} for key in INDEXED_KEYS}
+            for host, config in self.hosts.items():
+                config = config or {}
+                for key in INDEXED_KEYS:
+                    for value in _as_list(config.get(key)):
+                        indexes[key].setdefault(value, []).append(host)
+            self._indexes = indexes
+        return self._indexes
+
+    def values(self, key):
+        """All the values that an indexed key takes (e.g. all the groups)"""
+        return sorted(self.indexes[key])
+
+    def select(self, groups=None, tags=None, jump_through=None):
+        """
+        Selects hosts by their indexed keys.
+
+        Multiple values for the same key are joined (the host needs to match one of them),
+        while different keys are intersected (the host needs to match all of them).
+
+        Returns
+        ---------
+        list of str
+            The selected hosts, in the order of the inventory.
+        """
+        selected = set(self.hosts)
+        for key, values in zip(INDEXED_KEYS, (groups, tags, jump_through)):
+            if values:
+                selected &= {host for value in _as_list(values) for host in self.indexes[key].get(value, [])}
+
+        return [host for host in self.hosts if host in selected]
+
+_inventories = {}
+
+def get_inventory(filepath=None):
+    """
+    Returns the inventory of known hosts (read from hosts.yaml, unless another file is given).
+
+    The inventory is shared, so don't modify it. Use `get_hosts` to get a copy that you can modify.
+    """
+    if filepath is None:
+        filepath = get_path("hosts.yaml")
+
+    filepath = os.fspath(filepath)
+    try:
+        key = _file_key(filepath)
+    except OSError:
+        key = None
+
+    with _lock:
+        cached = _inventories.get(filepath)
+        if cached is None or cached[0] != key:
+            cached = (key, Inventory(load_hosts_file(filepath) if key is not None else {}))
+            _inventories[filepath] = cached
+
+    return cached[1]
@@ -0,0 +1,540 @@
+"""
+Management of the jobs that run in the hosts.
+"""
+import json
+import os
+from pathlib import PurePosixPath
+import re
+import shlex
+import subprocess
+import time
+
+from .host_management import DEFAULT_JOBS, get_hosts, run_for_hosts
+from .inventory import get_inventory
+from .mounting import get_host_from_path, get_local_path
+from .path import get_path
+from .subcommand import SubCommand
+from .connections import ssh_command, quote_remote_path
+from . import processes
+
+__all__ = ["submit", "get_jobs", "list_jobs", "jobdir"]
+
+DEFAULT_QUEUE_TTL = 30
+
+def _quote_pattern(pattern):
+    """Quotes a path for the shell of the host, but leaving its glob characters (*, ?, [...]) active"""
+    pattern = str(pattern)
+    prefix = ""
+    if pattern == "~" or pattern.startswith("~/"):
+        prefix, pattern = "~/", pattern[2:]
+
+    parts = re.split(r"([*?\[\]])", pattern)
+    return prefix + "".join(part if i % 2 else shlex.quote(part) for i, part in enumerate(parts) if part)
+
+def _resolve_patterns(paths, host=None):
+    """
+    Converts the paths given by the user to patterns in the hosts.
+
+    Returns
+    ---------
+    dict
+        The patterns (paths in the host, possibly with globs) for each host.
+    """
+    patterns = {}
+    for path in paths or ["."]:
+        if host is None:
+            path_host, remote_path = get_host_from_path(path)
+        else:
+            if host not in get_inventory():
+                raise ValueError(f"{host} is not a known host")
+            mount_target = (get_inventory().hosts.get(host) or {}).get("mount_target", "")
+            path_host, remote_path = host, PurePosixPath(mount_target) / path
+        patterns.setdefault(path_host, []).append(str(PurePosixPath(remote_path)))
+
+    return patterns
+
+# Script that the array jobs run: it picks its directory and system from the list of the submission
+_ARRAY_JOB = r"""
+index=${SLURM_ARRAY_TASK_ID:-${PBS_ARRAY_INDEX:-$PBS_ARRAYID}}
+IFS=$'\t' read -r dir SYSTEM < <(sed -n "$((index + 1))p" "${submit_dir}/systems")
+export SYSTEM PBS_O_WORKDIR="${dir}"
+cd "${dir}" || exit 1
+bash "${SIESTA_RUN_SCRIPT}"
+"""
+
+def _submit_script(clu_dir, patterns, name, args, limit=None, array=True):
+    """
+    Script that submits all the systems in a single session in the host.
+
+    It prints a line for each directory: "JOB <dir> <job id>", "SKIP <dir> <reason>" or "FAIL <dir> <message>".
+    """
+    args = " ".join(shlex.quote(arg) for arg in args)
+    # Slurm, PBS Pro and Torque all take the maximum number of simultaneous subjobs as a "%N" suffix
+    limit = f"%{int(limit)}" if limit else ""
+
+    return f"""
+export CLUSTER_UTILS_ROOT={quote_remote_path(clu_dir)}
+source "$CLUSTER_UTILS_ROOT/activate" > /dev/null 2>&1
+export SIESTA_RUN_SCRIPT=${{SIESTA_RUN_SCRIPT:-$(cluget runner siesta)}}
+export ENV_LOADER=${{SIESTA_ENV_LOADER:-$(cluget env_loader siesta)}}
+
+submit_dir="$CLUSTER_UTILS_ROOT/.submissions/$(date +%Y%m%d-%H%M%S)-$$"
+mkdir -p "$submit_dir" && : > "$submit_dir/systems" || exit 1
+
+# Find the system of each directory
+shopt -s nullglob
+dirs=()
+for dir in {' '.join(_quote_pattern(pattern) for pattern in patterns)}; do
+    [ -d "$dir" ] || continue
+    system=$(cd "$dir" && _siestasystem)
+    set -- $system
+    if [ $# -ne 1 ]; then
+        printf 'SKIP\\t%s\\t%s\\n' "$dir" "found ${{#}} main fdfs (${{system:-none}})"
+        continue
+    fi
+    printf '%s\\t%s\\n' "$(cd "$dir" && pwd)" "$system" >> "$submit_dir/systems"
+    dirs+=("$dir")
+done
+n=${{#dirs[@]}}
+[ $n -eq 0 ] && exit 0
+
+if command -v sbatch > /dev/null; then
+    scheduler=slurm
+elif command -v qsub > /dev/null; then
+    if qsub --version 2>&1 | grep -qi pbs_version; then scheduler=pbspro; else scheduler=torque; fi
+else
+    scheduler=none
+fi
+
+use_array={'yes' if array else 'no'}
+# PBS array jobs need at least two subjobs
+if [ $scheduler = none ] || {{ [ $scheduler != slurm ] && [ $n -lt 2 ]; }}; then use_array=no; fi
+
+if [ $use_array = yes ]; then
+    # The job script keeps the scheduler directives of the runner
+    {{
+        echo '#!/bin/bash'
+        grep -E '^#(SBATCH|PBS)' "$SIESTA_RUN_SCRIPT"
+        printf 'submit_dir=%q\\n' "$submit_dir"
+        cat << 'EOF'
+{_ARRAY_JOB}
+EOF
+    }} > "$submit_dir/job.sh"
+
+    case $scheduler in
+        slurm) out=$(sbatch --export=ALL --no-requeue -J {shlex.quote(name)} --array=0-$((n - 1)){limit} \\
+            -o "$submit_dir/%A_%a.out" {args} "$submit_dir/job.sh" 2>&1);;
+        pbspro) out=$(qsub -V -N {shlex.quote(name)} -J 0-$((n - 1)){limit} -o "$submit_dir" {args} "$submit_dir/job.sh" 2>&1);;
+        torque) out=$(qsub -V -N {shlex.quote(name)} -t 0-$((n - 1)){limit} -o "$submit_dir" {args} "$submit_dir/job.sh" 2>&1);;
+    esac
+    status=$?
+    out=${{out##*$'\\n'}}
+    for i in "${{!dirs[@]}}"; do
+        if [ $status -ne 0 ]; then
+            printf 'FAIL\\t%s\\t%s\\n' "${{dirs[$i]}}" "$out"
+        elif [ $scheduler = slurm ]; then
+            printf 'JOB\\t%s\\t%s\\n' "${{dirs[$i]}}" "${{out##* }}_$i"
+        else
+            # PBS prints something like 1234[].server
+            printf 'JOB\\t%s\\t%s\\n' "${{dirs[$i]}}" "${{out%%\\[\\]*}}[$i]${{out#*\\[\\]}}"
+        fi
+    done
+else
+    i=0
+    while IFS=$'\\t' read -r dir system; do
+        out=$(cd "$dir" && SYSTEM=$system JOB_NAME=$system jobsub {args} "$SIESTA_RUN_SCRIPT" 2>&1)
+        status=$?
+        out=${{out##*$'\\n'}}
+        if [ $status -eq 0 ]; then
+            printf 'JOB\\t%s\\t%s\\n' "${{dirs[$i]}}" "${{out##* }}"
+        else
+            printf 'FAIL\\t%s\\t%s\\n' "${{dirs[$i]}}" "$out"
+        fi
+        i=$((i + 1))
+    done < "$submit_dir/systems"
+fi
+"""
+
+def _submissions_file(host):
+    return get_path(".cache") / "jobs" / f"{host}.json"
+
+def get_submissions(host):
+    """
+    Gets the jobs submitted with `clu submit` to a host.
+
+    Returns
+    ---------
+    dict
+        Maps each job id to the directory (in the host) where it runs.
+    """
+    try:
+        return json.loads(_submissions_file(host).read_text())
+    except (OSError, ValueError):
+        return {}
+
+def _record_submissions(host, jobs):
+    submissions = {**get_submissions(host), **jobs}
+    submissions_file = _submissions_file(host)
+    submissions_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = submissions_file.with_name(f"{submissions_file.name}.{os.getpid()}")
+    tmp_file.write_text(json.dumps(submissions, indent=1))
+    os.replace(tmp_file, submissions_file)
+
+def submit(paths=None, host=None, args=None, name="siesta", limit=None, no_array=False):
+    """
+    Submits the SIESTA calculations of many directories at once.
+
+    All directories of a host are handled in a single session: the input fdf of each of them is found
+    (as siestasub does) and they are submitted as a single job array if the scheduler supports it
+    (Slurm and PBS). Otherwise, one job is submitted per directory with `jobsub`.
+
+    Parameters
+    -----------
+    paths: list of str, optional
+        The directories, which can contain glob patterns (e.g. 'sweep/*'). If no host is given, they are local
+        paths inside a mountpoint (the current directory by default). Otherwise, they are relative to the
+        mounted directory of the host.
+    host: str, optional
+        The name of the host, as understood by ssh (and cluster-utils).
+    args: str, optional
+        Extra arguments for sbatch/qsub.
+    name: str, optional
+        The name of the job array.
+    limit: int, optional
+        Maximum number of jobs of the array that run at the same time.
+    no_array: bool, optional
+        Submit one job per directory even if the scheduler supports job arrays.
+
+    Returns
+    ---------
+    dict
+        The job id of each directory, for each host.
+    """
+    submitted = {}
+    for submit_host, patterns in _resolve_patterns(paths, host=host).items():
+        clu_dir = (get_inventory().hosts.get(submit_host) or {}).get("clusterutils_dir", "~/.cluster-utils")
+
+        script = _submit_script(clu_dir, patterns, name=name, args=shlex.split(args or ""), limit=limit, array=not no_array)
+        completed = processes.run(ssh_command(submit_host, "bash -s"), input=script.encode(), stdout=subprocess.PIPE)
+
+        jobs = {}
+        for line in completed.stdout.decode(errors="replace").splitlines():
+            kind, _, rest = line.partition("\t")
+            remote_dir, _, info = rest.partition("\t")
+            if kind not in ("JOB", "SKIP", "FAIL"):
+                continue
+
+            shown_dir = get_local_path(submit_host, remote_dir) or f"{submit_host}:{remote_dir}"
+            if kind == "JOB":
+                jobs[remote_dir] = info
+                print(f"{info:<16} {shown_dir}")
+            else:
+                print(f"{kind:<16} {shown_dir} ({info})")
+
+        if jobs:
+            _record_submissions(submit_host, {job_id: remote_dir for remote_dir, job_id in jobs.items()})
+        elif completed.returncode != 0:
+            print(f"(cluster-utils) Submitting to {submit_host} failed.")
+
+        submitted[submit_host] = jobs
+
+    return submitted
+
+def _arguments_submit(subparser):
+    subparser.add_argument("paths", nargs="*", help="The directories, which can contain glob patterns (e.g. 'sweep/*',"\
+        " quote it so that your shell doesn't expand it). Local paths inside a mountpoint, or relative to the mounted"\
+        " directory if --host is given. Defaults to the current directory.")
+
+    subparser.add_argument("--host", help="The host where to submit, if you are not inside its mountpoint."
+        ).completer = lambda *args, **kwargs: get_hosts()
+
+    subparser.add_argument("-a", "--args", help="Extra arguments for sbatch/qsub, as a single string (e.g. --args='-p farm4').")
+
+    subparser.add_argument("-n", "--name", default="siesta", help="The name of the job array.")
+
+    subparser.add_argument("--limit", type=int, help="Maximum number of jobs of the array that run at the same time.")
+
+    subparser.add_argument("--no-array", action="store_true", help="Submit one job per directory, even if the"\
+        " scheduler supports job arrays.")
+
+SubCommand(submit, _arguments_submit)
+
+# Prints the queue of the user in a format that doesn't depend on the scheduler:
+# some KEY=VALUE lines, a "--" separator and then the raw output of squeue/qstat
+_QUEUE_QUERY = r"""
+echo "USER=$USER"
+echo "HOME=$HOME"
+if command -v squeue > /dev/null; then
+    echo "SCHEDULER=slurm"
+    echo "--"
+    squeue --noheader -u "$USER" --format=$'%i\t%j\t%T\t%M\t%R\t%Z'
+elif command -v qstat > /dev/null; then
+    echo "SCHEDULER=pbs"
+    echo "--"
+    qstat -f -t 2> /dev/null || qstat -f
+else
+    echo "SCHEDULER=none"
+    echo "--"
+fi
+"""
+
+_PBS_STATES = {
+    "Q": "PENDING", "R": "RUNNING", "H": "HELD", "E": "EXITING", "C": "COMPLETED", "F": "FINISHED",
+    "W": "WAITING", "T": "MOVING", "S": "SUSPENDED", "B": "RUNNING", "X": "FINISHED",
+}
+
+def _parse_slurm(output):
+    jobs = []
+    for line in output.splitlines():
+        fields = line.split("\t")
+        if len(fields) != 6:
+            continue
+        job_id, name, state, elapsed, reason, workdir = fields
+        jobs.append({"id": job_id, "name": name, "state": state, "time": elapsed, "where": reason, "workdir": workdir})
+    return jobs
+
+def _parse_pbs(output, user):
+    # qstat -f prints a block per job: "Job Id: ..." followed by "key = value" lines.
+    # Long values are wrapped in lines that start with a tab.
+    blocks = []
+    for line in output.splitlines():
+        if line.startswith("Job Id:"):
+            blocks.append({"id": line.partition(":")[2].strip()})
+        elif blocks and line.startswith("\t") and "last" in blocks[-1]:
+            key = blocks[-1]["last"]
+            blocks[-1][key] += line.strip()
+        elif blocks and " = " in line:
+            key, _, value = line.strip().partition(" = ")
+            blocks[-1][key] = value
+            blocks[-1]["last"] = key
+
+    jobs = []
+    for block in blocks:
+        # Skip the parents of job arrays, their subjobs are listed
+        if "[]" in block["id"] or block.get("Job_Owner", "").partition("@")[0] != user:
+            continue
+
+        variables = dict(var.partition("=")[::2] for var in block.get("Variable_List", "").split(","))
+        state = block.get("job_state", "")
+        jobs.append({
+            "id": block["id"], "name": block.get("Job_Name", ""), "state": _PBS_STATES.get(state, state),
+            "time": block.get("resources_used.walltime", "0:00"),
+            "where": block.get("exec_host", "").partition("/")[0],
+            "workdir": block.get("init_work_dir") or variables.get("PBS_O_WORKDIR", ""),
+        })
+    return jobs
+
+def _queue_file(host):
+    return get_path(".cache") / "jobs" / f"{host}.queue.json"
+
+def _read_queue(host):
+    try:
+        return json.loads(_queue_file(host).read_text())
+    except (OSError, ValueError):
+        return None
+
+def _query_queue(host):
+    """Gets the jobs of a host with a single ssh call and caches them"""
+    completed = processes.run(ssh_command(host, "bash -s"), input=_QUEUE_QUERY.encode(),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = completed.stdout.decode(errors="replace")
+    header, sep, body = output.partition("\n--\n")
+    if completed.returncode != 0 or not sep:
+        raise RuntimeError(completed.stderr.decode(errors="replace").strip() or "Could not query the jobs")
+
+    info = dict(line.partition("=")[::2] for line in header.splitlines() if "=" in line)
+    if info.get("SCHEDULER") == "slurm":
+        jobs = _parse_slurm(body)
+    elif info.get("SCHEDULER") == "pbs":
+        jobs = _parse_pbs(body, info.get("USER"))
+    else:
+        jobs = []
+
+    queue = {"time": time.time(), "home": info.get("HOME", ""), "scheduler": info.get("SCHEDULER"), "jobs": jobs}
+
+    queue_file = _queue_file(host)
+    queue_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = queue_file.with_name(f"{queue_file.name}.{os.getpid()}")
+    tmp_file.write_text(json.dumps(queue))
+    os.replace(tmp_file, queue_file)
+
+    return queue
+
+def _job_path(host, job, home, submissions):
+    """The local path where a job runs (inside the mountpoint of the host), if it is mounted."""
+    # Jobs of arrays submitted with `clu submit` run in a directory different from the submission one
+    remote_dir = PurePosixPath(submissions.get(job["id"]) or job["workdir"])
+
+    local_path = get_local_path(host, remote_dir)
+    if local_path is None and home and remote_dir.is_absolute():
+        try:
+            local_path = get_local_path(host, remote_dir.relative_to(home))
+        except ValueError:
+            pass
+    return local_path
+
+def get_ttl():
+    return float(os.environ.get("CLUSTER_UTILS_JOBS_TTL", DEFAULT_QUEUE_TTL))
+
+def get_jobs(hosts=None, ttl=None, timeout=None):
+    """
+    Gets the jobs of the user in multiple hosts.
+
+    Hosts are queried in parallel (DEFAULT_JOBS at a time), with one ssh call per host (squeue for Slurm, qstat
+    for PBS). The results are cached, and the cache is used if it is younger than `ttl`.
+
+    Parameters
+    -----------
+    hosts: list of str, optional
+        The hosts to query. Defaults to all hosts.
+    ttl: float, optional
+        Maximum age (in seconds) of the cached results that are used. Defaults to CLUSTER_UTILS_JOBS_TTL (or 30).
+    timeout: float, optional
+        Maximum time (in seconds) to wait for each host.
+
+    Returns
+    ---------
+    list of dict
+        The jobs, with their host, id, name, state, time, where (node or reason), workdir (in the host)
+        and path (local path, None if not mounted).
+    dict
+        The errors of the hosts that could not be queried, in which case the (stale) cached results are used if any.
+    """
+    hosts = list(get_hosts() if hosts is None else hosts)
+    ttl = get_ttl() if ttl is None else ttl
+
+    queues, errors, to_query = {}, {}, []
+    for host in hosts:
+        queue = _read_queue(host)
+        if queue is not None and time.time() - queue.get("time", 0) < ttl:
+            queues[host] = queue
+        else:
+            to_query.append(host)
+
+    if to_query:
+        for result in run_for_hosts(_query_queue, to_query, jobs=min(len(to_query), DEFAULT_JOBS), timeout=timeout):
+            if result.status == "ok":
+                queues[result.host] = result.value
+            else:
+                errors[result.host] = result.error or result.status
+                stale = _read_queue(result.host)
+                if stale is not None:
+                    queues[result.host] = stale
+
+    jobs = []
+    for host in hosts:
+        if host not in queues:
+            continue
+        queue = queues[host]
+        submissions = get_submissions(host)
+        for job in queue["jobs"]:
+            jobs.append({"host": host, **job, "path": _job_path(host, job, queue.get("home"), submissions)})
+
+    return jobs, errors
+
+def _select_hosts(host=None, group=None, tag=None, via=None):
+    hosts = list(host or [])
+    if group or tag or via:
+        hosts += [h for h in get_inventory().select(groups=group, tags=tag, jump_through=via) if h not in hosts]
+    elif not hosts:
+        hosts = list(get_hosts())
+    return hosts
+
+def list_jobs(host=None, group=None, tag=None, via=None, ttl=None, refresh=False, timeout=None):
+    """
+    Shows the jobs of all hosts in a single table.
+
+    Parameters
+    -----------
+    host: list of str, optional
+        The hosts to query. Defaults to all hosts.
+    group, tag, via: list of str, optional
+        Query also the hosts of these groups, with these tags or that jump through these hosts.
+    ttl: float, optional
+        Maximum age (in seconds) of the cached results that are used. Defaults to CLUSTER_UTILS_JOBS_TTL (or 30).
+    refresh: bool, optional
+        Ignore the cached results.
+    timeout: float, optional
+        Maximum time (in seconds) to wait for each host.
+    """
+    jobs, errors = get_jobs(_select_hosts(host, group, tag, via), ttl=0 if refresh else ttl, timeout=timeout)
+
+    rows = [("HOST", "JOBID", "NAME", "STATE", "TIME", "NODE/REASON", "PATH")]
+    for job in jobs:
+        path = job["path"] if job["path"] is not None else f"{job['host']}:{job['workdir']}"
+        rows.append((job["host"], job["id"], job["name"], job["state"], job["time"], job["where"], str(path)))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]) - 1)]
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)), row[-1], sep="  ")
+
+    for failed_host, error in errors.items():
+        print(f"(cluster-utils) Could not query {failed_host} ({error}), showing the last known jobs.")
+
+def _arguments_list_jobs(subparser):
+    subparser.add_argument("host", metavar="H", nargs="*", help="The hosts to query. Defaults to all hosts."
+        ).completer = lambda *args, **kwargs: get_hosts()
+
+    subparser.add_argument("--group", action="append", help="Also query the hosts of this group."
+        ).completer = lambda *args, **kwargs: get_inventory().values("groups")
+    subparser.add_argument("--tag", action="append", help="Also query the hosts with this tag."
+        ).completer = lambda *args, **kwargs: get_inventory().values("tags")
+    subparser.add_argument("--via", action="append", help="Also query the hosts that jump through this host."
+        ).completer = lambda *args, **kwargs: get_inventory().values("jump_through")
+
+    subparser.add_argument("--ttl", type=float, help="Results younger than this (in seconds) are reused instead of"\
+        f" querying the host again. Defaults to CLUSTER_UTILS_JOBS_TTL, or {DEFAULT_QUEUE_TTL} if it is not set.")
+    subparser.add_argument("-r", "--refresh", action="store_true", help="Query all hosts, ignoring cached results.")
+    subparser.add_argument("--timeout", type=float, default=20, help="Maximum time (in seconds) to wait for each host.")
+
+SubCommand(list_jobs, _arguments_list_jobs, name="jobs", served=True)
+
+def jobdir(job_id, host=None, ttl=None):
+    """
+    Prints the local path (inside the mountpoint of its host) where a job runs.
+
+    Parameters
+    -----------
+    job_id: str
+        The id of the job.
+    host: str, optional
+        The host where the job runs. If not given, all hosts are searched.
+    ttl: float, optional
+        Maximum age (in seconds) of the cached queues that are used. Defaults to CLUSTER_UTILS_JOBS_TTL (or 30).
+    """
+    hosts = [host] if host is not None else list(get_hosts())
+
+    def _matches(other):
+        return other == job_id or other.partition(".")[0] == job_id.partition(".")[0]
+
+    jobs, _ = get_jobs(hosts, ttl=ttl)
+    found = [job for job in jobs if _matches(job["id"])]
+
+    if not found:
+        # The job may have finished, but we may know it because it was submitted with `clu submit`
+        for search_host in hosts:
+            for other, remote_dir in get_submissions(search_host).items():
+                if _matches(other):
+                    found.append({"host": search_host, "id": other, "workdir": remote_dir,
+                        "path": _job_path(search_host, {"id": other, "workdir": remote_dir}, None, {})})
+
+    if not found:
+        raise ValueError(f"Job {job_id} was not found")
+    if len({job["host"] for job in found}) > 1:
+        raise ValueError(f"Job {job_id} exists in multiple hosts ({', '.join(job['host'] for job in found)}), use --host")
+
+    job = found[0]
+    if job["path"] is None:
+        raise ValueError(f"Job {job_id} runs in {job['host']}:{job['workdir']}, which is not inside the mounted directory")
+
+    print(job["path"])
+    return job["path"]
+
+def _arguments_jobdir(subparser):
+    subparser.add_argument("job_id", help="The id of the job.")
+    subparser.add_argument("--host", help="The host where the job runs, if the id is not unique."
+        ).completer = lambda *args, **kwargs: get_hosts()
+    subparser.add_argument("--ttl", type=float, help="Results younger than this (in seconds) are reused instead of"\
+        " querying the hosts again.")
+
+SubCommand(jobdir, _arguments_jobdir, served=True)
@@ -0,0 +1,295 @@
+"""
+Finding out which hosts are reachable, without paying a full connection timeout for each dead one.
+
+All hosts are probed at the same time. A host is probed with a plain TCP connection to the address
+and port that ssh would use (as resolved by `ssh -G`, so the ssh config is taken into account). Hosts
+that jump through another host are only probed if their jump host is reachable, and then through it
+(`ssh -W`, which reuses the master connection of the jump host if there is one). Hosts that already
+have a master connection are reachable without probing them.
+
+Results are cached (in CLUSTER_UTILS_ROOT/.cache/liveness.json) for CLUSTER_UTILS_LIVENESS_TTL seconds,
+so that consecutive commands don't probe again.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import subprocess
+import sys
+import time
+
+from .host_management import get_hosts, _jump_levels
+from .inventory import get_inventory
+from .path import get_path
+from .subcommand import SubCommand
+from . import processes
+
+__all__ = ["status", "probe"]
+
+# States of a host
+REACHABLE, UNREACHABLE, UNKNOWN = "reachable", "unreachable", "unknown"
+
+# Seconds that a host has to answer a probe
+DEFAULT_PROBE_TIMEOUT = 3
+# Seconds during which the result of a probe is reused
+DEFAULT_LIVENESS_TTL = 30
+# Maximum number of hosts that are probed at the same time
+_MAX_PROBES = 64
+
+def get_probe_timeout():
+    return float(os.environ.get("CLUSTER_UTILS_PROBE_TIMEOUT", DEFAULT_PROBE_TIMEOUT))
+
+def get_liveness_ttl():
+    return float(os.environ.get("CLUSTER_UTILS_LIVENESS_TTL", DEFAULT_LIVENESS_TTL))
+
+class Liveness:
+    """
+    The outcome of probing a host.
+
+    `state` is one of "reachable", "unreachable" or "unknown" (the probe couldn't tell, e.g. the host is
+    reached through a ProxyCommand). `checked` is the time of the probe (as given by `time.time`).
+    """
+
+    def __init__(self, host, state, detail="", elapsed=0., checked=None):
+        self.host = host
+        self.state = state
+        self.detail = detail
+        self.elapsed = elapsed
+        self.checked = time.time() if checked is None else checked
+
+    @property
+    def reachable(self):
+        """Whether it is worth trying to connect to the host (i.e. it is not known to be unreachable)"""
+        return self.state != UNREACHABLE
+
+    def to_dict(self):
+        return {"state": self.state, "detail": self.detail, "elapsed": self.elapsed, "checked": self.checked}
+
+    def __repr__(self):
+        return f"Liveness({self.host!r}, {self.state!r})"
+
+def _cache_file():
+    return get_path(".cache") / "liveness.json"
+
+def _read_cache():
+    try:
+        return json.loads(_cache_file().read_text())
+    except (OSError, ValueError):
+        return {}
+
+def _write_cache(results):
+    cache = _read_cache()
+    cache.update({host: liveness.to_dict() for host, liveness in results.items()})
+
+    cache_file = _cache_file()
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}")
+    tmp_file.write_text(json.dumps(cache))
+    os.replace(tmp_file, cache_file)
+
+def _ssh_settings(host):
+    """The settings that ssh would use to connect to the host (`ssh -G`), lowercase keys"""
+    completed = processes.run(["ssh", "-G", host], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        universal_newlines=True, timeout=get_probe_timeout())
+    settings = {}
+    for line in completed.stdout.splitlines():
+        key, _, value = line.partition(" ")
+        settings.setdefault(key.lower(), value)
+    return settings
+
+def _tcp_probe(address, port, timeout):
+    import socket
+
+    with socket.create_connection((address, port), timeout=timeout) as sock:
+        # Make sure that there's an ssh server on the other side, not just something accepting connections
+        sock.settimeout(timeout)
+        banner = sock.recv(256)
+    if not banner.startswith(b"SSH-"):
+        raise ConnectionError("no ssh server answered")
+
+def _jump_probe(proxy_jump, address, port, timeout):
+    """Checks that the (last) jump host can open a connection to the address"""
+    from .connections import multiplexing_options
+
+    # ProxyJump is a comma separated list of [user@]host[:port], the last one connects to the host.
+    *previous, jump = proxy_jump.split(",")
+    # ControlMaster=no uses the master of the jump host if there is one, but doesn't start one.
+    options = [*multiplexing_options(master="no"), "-o", "BatchMode=yes", "-o", f"ConnectTimeout={int(timeout) or 1}",
+        *(["-J", ",".join(previous)] if previous else []), "-W", f"{address}:{port}"]
+    process = processes.Popen(["ssh", *options, f"ssh://{jump}" if ":" in jump else jump], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    try:
+        # The connection stays open until we close it, so we only wait for the banner of the host
+        banner = _read_line(process.stdout, timeout)
+    finally:
+        process.kill()
+        _, errors = process.communicate()
+    if banner.startswith(b"SSH-"):
+        return
+
+    errors = errors.decode(errors="replace").strip().splitlines()
+    if any("Permission denied" in line or "Host key verification failed" in line for line in errors):
+        # We can't tell without logging into the jump host
+        raise PermissionError(f"could not log into {jump} to check")
+    reasons = [line for line in errors if "open failed" in line] or errors[-1:] or [f"no answer through {jump}"]
+    raise ConnectionError(reasons[0])
+
+def _read_line(stream, timeout):
+    """Reads the first line of a stream, giving up (and returning what was read) after `timeout` seconds"""
+    import selectors
+
+    data = b""
+    deadline = time.monotonic() + timeout
+    with selectors.DefaultSelector() as selector:
+        selector.register(stream, selectors.EVENT_READ)
+        while b"\n" not in data and selector.select(max(deadline - time.monotonic(), 0)):
+            chunk = os.read(stream.fileno(), 256)
+            if not chunk:
+                break
+            data += chunk
+    return data
+
+def _probe_host(host, jump, timeout):
+    """Probes a single host. `jump` is the Liveness of its jump host, if it has one."""
+    from .connections import master_alive
+
+    start = time.monotonic()
+
+    def done(state, detail=""):
+        return Liveness(host, state, detail, elapsed=time.monotonic() - start)
+
+    if jump is not None and jump.state == UNREACHABLE:
+        return done(UNREACHABLE, f"its jump host ({jump.host}) is unreachable")
+
+    try:
+        if master_alive(host):
+            return done(REACHABLE, "connected")
+
+        settings = _ssh_settings(host)
+        address, port = settings.get("hostname", host), settings.get("port", "22")
+        proxy_jump = settings.get("proxyjump", "none")
+
+        if settings.get("proxycommand", "none") != "none":
+            return done(UNKNOWN, "it is reached through a ProxyCommand")
+        if proxy_jump == "none":
+            _tcp_probe(address, int(port), timeout)
+        else:
+            _jump_probe(proxy_jump, address, port, timeout)
+    except PermissionError as e:
+        return done(UNKNOWN, str(e))
+    except (OSError, subprocess.TimeoutExpired, ValueError) as e:
+        return done(UNREACHABLE, str(e) or type(e).__name__)
+
+    return done(REACHABLE)
+
+def probe(hosts=None, timeout=None, refresh=False):
+    """
+    Finds out which hosts are reachable, probing all of them at the same time.
+
+    Parameters
+    -----------
+    hosts: list of str, optional
+        The hosts to probe. Defaults to all the known hosts.
+    timeout: float, optional
+        Seconds that each host has to answer. Defaults to CLUSTER_UTILS_PROBE_TIMEOUT (or 3).
+    refresh: bool, optional
+        Probe the hosts even if they were probed less than CLUSTER_UTILS_LIVENESS_TTL seconds ago.
+
+    Returns
+    ---------
+    dict
+        The Liveness of each host, in the same order as `hosts`.
+    """
+    configs = get_inventory().hosts
+    hosts = list(configs) if hosts is None else list(hosts)
+    timeout = get_probe_timeout() if timeout is None else timeout
+
+    results = {}
+    if not refresh:
+        ttl, now = get_liveness_ttl(), time.time()
+        for host, entry in _read_cache().items():
+            if host in hosts and now - entry.get("checked", 0) < ttl:
+                results[host] = Liveness(host, **entry)
+
+    def jump_of(host):
+        return (configs.get(host) or {}).get("jump_through") or None
+
+    # The jump hosts (that aren't cached) need to be probed first, so they are added to
+    # the hosts to probe. Then hosts are probed by levels, jump hosts before the hosts behind them.
+    pending = [host for host in hosts if host not in results]
+    for host in pending:
+        jump = jump_of(host)
+        if jump and jump not in results and jump not in pending:
+            pending.append(jump)
+
+    levels, cyclic = _jump_levels(pending, jump_of)
+
+    # Hosts whose jump hosts form a cycle can't be reached (ssh would refuse to connect).
+    probed = {host: Liveness(host, UNREACHABLE, "its jump_through hosts form a cycle") for host in cyclic}
+    results.update(probed)
+
+    with processes.phase("probe hosts"), ThreadPoolExecutor(max_workers=min(max(len(pending), 1), _MAX_PROBES)) as executor:
+        for level in levels:
+            futures = {host: executor.submit(_probe_host, host, results.get(jump_of(host)), timeout) for host in level}
+            for host, future in futures.items():
+                results[host] = probed[host] = future.result()
+
+    if probed:
+        _write_cache(probed)
+
+    return {host: results[host] for host in hosts}
+
+def reachable_hosts(hosts, timeout=None):
+    """
+    Filters out the hosts that are known to be unreachable.
+
+    Returns
+    ---------
+    list of str
+        The hosts (in the same order) that are reachable or whose state is unknown.
+    """
+    results = probe(hosts, timeout=timeout)
+    skipped = [host for host, liveness in results.items() if not liveness.reachable]
+    if skipped:
+        print(f"(cluster-utils) Skipping unreachable hosts: {' '.join(skipped)}", file=sys.stderr)
+
+    return [host for host, liveness in results.items() if liveness.reachable]
+
+def status(host=None, refresh=False, timeout=None):
+    """
+    Shows which hosts are reachable.
+
+    Parameters
+    -----------
+    host: list of str, optional
+        The hosts to check. Defaults to all the known hosts.
+    refresh: bool, optional
+        Probe all hosts again, even if they were checked recently.
+    timeout: float, optional
+        Seconds that each host has to answer. Defaults to CLUSTER_UTILS_PROBE_TIMEOUT (or 3).
+    """
+    results = probe(host or None, timeout=timeout, refresh=refresh)
+
+    now = time.time()
+    rows = [["HOST", "STATE", "CHECKED", "DETAIL"]]
+    for liveness in results.values():
+        detail = liveness.detail or (f"{liveness.elapsed * 1000:.0f}ms" if liveness.state == REACHABLE else "")
+        rows.append([liveness.host, liveness.state, f"{now - liveness.checked:.0f}s ago", detail])
+
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+    for row in rows:
+        print("  ".join([*(value.ljust(width) for value, width in zip(row, widths)), row[3]]).rstrip())
+
+    return results
+
+def _arguments_status(subparser):
+    subparser.add_argument("host", metavar="H", nargs="*", help="The name(s) of the host(s) to check. Defaults to"\
+        " all the known hosts.").completer = lambda *args, **kwargs: get_hosts()
+
+    subparser.add_argument("--refresh", action="store_true", help="Probe the hosts even if they were checked recently.")
+    subparser.add_argument("--timeout", type=float, help="Seconds that each host has to answer. Defaults to"\
+        f" CLUSTER_UTILS_PROBE_TIMEOUT (or {DEFAULT_PROBE_TIMEOUT}).")
+
+    subparser.epilog = "Results are reused for CLUSTER_UTILS_LIVENESS_TTL seconds (default:"\
+        f" {DEFAULT_LIVENESS_TTL}), also by the commands that accept --only-reachable."
+
+SubCommand(status, _arguments_status)
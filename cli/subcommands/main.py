@@ -0,0 +1,120 @@
+"""
+What `clu` does when it is called: finding out the subcommand, parsing its arguments and running it.
+
+It lives in the package (and not in the clu script) so that the daemon can do exactly the same
+for the commands that it serves.
+"""
+import os
+import sys
+
+from .registry import load_registry, get_subcommand
+
+__all__ = []
+
+def _requested_subcommand(argv, registry):
+    """
+    Finds out which subcommand is being requested, so that only that one needs to be fully built.
+
+    When argcomplete is asking for completions, the command line is read from the environment.
+    Returns None if no subcommand has been typed yet (e.g. completing the subcommand's name).
+    """
+    if "_ARGCOMPLETE" in os.environ:
+        import shlex
+
+        line = os.environ.get("COMP_LINE", "")[:int(os.environ.get("COMP_POINT", 0))]
+        try:
+            words = shlex.split(line)
+        except ValueError:
+            words = line.split()
+        # The last word is only complete if it's followed by a space
+        if not line.endswith(" "):
+            words = words[:-1]
+        argv = words[1:]
+
+    for arg in argv:
+        if not arg.startswith("-"):
+            return arg if arg in registry["commands"] else None
+    return None
+
+def build_parser(registry, requested=None):
+    """
+    Builds the parser of the CLI.
+
+    Only the requested subcommand is fully built. The rest are just registered with their
+    name and help message (so that they appear in the help and name completion), and only
+    if they are needed.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="clu")
+
+    parser.add_argument("--profile", action="store_true", help="Time everything that the subcommand does (per phase,"\
+        " command and host) and write a trace of it. Also enabled by the CLUSTER_UTILS_PROFILE environment variable.")
+
+    subparsers = parser.add_subparsers(dest="subcommand")
+
+    if requested is not None and "_ARGCOMPLETE" not in os.environ:
+        # The command is going to run, there's no need to know about the others.
+        get_subcommand(requested).register(subparsers)
+        return parser
+
+    for name, entry in registry["commands"].items():
+        if name == requested:
+            get_subcommand(name).register(subparsers)
+        else:
+            subparsers.add_parser(name, help=entry["help"])
+
+    return parser
+
+def clu(parsed_args, argv=()):
+
+    args = vars(parsed_args)
+
+    profile = args.pop("profile", False) or os.environ.get("CLUSTER_UTILS_PROFILE", "").lower() not in ("", "0", "no", "false")
+    subcommand = args.pop("subcommand")
+
+    if profile:
+        # Only imported when needed, so that it costs nothing otherwise
+        from .profiling import profile as profiling
+
+        with profiling(subcommand, argv):
+            returns = get_subcommand(subcommand)(**args)
+    else:
+        returns = get_subcommand(subcommand)(**args)
+
+    # Subcommands return False when they failed (e.g. some files could not be transferred)
+    if returns is False:
+        sys.exit(1)
+
+def main(argv, completion_output=None):
+    """
+    Runs clu with the given arguments.
+
+    Parameters
+    -----------
+    argv: list of str
+        The arguments, without the name of the program.
+    completion_output: file-like, optional
+        Where to write the completions, when argcomplete is asking for them. If not
+        provided, argcomplete writes them where the shell expects them and exits the process.
+    """
+    registry = load_registry()
+
+    parser = build_parser(registry, _requested_subcommand(argv, registry))
+
+    if "_ARGCOMPLETE" in os.environ:
+        try:
+            import argcomplete
+        except ModuleNotFoundError:
+            pass
+        else:
+            if completion_output is None:
+                argcomplete.autocomplete(parser)
+            else:
+                finder = argcomplete.CompletionFinder()
+                # By default, argcomplete takes file descriptor 9 for its debug output (and
+                # closes it afterwards), which in a long-lived process may be anything.
+                finder._init_debug_stream = lambda: None
+                finder(parser, output_stream=completion_output, exit_method=sys.exit)
+
+    clu(parser.parse_args(argv), argv)
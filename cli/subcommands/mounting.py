@@ -1,14 +1,30 @@
 import argparse
 import os, stat
 import getpass
+import json
 import platform
-from pathlib import Path
+from pathlib import Path, PurePosixPath
+import re
+import shutil
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 from .subcommand import SubCommand
 from .host_management import get_hosts, _multiple_hosts
+from .inventory import get_inventory, editing as hosts_editing
+from .path import get_path
+from .connections import ssh_command, sshfs_ssh_option
+from . import processes
 
-__all__ = ["lsmounts", "mount", "unmount", "fssh"]
+__all__ = ["lsmounts", "mount", "unmount", "fssh", "where"]
+
+# Hosts are mounted/removed concurrently, but the permissions of the mounts
+# directory are toggled around each change, so only one can touch it at a time.
+_mounts_dir_lock = threading.Lock()
 
 def get_mounts_dir():
     if "CLUSTER_UTILS_MOUNTS" not in os.environ:
@@ -18,7 +34,7 @@ def get_mounts_dir():
 
 def get_mount_adress(host, mount_target=False, host_config=None):
     if host_config is None:
-        host_config = get_hosts().get(host, {})
+        host_config = get_inventory().hosts.get(host) or {}
 
     adress = f"{host_config.get('user', getpass.getuser())}@{host_config.get('mount_hostname', host)}"
 
@@ -49,22 +65,175 @@ def _write_permissions(path, grant):
 
     os.chmod(path, new_mode)
 
+# Options passed to sshfs (with -o) for each value of the "mount_profile" host key.
+# Profiles with ssh options (see _SSH_OPTIONS) mount through their own connection, since
+# through the shared master connection the options of the master would be used instead.
+MOUNT_PROFILES = {
+    "default": [
+        "ServerAliveInterval=5", "ServerAliveCountMax=2", "ConnectTimeout=3", "ConnectionAttempts=1",
+    ],
+    "lan": [
+        "ServerAliveInterval=5", "ServerAliveCountMax=2", "ConnectTimeout=3", "ConnectionAttempts=1",
+        "Ciphers=aes128-gcm@openssh.com", "Compression=no", "kernel_cache", "max_read=131072",
+    ],
+    "wan": [
+        "ServerAliveInterval=10", "ServerAliveCountMax=3", "ConnectTimeout=10", "ConnectionAttempts=1",
+        "Ciphers=aes128-gcm@openssh.com", "Compression=yes", "kernel_cache", "dcache_timeout=60", "reconnect",
+    ],
+    "bastion": [
+        "ServerAliveInterval=15", "ServerAliveCountMax=4", "ConnectTimeout=20", "ConnectionAttempts=2",
+        "Compression=yes", "kernel_cache", "dcache_timeout=300", "reconnect",
+    ],
+}
+
+# The options of the profiles that are understood by ssh, not by sshfs
+_SSH_OPTIONS = {"ServerAliveInterval", "ServerAliveCountMax", "ConnectTimeout", "ConnectionAttempts", "Ciphers", "Compression"}
+
+def get_mount_options(host, host_config=None, profile=None):
+    """
+    The sshfs options to mount a host with a mount profile (the one of the host by default).
+
+    They include the ssh command to use, which only goes through the shared master connection
+    if the profile doesn't set ssh options.
+    """
+    if profile is None:
+        if host_config is None:
+            host_config = get_inventory().hosts.get(host) or {}
+        profile = host_config.get("mount_profile") or "default"
+
+    if profile not in MOUNT_PROFILES:
+        raise ValueError(f"Unknown mount profile '{profile}' for {host}. Available profiles: {', '.join(MOUNT_PROFILES)}")
+
+    options = MOUNT_PROFILES[profile]
+    shared = not any(option.partition("=")[0] in _SSH_OPTIONS for option in options)
+    return ["-o", ",".join(options), *sshfs_ssh_option(shared=shared)]
+
+# States of a mountpoint
+HEALTHY, STALE, UNMOUNTED = "healthy", "stale", "unmounted"
+
+# Seconds that a mountpoint has to answer before we consider it stale
+DEFAULT_MOUNT_TIMEOUT = 3
+# Seconds between the checks of the mounts supervisor (clu mount --watch)
+DEFAULT_WATCH_INTERVAL = 10
+# Limits of the time that the supervisor waits before trying to remount again
+_MIN_BACKOFF, _MAX_BACKOFF = 5, 300
+
+def get_mount_timeout():
+    return float(os.environ.get("CLUSTER_UTILS_MOUNT_TIMEOUT", DEFAULT_MOUNT_TIMEOUT))
+
+def _unescape_mountinfo(field):
+    # Spaces, tabs and backslashes in paths are written as octal escapes (e.g. \040)
+    return re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), field)
+
+def read_mount_table():
+    """
+    Reads the table of mounted filesystems.
+
+    The mountpoints themselves are never touched, so this can't hang on a dead connection.
+
+    Returns
+    ---------
+    dict
+        Maps each mountpoint to the type of its filesystem.
+    """
+    try:
+        with open("/proc/self/mountinfo") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        # There is no /proc (e.g. in macOS), ask the mount command instead.
+        output = processes.run(["mount"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode()
+        return {match.group(1): match.group(2) for match in re.finditer(r" on (.+) \(([^,)]+)", output)}
+
+    table = {}
+    for line in lines:
+        fields = line.split(" ")
+        try:
+            table[_unescape_mountinfo(fields[4])] = fields[fields.index("-", 6) + 1]
+        except (IndexError, ValueError):
+            continue
+
+    return table
+
 def get_mounted():
     """Gets all the currently mounted hosts"""
+    mounts_dir = os.path.realpath(get_mounts_dir())
+
+    return [os.path.basename(point) for point in read_mount_table() if os.path.dirname(point) == mounts_dir]
+
+def _probe(path, timeout):
+    """
+    Checks whether a mountpoint answers.
+
+    The check runs in a separate process, so that we can give up on it if it hangs.
+    """
+    process = processes.Popen(["stat", str(path)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        return process.wait(timeout) == 0
+    except subprocess.TimeoutExpired:
+        # If it is stuck in the kernel, it will die whenever the kernel lets it.
+        process.kill()
+        return False
+
+def get_mount_status(hosts=None, timeout=None):
+    """
+    Checks the state of the mountpoints, without ever blocking on a dead mount.
+
+    Parameters
+    -----------
+    hosts: list of str, optional
+        The hosts to check. If not provided, all directories in the mounts directory
+        and all mounted hosts are checked.
+    timeout: float, optional
+        Seconds that each mountpoint has to answer. Defaults to CLUSTER_UTILS_MOUNT_TIMEOUT (or 3).
+
+    Returns
+    ---------
+    dict
+        Maps each host to its state: "healthy", "stale" (mounted, but not answering) or "unmounted".
+    """
     mounts_dir = get_mounts_dir()
-    mounts = []
+    mounted = get_mounted()
 
-    if mounts_dir.is_dir():
-        mounts = [d.name for d in mounts_dir.glob("*") if os.path.ismount(d)]
-    
-    return mounts
+    if hosts is None:
+        # Listing the mounts directory doesn't touch the mountpoints inside it.
+        try:
+            hosts = sorted({entry.name for entry in os.scandir(mounts_dir)}.union(mounted))
+        except OSError:
+            hosts = mounted
+
+    timeout = get_mount_timeout() if timeout is None else timeout
+
+    status = {host: UNMOUNTED for host in hosts}
+    to_probe = [host for host in hosts if host in mounted]
+    if to_probe:
+        from concurrent.futures import ThreadPoolExecutor
 
-def lsmounts():
+        with ThreadPoolExecutor(max_workers=len(to_probe)) as executor:
+            answers = executor.map(lambda host: _probe(mounts_dir / host, timeout), to_probe)
+            for host, healthy in zip(to_probe, answers):
+                status[host] = HEALTHY if healthy else STALE
+
+    return status
+
+def lsmounts(status=False):
     """Lists the currently mounted hosts"""
-    print(" ".join(get_mounted()))
+    from .session import default_session
+
+    session = default_session()
+    if not status:
+        print(" ".join(session.mounted()))
+        return
+
+    for mount in session.mounts():
+        print(f"{mount.host:<20} {mount.state}{' (watched)' if mount.watched else ''}")
+
+def _arguments_lsmounts(subparser):
+    subparser.add_argument("--status", action="store_true", help="Check whether each mount answers and show"\
+        " its state: healthy, stale (the connection died) or unmounted. Mounts that take more than"\
+        f" CLUSTER_UTILS_MOUNT_TIMEOUT seconds (default: {DEFAULT_MOUNT_TIMEOUT}) to answer are considered stale.")
 
 @_multiple_hosts()
-def mount(host, args):
+def mount(host, args, watch=False):
     """
     Mounts hosts into the mounts directory.
 
@@ -75,9 +244,33 @@ def mount(host, args):
         If it's a list, it will mount all hosts.
     all: bool, optional
         If `True`, all known hosts are mounted (hosts is ignored).
+    watch: bool, optional
+        If `True`, a supervisor running in the background will remount the host
+        whenever the mount goes stale.
     """
     mounts_dir = get_mounts_dir()
 
+    state = get_mount_status([host])[host]
+    if state == HEALTHY:
+        print(f"{host} is already mounted")
+    else:
+        if state == STALE:
+            _lazy_unmount(host)
+
+        with _mounts_dir_lock:
+            _make_mount_point(mounts_dir, host)
+
+        processes.run(
+            ["sshfs",
+             *get_mount_options(host),
+             *args,
+             get_mount_adress(host, mount_target=True), str(mounts_dir / host)]
+        )
+
+    if watch:
+        watch_mount(host, args)
+
+def _make_mount_point(mounts_dir, host):
     # Make sure the mounts directory exists
     if not mounts_dir.exists():
         os.makedirs(mounts_dir)
@@ -104,25 +297,33 @@ def mount(host, args):
     # created the directory but this is the first time cluster-utils uses it.
     _write_permissions(mounts_dir, False)
 
-    subprocess.run(
-        ["sshfs",
-         "-o", "ServerAliveInterval=5,ServerAliveCountMax=2,ConnectTimeout=3,ConnectionAttempts=1",
-         *args,
-         get_mount_adress(host, mount_target=True), str(host_mnt)]
-    )
-
 def _arguments_mount(subparser):
     mount.argument_gen(subparser)
+
+    subparser.add_argument("--watch", action="store_true", help="Keep the mount alive: a supervisor running in the"\
+        " background checks it periodically and, if the connection dies, unmounts it and mounts it again. Note that"\
+        " this flag must go before the names of the hosts.")
     
     subparser.add_argument("args", nargs=argparse.REMAINDER, 
         help="Additional args (options) that go into the sshfs command").completer = lambda *args, **kwargs: ""
 
+def _unmount_command(mount_point, force=False):
+    if platform.system() == "Darwin":
+        return ["umount", *(["-f"] if force else []), str(mount_point)]
+    # -z makes it lazy: the mount is detached immediately, even if the connection is dead.
+    return ["fusermount", "-zu", str(mount_point)]
+
+def _lazy_unmount(host):
+    """Detaches a (possibly stale) mount without waiting for it to answer"""
+    return processes.run(_unmount_command(get_mounts_dir() / host, force=True),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
 @_multiple_hosts(all_getter=get_mounted)
 def unmount(host):
     """
     Unmounts previously mounted directories.
 
-    If a host is not mounted, it will do nothing.
+    If a host is not mounted, it will do nothing. The host stops being watched (see `mount --watch`).
 
     Parameters
     -------------
@@ -134,13 +335,10 @@ def unmount(host):
     """
     mounted_in = get_mounts_dir() / host
 
+    unwatch_mount(host)
+
     try:
-        OS = platform.system()
-        if OS == "Darwin":
-            commands = ["umount", str(mounted_in)]
-        else:
-            commands = ["fusermount", "-zu", str(mounted_in)]
-        subprocess.run(commands).check_returncode()
+        processes.run(_unmount_command(mounted_in)).check_returncode()
     except subprocess.CalledProcessError:
         pass
     else:
@@ -150,17 +348,328 @@ def remove_mount_point(host):
 
     if host in get_mounted():
         unmount(host)
+        if host in get_mounted():
+            print(f"(cluster-utils) {host} could not be unmounted, its mount point is kept.")
+            return
     
     mounts_dir = get_mounts_dir()
     mount_point = mounts_dir / host
 
-    if mount_point.is_dir():
-        _write_permissions(mounts_dir, True)
+    with _mounts_dir_lock:
+        if mount_point.is_dir():
+            _write_permissions(mounts_dir, True)
+
+            os.rmdir(mount_point)
 
-        os.rmdir(mount_point)
+        if len(list(mounts_dir.glob("*"))) > 0:
+            _write_permissions(mounts_dir, False)
 
-    if len(list(mounts_dir.glob("*"))) > 0:
-        _write_permissions(mounts_dir, False)
+_watch_lock = threading.Lock()
+
+def _watch_dir():
+    watch_dir = get_path(".cache") / "mounts"
+    watch_dir.mkdir(parents=True, exist_ok=True)
+    return watch_dir
+
+def _read_watched():
+    """The hosts that the supervisor keeps mounted, with the sshfs args they were mounted with"""
+    try:
+        return json.loads((_watch_dir() / "watched.json").read_text())
+    except (OSError, ValueError):
+        return {}
+
+def _write_watched(watched):
+    watched_file = _watch_dir() / "watched.json"
+    tmp_file = watched_file.with_name(f"{watched_file.name}.{os.getpid()}")
+    tmp_file.write_text(json.dumps(watched))
+    os.replace(tmp_file, watched_file)
+
+def _supervisor_pid():
+    """The pid of the running supervisor, if there is one"""
+    try:
+        pid = int((_watch_dir() / "watch.pid").read_text())
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass
+    except (OSError, ValueError):
+        return None
+
+    return pid
+
+def watch_mount(host, args=()):
+    """Adds a host to the mounts supervisor, starting it if it is not running"""
+    with _watch_lock:
+        watched = _read_watched()
+        watched[host] = {"args": list(args)}
+        _write_watched(watched)
+
+        if _supervisor_pid() is None:
+            watch_dir = _watch_dir()
+            with open(watch_dir / "watch.log", "ab") as log:
+                process = processes.Popen([sys.executable, str(get_path("cli") / "clu"), "watchmounts"],
+                    stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+            (watch_dir / "watch.pid").write_text(str(process.pid))
+
+def unwatch_mount(host):
+    """Removes a host from the mounts supervisor (which stops when there is nothing to watch)"""
+    with _watch_lock:
+        watched = _read_watched()
+        if watched.pop(host, None) is not None:
+            _write_watched(watched)
+
+def watch_mounts(stop=False, interval=None):
+    """
+    Supervisor that keeps the watched mounts alive.
+
+    It is started in the background by `clu mount --watch`. Stale mounts are unmounted lazily
+    and mounted again, waiting longer after each failed attempt. The supervisor exits when
+    there are no hosts left to watch.
+
+    Parameters
+    -----------
+    stop: bool, optional
+        Stop the running supervisor instead.
+    interval: float, optional
+        Seconds between checks. Defaults to CLUSTER_UTILS_MOUNT_WATCH_INTERVAL (or 10).
+    """
+    if stop:
+        pid = _supervisor_pid()
+        if pid is not None:
+            os.kill(pid, signal.SIGTERM)
+            print("Stopped the mounts supervisor")
+        return
+
+    if interval is None:
+        interval = float(os.environ.get("CLUSTER_UTILS_MOUNT_WATCH_INTERVAL", DEFAULT_WATCH_INTERVAL))
+
+    pid_file = _watch_dir() / "watch.pid"
+    pid_file.write_text(str(os.getpid()))
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    def log(message):
+        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {message}", flush=True)
+
+    # For each host that failed to remount: (time of the next attempt, delay after that)
+    backoff = {}
+    try:
+        while True:
+            watched = _read_watched()
+            if not watched:
+                break
+
+            status = get_mount_status(list(watched))
+            for host, host_watch in watched.items():
+                if status[host] == HEALTHY:
+                    backoff.pop(host, None)
+                    continue
+
+                next_attempt, delay = backoff.get(host, (0, _MIN_BACKOFF))
+                if time.monotonic() < next_attempt:
+                    continue
+
+                log(f"{host} is {status[host]}, mounting it again")
+                mount(host, args=host_watch["args"])
+
+                if get_mount_status([host])[host] == HEALTHY:
+                    log(f"{host} is mounted again")
+                    backoff.pop(host, None)
+                else:
+                    log(f"Could not mount {host}, trying again in {delay}s")
+                    backoff[host] = (time.monotonic() + delay, min(delay * 2, _MAX_BACKOFF))
+
+            time.sleep(interval)
+    finally:
+        if pid_file.exists() and pid_file.read_text() == str(os.getpid()):
+            pid_file.unlink()
+
+def _arguments_watch_mounts(subparser):
+    subparser.add_argument("--stop", action="store_true", help="Stop the supervisor that is running in the background.")
+
+    subparser.add_argument("--interval", type=float, help="Seconds between checks. Defaults to"\
+        f" CLUSTER_UTILS_MOUNT_WATCH_INTERVAL, or {DEFAULT_WATCH_INTERVAL} if it is not set.")
+
+# Metrics measured by mountbench: (label, whether higher values are better)
+_BENCH_METRICS = {
+    "metadata": ("stat+readdir ms", False),
+    "small_write": ("small write files/s", True),
+    "small_read": ("small read files/s", True),
+    "large_write": ("large write MB/s", True),
+    "large_read": ("large read MB/s", True),
+}
+
+def _timed(function, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return max((time.perf_counter() - start) / repeat, 1e-9)
+
+def _bench_mount(host, profile, mount_point, args):
+    # Mounted exactly as `mount` would do it with this profile
+    completed = processes.run(["sshfs", *get_mount_options(host, profile=profile), *args,
+        get_mount_adress(host, mount_target=True), str(mount_point)])
+    return completed.returncode == 0 and os.path.realpath(mount_point) in read_mount_table()
+
+def _bench_unmount(mount_point):
+    processes.run(_unmount_command(mount_point, force=True), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def _bench_profile(host, profile, args, n_files, size):
+    """
+    Mounts a host with a given profile and measures the performance of the mount.
+
+    Returns
+    ---------
+    dict or None
+        The value of each of the _BENCH_METRICS. None if the host could not be mounted.
+    """
+    mount_point = Path(tempfile.mkdtemp(prefix="clu-mountbench-"))
+    bench_dir = mount_point / f".clu-mountbench-{os.getpid()}"
+    small_file, chunk = os.urandom(4096), os.urandom(1 << 20)
+
+    def write_small():
+        for i in range(n_files):
+            (bench_dir / f"small_{i}").write_bytes(small_file)
+
+    def write_large():
+        with open(bench_dir / "large", "wb") as f:
+            for _ in range(size):
+                f.write(chunk)
+
+    def metadata():
+        for entry in os.scandir(bench_dir):
+            entry.stat()
+
+    def read_small():
+        for i in range(n_files):
+            (bench_dir / f"small_{i}").read_bytes()
+
+    def read_large():
+        with open(bench_dir / "large", "rb") as f:
+            while f.read(1 << 20):
+                pass
+
+    results = {}
+    try:
+        if not _bench_mount(host, profile, mount_point, args):
+            return None
+
+        bench_dir.mkdir()
+        results["small_write"] = n_files / _timed(write_small)
+        results["large_write"] = size / _timed(write_large)
+
+        # Mount again, so that reads don't come from the local cache
+        _bench_unmount(mount_point)
+        if not _bench_mount(host, profile, mount_point, args):
+            return None
+
+        results["metadata"] = _timed(metadata, repeat=3) / (n_files + 1) * 1000
+        results["small_read"] = n_files / _timed(read_small)
+        results["large_read"] = size / _timed(read_large)
+
+        return results
+    finally:
+        if os.path.realpath(mount_point) in read_mount_table():
+            shutil.rmtree(bench_dir, ignore_errors=True)
+            _bench_unmount(mount_point)
+        try:
+            os.rmdir(mount_point)
+        except OSError:
+            pass
+
+def _score_profiles(results):
+    """Geometric mean of how close each profile is to the best one in each metric (1 is the best)"""
+    best = {
+        metric: (max if higher_is_better else min)(values[metric] for values in results.values())
+        for metric, (_, higher_is_better) in _BENCH_METRICS.items()
+    }
+
+    scores = {}
+    for profile, values in results.items():
+        score = 1
+        for metric, (_, higher_is_better) in _BENCH_METRICS.items():
+            ratio = values[metric] / best[metric] if higher_is_better else best[metric] / values[metric]
+            score *= ratio
+        scores[profile] = score ** (1 / len(_BENCH_METRICS))
+
+    return scores
+
+def mountbench(host, args, profiles=None, files=100, size=16, apply=False):
+    """
+    Measures the performance of mounting a host with each of the mount profiles.
+
+    Each profile is mounted in a temporary directory, where we measure the latency of
+    metadata operations (stat and readdir) and the throughput of reading and writing
+    small and large files. Then, the best profile is suggested.
+
+    Parameters
+    -----------
+    host: str
+        The name of the host, as understood by ssh (and cluster-utils).
+    args: list of str
+        Additional arguments for sshfs.
+    profiles: list of str, optional
+        The profiles to test. All of them by default.
+    files: int, optional
+        Number of small (4 KiB) files to write and read.
+    size: int, optional
+        Size of the large file, in MiB.
+    apply: bool, optional
+        Set the best profile as the mount profile of the host.
+    """
+    if host not in get_inventory():
+        raise ValueError(f"{host} is not a known host")
+
+    results = {}
+    for profile in profiles or MOUNT_PROFILES:
+        print(f"(cluster-utils) Benchmarking the '{profile}' profile...", flush=True)
+        profile_results = _bench_profile(host, profile, args, files, size)
+        if profile_results is None:
+            print(f"(cluster-utils) Could not mount {host} with the '{profile}' profile.")
+        else:
+            results[profile] = profile_results
+
+    if not results:
+        return None
+
+    scores = _score_profiles(results)
+
+    print()
+    print(f"{'profile':<10}" + "".join(f"{label:>22}" for label, _ in _BENCH_METRICS.values()) + f"{'score':>8}")
+    for profile, values in results.items():
+        print(f"{profile:<10}" + "".join(f"{values[metric]:>22.3f}" for metric in _BENCH_METRICS) + f"{scores[profile]:>8.2f}")
+
+    best = max(scores, key=scores.get)
+    current = (get_inventory().hosts.get(host) or {}).get("mount_profile") or "default"
+    print(f"\nSuggested profile: {best} (current: {current})")
+
+    if apply and best != current:
+        with hosts_editing() as hosts:
+            hosts[host] = {**(hosts[host] or {}), "mount_profile": best}
+        print(f"{host} will be mounted with the '{best}' profile from now on.")
+    elif best != current:
+        print(f"To use it, run: clu updatehostconfig {host} --mount_profile {best}")
+
+    return best
+
+def _arguments_mountbench(subparser):
+    subparser.add_argument("host", help="The name of the host, as understood by ssh (and cluster-utils)"
+        ).completer = lambda *args, **kwargs: get_hosts()
+
+    subparser.add_argument("--profile", dest="profiles", action="append", choices=list(MOUNT_PROFILES),
+        help="A profile to test (can be repeated). All of them are tested by default.")
+
+    subparser.add_argument("--files", type=int, default=100, help="Number of small (4 KiB) files to write and read.")
+
+    subparser.add_argument("--size", type=int, default=16, help="Size of the large file to write and read, in MiB.")
+
+    subparser.add_argument("--apply", action="store_true", help="Store the best profile in the configuration of the host.")
+
+    subparser.add_argument("args", nargs=argparse.REMAINDER,
+        help="Additional args (options) that go into the sshfs command").completer = lambda *args, **kwargs: ""
+
+    subparser.epilog = "Options must go before the name of the host, everything after it is passed to sshfs."\
+        " Example: 'clu mountbench --size 64 myhost -p 2222'"
 
 def get_host_from_path(path=""):
     """
@@ -181,8 +690,12 @@ def get_host_from_path(path=""):
         Remote path that corresponds to the given local path.
     """
 
-    current_path = Path(path).resolve()
+    # Resolving symlinks needs to look at each directory, which hangs if the mount is stale.
+    # So we only do it if the path is not inside the mounts directory already.
+    current_path = Path(os.path.abspath(path))
     mounts_dir = get_mounts_dir()
+    if mounts_dir not in current_path.parents:
+        current_path = current_path.resolve()
 
     if mounts_dir not in current_path.parents:
         raise ValueError(f"Your current path ({current_path}) is not inside the mounts directory")
@@ -190,7 +703,7 @@ def get_host_from_path(path=""):
     from_mounts = current_path.relative_to(mounts_dir)
     host = str(list(from_mounts.parents)[-2])
 
-    hosts = get_hosts()
+    hosts = get_inventory().hosts
 
     host_dir = mounts_dir / host
     remote_root = Path(hosts[host].get("mount_target", ""))
@@ -199,6 +712,49 @@ def get_host_from_path(path=""):
 
     return host, remote_dir
 
+def get_local_path(host, remote_path):
+    """
+    The inverse of `get_host_from_path`: given a path in a host, returns the equivalent local path.
+
+    Parameters
+    ------------
+    host: str
+        The name of the host.
+    remote_path: str or PurePosixPath
+        The path in the host, either absolute or relative to the home directory.
+
+    Returns
+    -----------
+    Path or None:
+        The path inside the mountpoint of the host. None if the remote path is not in the mounted directory.
+    """
+    mount_target = PurePosixPath((get_inventory().hosts.get(host) or {}).get("mount_target", "") or ".")
+    try:
+        relative = PurePosixPath(remote_path).relative_to(mount_target)
+    except ValueError:
+        return None
+
+    return get_mounts_dir() / host / relative
+
+def where(path=None):
+    """
+    Prints the host and the remote path that a path inside the mounts corresponds to.
+
+    Parameters
+    ------------
+    path: str, optional
+        The local path. Defaults to the current directory.
+    """
+    try:
+        host, remote_path = get_host_from_path(path or "")
+    except ValueError as e:
+        sys.exit(f"(cluster-utils) {e}")
+
+    print(f"{host}:{remote_path}")
+
+def _arguments_where(subparser):
+    subparser.add_argument("path", nargs="?", help="A path inside the mounts. Defaults to the current directory.")
+
 def fssh(command=None):
     """
     If inside a mountpoint, ssh into the equivalent remote directory.
@@ -206,9 +762,9 @@ def fssh(command=None):
     host, remote_dir = get_host_from_path()
 
     if command is None or command == []:
-        subprocess.run(["ssh", host, "-t", f'bash --init-file <(echo \". \$HOME/.bash_profile; cd {remote_dir}\")'])
+        processes.run(ssh_command(host, f'bash --init-file <(echo \". \$HOME/.bash_profile; cd {remote_dir}\")', tty=True))
     else:
-        subprocess.run(["ssh", host, f'cd {remote_dir}; {" ".join(command)}'])
+        processes.run(ssh_command(host, f'cd {remote_dir}; {" ".join(command)}'))
 
 def _arguments_fssh(subparser):
     subparser.add_argument("command", nargs=argparse.REMAINDER, help="Command that you want to execute on this folder on the host."
@@ -217,7 +773,10 @@ def _arguments_fssh(subparser):
     subparser.epilog = "Example: 'clu fssh mycommand --arg1 value --arg2' will run 'mycommand --arg1 value --arg2'"\
         " in the equivalent REMOTE folder."
 
-SubCommand(lsmounts)
+SubCommand(lsmounts, _arguments_lsmounts, served=True)
 SubCommand(mount, _arguments_mount)
 SubCommand(unmount, unmount.argument_gen)
+SubCommand(watch_mounts, _arguments_watch_mounts, name="watchmounts")
+SubCommand(mountbench, _arguments_mountbench)
 SubCommand(fssh, _arguments_fssh)
+SubCommand(where, _arguments_where, served=True)
@@ -15,4 +15,4 @@ def path(path):
 def _arguments_path(subparser):
     subparser.add_argument("path", nargs="?")
 
-SubCommand(path, _arguments_path)
\ No newline at end of file
+SubCommand(path, _arguments_path, served=True)
\ No newline at end of file
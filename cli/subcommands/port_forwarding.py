@@ -1,18 +1,321 @@
+"""
+Port forwarding to the hosts.
+
+Tunnels are added to a master connection of the host (`ssh -O forward`) that is kept alive until they are
+closed, so they run in the background and all the tunnels of a host share the same handshake. They are recorded in CLUSTER_UTILS_ROOT/.cache/tunnels.json, which lets
+`clu tunnels` list and close them and lets us reuse a tunnel when the same service is asked for again.
+"""
+import json
+import os
+import re
+import signal
+import socket
 import subprocess
+import time
 
 from .mounting import get_host_from_path
 from .host_management import get_hosts
+from .path import get_path
 from .subcommand import SubCommand
+from .connections import ssh_command, quote_remote_path, multiplexing_enabled, multiplexing_options, master_alive, \
+    open_master, get_tunnels_control_path
+from . import processes
+
+__all__ = ["remotejupyternb", "open_tunnel", "close_tunnel", "get_tunnels", "tunnel", "tunnels"]
+
+def _tunnels_file():
+    return get_path(".cache") / "tunnels.json"
+
+def get_tunnels():
+    """
+    Gets the tunnels that have been opened by cluster-utils.
+
+    Returns
+    ---------
+    list of dict
+        Each tunnel has an "id", the "host", the "service" it gives access to, the "local_port" and the
+        "remote_host" and "remote_port" that it forwards to.
+    """
+    try:
+        return json.loads(_tunnels_file().read_text())
+    except (OSError, ValueError):
+        return []
+
+def _save_tunnels(tunnels):
+    tunnels_file = _tunnels_file()
+    tunnels_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = tunnels_file.with_name(f"{tunnels_file.name}.{os.getpid()}")
+    tmp_file.write_text(json.dumps(tunnels, indent=1))
+    os.replace(tmp_file, tunnels_file)
+
+def _free_local_port(preferred=None):
+    """Returns the preferred port if it is free, otherwise any free port"""
+    for port in (preferred, 0):
+        if port is None:
+            continue
+        with socket.socket() as sock:
+            try:
+                sock.bind(("127.0.0.1", port))
+            except OSError:
+                continue
+            return sock.getsockname()[1]
 
-__all__ = ["remotejupyternb"]
+def _port_open(port):
+    with socket.socket() as sock:
+        sock.settimeout(1)
+        return sock.connect_ex(("127.0.0.1", port)) == 0
 
-def remotejupyternb(host=None, port=8003, path=""):
+def _forward_spec(tunnel):
+    return f"{tunnel['local_port']}:{tunnel['remote_host']}:{tunnel['remote_port']}"
+
+def _tunnel_master_command(host, *options):
+    """An ssh command that acts on the master that carries the tunnels of the host"""
+    return ["ssh", *multiplexing_options(persist="yes", control_path=get_tunnels_control_path()), *options, host]
+
+def tunnel_alive(tunnel):
+    """Checks whether a tunnel is still forwarding its port"""
+    if tunnel.get("pid"):
+        try:
+            os.kill(tunnel["pid"], 0)
+        except OSError:
+            return False
+    elif not master_alive(tunnel["host"], control_path=get_tunnels_control_path()):
+        return False
+
+    return _port_open(tunnel["local_port"])
+
+def _forward(tunnel):
+    """
+    Starts forwarding the port of a tunnel.
+
+    The forward is added to a master connection of the host that is only used for tunnels, since the
+    shared master goes away when it has been idle for a while (and the tunnels with it). It stays
+    alive until the last tunnel of the host is closed. If connection sharing is disabled, a dedicated
+    ssh process is started in the background instead.
+    """
+    if multiplexing_enabled():
+        if not open_master(tunnel["host"], persist="yes", control_path=get_tunnels_control_path()):
+            raise RuntimeError(f"Could not connect to {tunnel['host']}")
+
+        completed = processes.run(_tunnel_master_command(tunnel["host"], "-O", "forward", "-L", _forward_spec(tunnel)),
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if completed.returncode != 0:
+            raise RuntimeError(completed.stderr.decode(errors="replace").strip())
+        tunnel["pid"] = None
+        return
+
+    process = processes.Popen(["ssh", "-N", "-o", "ExitOnForwardFailure=yes", "-L", _forward_spec(tunnel), tunnel["host"]],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    for _ in range(100):
+        if process.poll() is not None:
+            raise RuntimeError(f"ssh exited with code {process.returncode}")
+        if _port_open(tunnel["local_port"]):
+            break
+        time.sleep(0.1)
+    tunnel["pid"] = process.pid
+
+def open_tunnel(host, remote_port, local_port=None, remote_host="localhost", service=None, **info):
+    """
+    Forwards a local port to a port of the host (or of a machine that the host can reach), in the background.
+
+    If there is already a tunnel for the same service of the host, it is reused.
+
+    Parameters
+    -----------
+    host: str
+        The name of the host, as understood by ssh (and cluster-utils).
+    remote_port: int
+        The port to forward to.
+    local_port: int, optional
+        The local port. If not given (or not free), a free port is chosen.
+    remote_host: str, optional
+        The machine where the port is, as seen from the host (e.g. a compute node).
+    service: str, optional
+        Identifies what the tunnel gives access to, so that it can be reused. Defaults to "remote_host:remote_port".
+    **info:
+        Extra information that is stored with the tunnel.
+
+    Returns
+    ---------
+    dict
+        The tunnel (see `get_tunnels`).
+    """
+    service = service or f"{remote_host}:{remote_port}"
+
+    tunnels = get_tunnels()
+    for existing in tunnels:
+        if existing["host"] == host and existing["service"] == service:
+            if tunnel_alive(existing):
+                return existing
+            # The connection went away, open it again with the same ports if possible
+            tunnels.remove(existing)
+            local_port = local_port or existing["local_port"]
+            break
+
+    tunnel = {
+        "id": max([t["id"] for t in tunnels], default=0) + 1,
+        "host": host, "service": service,
+        "local_port": _free_local_port(local_port or remote_port),
+        "remote_host": remote_host, "remote_port": remote_port,
+        **info,
+    }
+    _forward(tunnel)
+
+    tunnels.append(tunnel)
+    _save_tunnels(tunnels)
+
+    return tunnel
+
+def close_tunnel(tunnel):
+    """Stops forwarding the port of a tunnel (and the remote process it was opened for, if any)"""
+    if tunnel.get("pid"):
+        try:
+            os.kill(tunnel["pid"], signal.SIGTERM)
+        except OSError:
+            pass
+    elif master_alive(tunnel["host"], control_path=get_tunnels_control_path()):
+        processes.run(_tunnel_master_command(tunnel["host"], "-O", "cancel", "-L", _forward_spec(tunnel)),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    if tunnel.get("remote_pid"):
+        processes.run(ssh_command(tunnel["host"], f"kill {int(tunnel['remote_pid'])}"),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    remaining = [t for t in get_tunnels() if t["id"] != tunnel["id"]]
+    _save_tunnels(remaining)
+
+    if not tunnel.get("pid") and not any(t["host"] == tunnel["host"] and not t.get("pid") for t in remaining):
+        # Nothing else uses the master of the tunnels, it would otherwise stay alive forever.
+        processes.run(_tunnel_master_command(tunnel["host"], "-O", "exit"), stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+
+def _job_node(host, job_id):
+    """The first node where a job is running"""
+    from .jobs import get_jobs
+
+    jobs, _ = get_jobs([host], ttl=0)
+    for job in jobs:
+        if job["id"] == job_id or job["id"].partition(".")[0] == job_id.partition(".")[0]:
+            if job["state"] != "RUNNING":
+                raise ValueError(f"Job {job_id} is not running ({job['state']})")
+            # Slurm compresses node lists, e.g. node[01-04,07]
+            match = re.match(r"([^\[,]+)(?:\[([^\],-]+))?", job["where"])
+            return match.group(1) + (match.group(2) or "")
+
+    raise ValueError(f"Job {job_id} was not found in {host}")
+
+def tunnel(host, port, local_port=None, node=None, job=None):
+    """
+    Forwards a port of the host to your computer, in the background.
+
+    The tunnel uses the shared connection with the host. If a tunnel to the same port already exists,
+    it is reused. Use `clu tunnels` to list and close tunnels.
+
+    Parameters
+    -----------
+    host: str
+        The name of the host, as understood by ssh (and cluster-utils).
+    port: int
+        The port to forward.
+    local_port: int, optional
+        The local port. Defaults to the same port if it is free, otherwise any free port.
+    node: str, optional
+        Forward to a port of this machine (as seen by the host) instead of the host itself. E.g. a compute node.
+    job: str, optional
+        Forward to a port of the node where this job is running (e.g. a notebook running inside an allocation).
+    """
+    service = None
+    if job is not None:
+        node = _job_node(host, job)
+        service = f"job {job}:{port}"
+
+    opened = open_tunnel(host, port, local_port=local_port, remote_host=node or "localhost", service=service)
+    print(f"localhost:{opened['local_port']} -> {host}:{opened['remote_host']}:{opened['remote_port']}")
+    return opened
+
+def _arguments_tunnel(subparser):
+    subparser.add_argument("host", help="The name of the host, as understood by ssh (and cluster-utils)."
+        ).completer = lambda *args, **kwargs: get_hosts()
+    subparser.add_argument("port", type=int, help="The port to forward.")
+    subparser.add_argument("-l", "--local-port", type=int, help="The local port. Defaults to the same port if it is"\
+        " free, otherwise any free port.")
+
+    group = subparser.add_mutually_exclusive_group()
+    group.add_argument("--node", help="Forward to a port of this machine (as seen by the host), e.g. a compute node.")
+    group.add_argument("--job", help="Forward to a port of the node where this job is running.")
+
+SubCommand(tunnel, _arguments_tunnel)
+
+def tunnels(id=None, all=False, close=False):
+    """
+    Lists or closes the tunnels opened by cluster-utils.
+
+    Parameters
+    -----------
+    id: list of int, optional
+        The ids of the tunnels to act on.
+    all: bool, optional
+        If `True`, act on all tunnels.
+    close: bool, optional
+        Close the tunnels.
+    """
+    selected = [t for t in get_tunnels() if all or not id or t["id"] in id]
+
+    if close:
+        if not (id or all):
+            raise ValueError("Specify the ids of the tunnels to close (or --all)")
+        for existing in selected:
+            close_tunnel(existing)
+            print(f"Closed tunnel {existing['id']} ({existing['host']} {existing['service']})")
+        return
+
+    for existing in selected:
+        state = "open" if tunnel_alive(existing) else "dead"
+        print(f"{existing['id']:<4} {existing['host']:<15} {existing['service']:<30} localhost:{existing['local_port']:<6}"\
+            f" {state}  {existing.get('url', '')}")
+
+def _arguments_tunnels(subparser):
+    subparser.add_argument("id", type=int, nargs="*", help="The ids of the tunnels (as shown by `clu tunnels`).")
+    subparser.add_argument("--all", action="store_true", help="Act on all tunnels.")
+    subparser.add_argument("--close", action="store_true", help="Close the tunnels. If they were opened by"\
+        " `clu remotejupyternb`, the notebook is also stopped.")
+
+SubCommand(tunnels, _arguments_tunnels)
+
+# Starts jupyter in the background and prints its pid and url once it is ready
+_START_JUPYTER = r"""
+cd {path} || exit 1
+port={port}
+if [ -z "$port" ]; then
+    port=$(python3 -c 'import socket; s = socket.socket(); s.bind(("localhost", 0)); print(s.getsockname()[1])')
+fi
+log=$(mktemp "${{TMPDIR:-/tmp}}/clu-jupyter.XXXXXX")
+nohup jupyter notebook --no-browser --port "$port" --port-retries 0 > "$log" 2>&1 < /dev/null &
+pid=$!
+echo "PID=$pid"
+for i in $(seq 120); do
+    url=$(grep -Eo 'https?://(localhost|127\.0\.0\.1):[0-9]+/[^ ]*' "$log" | head -n 1)
+    [ -n "$url" ] && break
+    kill -0 $pid 2> /dev/null || break
+    sleep 0.5
+done
+if [ -z "$url" ]; then
+    tail -n 5 "$log" >&2
+    exit 1
+fi
+echo "URL=$url"
+"""
+
+def remotejupyternb(host=None, port=None, path="", foreground=False):
     """
     Runs the remote version of jupyter notebook and forwards the port to your local computer.
 
-    Then, you can use the notebook GUI that is running on the remote as if it was running in your computer. 
+    Then, you can use the notebook GUI that is running on the remote as if it was running in your computer.
     Therefore, you will be using the python kernels that are installed in your remote.
 
+    The notebook runs in the background (see `clu tunnels` to stop it). If a notebook was already started
+    for the same host and path, it is reused.
+
     To use this, you need to allow remote access to jupyter in your remote. For this, set the option
     `NotebookApp.allow_remote_access` to `True` in your jupyter config file.
     See: https://jupyter-notebook.readthedocs.io/en/stable/config.html
@@ -25,31 +328,68 @@ def remotejupyternb(host=None, port=8003, path=""):
         If not provided, clusterutils will assume that you want the host to be inferred from your
         current path (you are inside a mountpoint).
     port: int, optional
-        The port where the jupyter notebook should run (and that will be forwarded to your equivalent local port)
+        The port where the jupyter notebook should run (and that will be forwarded to your equivalent local port,
+        if it is free). If not provided, a free port is chosen.
     path: str or Path, optional
         The path to the place where jupyter should be run.
-        
-        If a host is provided, the path is taken as is. 
+
+        If a host is provided, the path is taken as is.
         Otherwise, this is a path relative to the mountpoint and clu calculates the equivalent remote path.
+    foreground: bool, optional
+        Run the notebook in the foreground, attached to your terminal, instead of in the background.
     """
 
     if host is None:
         host, path = get_host_from_path(path)
 
-    subprocess.run(
-        ["ssh", "-L", f"{port}:localhost:{port}", host, "-t", f"jupyter notebook {path} --port {port}"]
-    )
+    if foreground:
+        port = port or 8003
+        processes.run(
+            ssh_command(host, f"jupyter notebook {path} --port {port}", tty=True, options=["-L", f"{port}:localhost:{port}"])
+        )
+        return
+
+    service = f"jupyter {path or '~'}"
+    for existing in get_tunnels():
+        if existing["host"] == host and existing["service"] == service:
+            if tunnel_alive(existing):
+                print(existing["url"])
+                return existing
+            close_tunnel(existing)
+
+    completed = processes.run(ssh_command(host, "bash -s"), stdout=subprocess.PIPE,
+        input=_START_JUPYTER.format(path=quote_remote_path(path), port=port or "").encode())
+    info = dict(line.partition("=")[::2] for line in completed.stdout.decode(errors="replace").splitlines() if "=" in line)
+    if completed.returncode != 0 or "URL" not in info:
+        raise RuntimeError(f"Could not start jupyter in {host}")
+
+    remote_port = int(re.search(r"://[^:/]+:(\d+)", info["URL"]).group(1))
+    try:
+        opened = open_tunnel(host, remote_port, service=service, remote_pid=int(info["PID"]))
+    except Exception:
+        processes.run(ssh_command(host, f"kill {int(info['PID'])}"), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        raise
+
+    opened["url"] = re.sub(r"://[^:/]+:\d+", f"://localhost:{opened['local_port']}", info["URL"])
+    _save_tunnels([opened if t["id"] == opened["id"] else t for t in get_tunnels()])
+
+    print(opened["url"])
+    return opened
 
 def _arguments_remotejupyternb(subparser):
-    
+
     subparser.add_argument("host", nargs="?",
         help="Host where to run the jupyter notebook. If not provided, it will be inferred from your current path"+
         " (you must be inside a mountpoint)").completer = lambda *args, **kwargs: get_hosts()
-    
-    subparser.add_argument("-p", "--port", help="The port where the jupyter notebook should run", default=8003, type=int)
+
+    subparser.add_argument("-p", "--port", help="The port where the jupyter notebook should run. If not provided,"+
+        " a free port is chosen.", type=int)
 
     subparser.add_argument("--path", help="The path to the place where jupyter should be run. "+
         "If a host is provided, the path is taken as is. Otherwise, this is a path relative to the mountpoint and"+
         " clu calculates the equivalent remote path.", default="")
 
-SubCommand(remotejupyternb, _arguments_remotejupyternb)
\ No newline at end of file
+    subparser.add_argument("--foreground", action="store_true", help="Run the notebook attached to your terminal"+
+        " (it stops when you close it) instead of in the background.")
+
+SubCommand(remotejupyternb, _arguments_remotejupyternb)
@@ -0,0 +1,187 @@
+"""
+Helpers to run external commands (ssh, scp, sshfs...) from the subcommands.
+
+All subcommands should go through `run` instead of calling `subprocess` directly.
+This lets `_multiple_hosts` run several hosts at the same time while keeping the
+output of each host together (it's buffered and printed when the host is done) and
+while enforcing a per host deadline.
+"""
+from contextlib import contextmanager, nullcontext
+import subprocess
+import sys
+import threading
+import time
+
+__all__ = []
+
+_local = threading.local()
+
+# Set by the profiling module while `clu --profile` is active (see profiling.py).
+# When it is None, the only cost of the profiling hooks is checking it.
+_profiler = None
+_NO_PHASE = nullcontext()
+
+def current_host():
+    """The host that the current thread is working on (see `host_context`), if any"""
+    return getattr(_local, "host", None)
+
+def phase(name, **info):
+    """
+    Marks a phase of a subcommand, so that its time appears in the profile (`clu --profile`).
+
+    Use it as a context manager: `with processes.phase("parse yaml"): ...`
+    """
+    if _profiler is None:
+        return _NO_PHASE
+    return _profiler.phase(name, **info)
+
+def record_bytes(sent=0, received=0, host=None):
+    """Records bytes transferred to/from a host (the current one by default) that the profiler can't see (e.g. pipes)"""
+    if _profiler is not None:
+        _profiler.record_bytes(sent=sent, received=received, host=host)
+
+def _current_buffer():
+    return getattr(_local, "buffer", None)
+
+def _remaining_time(timeout=None):
+    """
+    Returns the timeout to pass to a subprocess, taking into account the deadline of the current host.
+
+    Raises `subprocess.TimeoutExpired` if the deadline has already passed.
+    """
+    deadline = getattr(_local, "deadline", None)
+    if deadline is None:
+        return timeout
+
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise subprocess.TimeoutExpired(getattr(_local, "host", ""), 0)
+
+    return remaining if timeout is None else min(timeout, remaining)
+
+class _RoutedStream:
+    """
+    Replacement for sys.stdout/sys.stderr that sends writes to the buffer of the current thread.
+
+    Threads that are not collecting output write to the original stream.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, text):
+        buffer = _current_buffer()
+        if buffer is None:
+            return self._stream.write(text)
+        buffer.append(text)
+        return len(text)
+
+    def flush(self):
+        if _current_buffer() is None:
+            self._stream.flush()
+
+    def __getattr__(self, key):
+        return getattr(self._stream, key)
+
+@contextmanager
+def routed_output():
+    """Routes sys.stdout and sys.stderr through the per thread buffers while the context is active."""
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = _RoutedStream(stdout), _RoutedStream(stderr)
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+@contextmanager
+def host_context(host, timeout=None, buffer=None):
+    """
+    Sets the host that the current thread is working on.
+
+    Parameters
+    -----------
+    host: str
+        The name of the host.
+    timeout: float, optional
+        Maximum number of seconds that the commands run for this host can take in total.
+    buffer: list, optional
+        If provided, all the output (python prints and subprocess output) is appended
+        to this list instead of going directly to the terminal.
+
+    When it is used inside another host context (e.g. a function for a single host called
+    while processing many hosts), the deadline and the buffer of the outer context still
+    apply, unless new ones are given (a new deadline can't be later than the outer one).
+    """
+    previous = (getattr(_local, "host", None), getattr(_local, "deadline", None), _current_buffer())
+
+    deadline = previous[1]
+    if timeout is not None:
+        new_deadline = time.monotonic() + timeout
+        deadline = new_deadline if deadline is None else min(deadline, new_deadline)
+
+    _local.host = host
+    _local.deadline = deadline
+    _local.buffer = previous[2] if buffer is None else buffer
+    try:
+        yield
+    finally:
+        _local.host, _local.deadline, _local.buffer = previous
+
+def run(command, **kwargs):
+    """
+    Wrapper around `subprocess.run` that is aware of the host context.
+
+    If output is being collected, stdout and stderr of the process are captured
+    (unless the caller asks for something else) and added to the host's buffer.
+    """
+    kwargs["timeout"] = _remaining_time(kwargs.get("timeout"))
+
+    buffer = _current_buffer()
+    collect = buffer is not None and "stdout" not in kwargs and not kwargs.get("capture_output")
+    if collect:
+        kwargs["stdout"] = subprocess.PIPE
+        kwargs.setdefault("stderr", subprocess.STDOUT)
+
+    event = None if _profiler is None else _profiler.begin_process(command, kwargs.get("input"))
+    # How the process ended, for the profiler
+    info = {}
+    try:
+        completed = subprocess.run(command, **kwargs)
+    except subprocess.TimeoutExpired as e:
+        info = {"status": "timed out"}
+        if collect and e.output:
+            buffer.append(e.output.decode(errors="replace") if isinstance(e.output, bytes) else e.output)
+        raise
+    except subprocess.CalledProcessError as e:
+        info = {"returncode": e.returncode, "output": e.output}
+        if collect and e.output:
+            buffer.append(e.output.decode(errors="replace") if isinstance(e.output, bytes) else e.output)
+        raise
+    except OSError as e:
+        info = {"status": "failed", "error": str(e)}
+        raise
+    else:
+        info = {"returncode": completed.returncode, "output": completed.stdout}
+    finally:
+        if event is not None:
+            _profiler.end_process(event, **info)
+
+    if collect and completed.stdout:
+        out = completed.stdout
+        buffer.append(out.decode(errors="replace") if isinstance(out, bytes) else out)
+        completed.stdout = None
+
+    return completed
+
+def check_output(command, **kwargs):
+    """Same as `subprocess.check_output`, but going through `run` (deadline of the current host, profiling...)."""
+    if "stdout" in kwargs:
+        raise ValueError("stdout argument not allowed, it will be overridden.")
+    kwargs.setdefault("check", True)
+    return run(command, stdout=subprocess.PIPE, **kwargs).stdout
+
+def Popen(command, **kwargs):
+    """Same as `subprocess.Popen`. Deadlines can't be applied to it, the caller must wait for it."""
+    if _profiler is not None:
+        return _profiler.popen(command, **kwargs)
+    return subprocess.Popen(command, **kwargs)
@@ -0,0 +1,225 @@
+"""
+Timing instrumentation for the subcommands (`clu --profile` or CLUSTER_UTILS_PROFILE=1).
+
+While profiling is active, the dispatch of the subcommand, every external process started
+through `processes` (ssh, scp, sshfs...) and the phases marked with `processes.phase` are
+recorded, together with the host that they were run for and the bytes sent and received
+when they are known. At the end, a summary is printed and a trace is written in the Chrome
+trace format (open it in https://ui.perfetto.dev or chrome://tracing).
+
+When profiling is not active, this module is not even imported and the hooks in `processes`
+only check that there is no profiler.
+"""
+from contextlib import contextmanager
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from .sizes import human_size
+from . import processes
+
+__all__ = []
+
+def _trace_path(subcommand):
+    """Where the trace is written: CLUSTER_UTILS_PROFILE if it is a path, otherwise in the cache"""
+    from .path import get_path
+
+    requested = os.environ.get("CLUSTER_UTILS_PROFILE", "")
+    if requested.lower().endswith(".json"):
+        return os.path.abspath(os.path.expanduser(requested))
+
+    profiles_dir = get_path(".cache") / "profiles"
+    profiles_dir.mkdir(parents=True, exist_ok=True)
+    return str(profiles_dir / f"{time.strftime('%Y%m%d-%H%M%S')}-{subcommand}.json")
+
+def _process_name(command):
+    if isinstance(command, (str, bytes)):
+        return os.path.basename(str(command).split()[0])
+    name = os.path.basename(str(command[0]))
+    if "-O" in command[:-1]:
+        # Control commands for the master connection (e.g. ssh -O check)
+        name += f" -O {command[command.index('-O') + 1]}"
+    return name
+
+def _size(data):
+    return len(data) if isinstance(data, (bytes, str)) else 0
+
+class _ProfiledPopen(subprocess.Popen):
+    """Popen that tells the profiler when the process finishes (i.e. when someone notices that it did)"""
+
+    def __init__(self, profiler, event, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._clu_profile = (profiler, event)
+        event["args"]["pid"] = self.pid
+
+    def _clu_finish(self):
+        if self.returncode is not None and self._clu_profile is not None:
+            profiler, event = self._clu_profile
+            self._clu_profile = None
+            profiler.end_process(event, returncode=self.returncode)
+
+    def wait(self, timeout=None):
+        try:
+            return super().wait(timeout)
+        finally:
+            self._clu_finish()
+
+    def poll(self):
+        returncode = super().poll()
+        self._clu_finish()
+        return returncode
+
+class Profiler:
+    """
+    Records what happens while a subcommand runs.
+
+    Events are kept as complete events of the Chrome trace format ("ph": "X"), with times in microseconds
+    since the profiler was created. Each thread is a row of the trace, which, since `run_for_hosts` uses
+    a thread per host, means that concurrent hosts are shown side by side.
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self.events = []
+        # Popen events that haven't finished yet
+        self._running = []
+        # {host: [sent, received]}
+        self.transferred = {}
+
+    def _now(self):
+        return (time.perf_counter() - self._start) * 1e6
+
+    def begin(self, name, category, **info):
+        host = processes.current_host()
+        return {"name": name, "cat": category, "ph": "X", "ts": self._now(), "pid": os.getpid(),
+            "tid": threading.get_ident(), "args": {**({"host": host} if host else {}), **info}}
+
+    def end(self, event, **info):
+        event["dur"] = self._now() - event["ts"]
+        event["args"].update(info)
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def phase(self, name, **info):
+        event = self.begin(name, "phase", **info)
+        try:
+            yield
+        finally:
+            self.end(event)
+
+    def record_bytes(self, sent=0, received=0, host=None):
+        host = host or processes.current_host() or "local"
+        with self._lock:
+            counts = self.transferred.setdefault(host, [0, 0])
+            counts[0] += sent
+            counts[1] += received
+
+    def begin_process(self, command, input=None):
+        event = self.begin(_process_name(command), "process", command=" ".join(map(str, command))[:300]
+            if not isinstance(command, (str, bytes)) else str(command)[:300])
+        if input:
+            event["args"]["sent"] = _size(input)
+        return event
+
+    def end_process(self, event, output=None, **info):
+        if output:
+            info["received"] = _size(output)
+        self.end(event, **info)
+        if event["args"].get("sent") or info.get("received"):
+            self.record_bytes(event["args"].get("sent", 0), info.get("received", 0), host=event["args"].get("host"))
+
+    def popen(self, command, **kwargs):
+        event = self.begin_process(command)
+        process = _ProfiledPopen(self, event, command, **kwargs)
+        with self._lock:
+            self._running.append(process)
+        return process
+
+    def close(self):
+        """Finishes the events of the processes that are still running (e.g. daemons started by the command)"""
+        for process in self._running:
+            if process._clu_profile is not None:
+                process.poll()
+            if process._clu_profile is not None:
+                profiler, event = process._clu_profile
+                process._clu_profile = None
+                profiler.end(event, still_running=True)
+
+    def trace(self):
+        """The recorded events in the Chrome trace format"""
+        thread_names = {threading.main_thread().ident: "main"}
+        for event in self.events:
+            host = event["args"].get("host")
+            if host and event["tid"] not in thread_names:
+                thread_names[event["tid"]] = host
+
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+            for tid, name in thread_names.items()]
+        return {"traceEvents": metadata + sorted(self.events, key=lambda event: event["ts"]), "displayTimeUnit": "ms"}
+
+    def summary(self, title):
+        """A human readable summary: time spent on each phase/command and on each host"""
+        total = self._now() / 1e6
+
+        by_name, by_host = {}, {}
+        for event in self.events:
+            name = event["name"] if event["cat"] != "process" else f"[{event['name']}]"
+            stats = by_name.setdefault(name, [0, 0., 0.])
+            stats[0] += 1
+            stats[1] += event["dur"] / 1e6
+            stats[2] = max(stats[2], event["dur"] / 1e6)
+
+            host = event["args"].get("host")
+            if host and event["cat"] == "process":
+                by_host[host] = by_host.get(host, 0.) + event["dur"] / 1e6
+
+        lines = [f"(cluster-utils) Profile of `{title}`: {total:.3f}s",
+            f"   {'phase / [command]':<36} {'calls':>6} {'total':>9} {'max':>9}"]
+        for name, (calls, busy, longest) in sorted(by_name.items(), key=lambda item: -item[1][1]):
+            lines.append(f"   {name[:36]:<36} {calls:>6} {busy:>8.3f}s {longest:>8.3f}s")
+
+        hosts = sorted(set(by_host) | set(self.transferred))
+        if hosts:
+            lines.append(f"   {'host':<36} {'commands':>9} {'sent':>9} {'received':>9}")
+            for host in hosts:
+                sent, received = self.transferred.get(host, (0, 0))
+                lines.append(f"   {host[:36]:<36} {by_host.get(host, 0.):>8.3f}s {human_size(sent):>9} {human_size(received):>9}")
+
+        return "\n".join(lines)
+
+@contextmanager
+def profile(subcommand, argv=()):
+    """
+    Profiles everything that runs inside it.
+
+    At the end, the summary is printed (to stderr) and the trace is written to a file.
+
+    Parameters
+    -----------
+    subcommand: str
+        The name of the subcommand that is profiled.
+    argv: list of str, optional
+        The arguments of the command line, to show them in the summary.
+    """
+    profiler = Profiler()
+    processes._profiler = profiler
+    try:
+        with profiler.phase(f"clu {subcommand}"):
+            yield profiler
+    finally:
+        processes._profiler = None
+        profiler.close()
+
+        import json
+
+        trace_path = _trace_path(subcommand)
+        with open(trace_path, "w") as f:
+            json.dump(profiler.trace(), f)
+
+        print(profiler.summary(" ".join(["clu", *argv])), file=sys.stderr)
+        print(f"(cluster-utils) Trace written to {trace_path} (open it in https://ui.perfetto.dev or chrome://tracing)",
+            file=sys.stderr)
@@ -0,0 +1,97 @@
+"""
+Registry of the available subcommands.
+
+It lets `clu` know which subcommands exist (and their help message) without importing
+all the modules that define them, so that only the module of the command that is run
+(or completed) is imported. The registry is generated by importing everything once and
+it is regenerated automatically whenever a module of this package is modified.
+"""
+import importlib
+import marshal
+import os
+
+# Note that we avoid pathlib and json here, since importing them is a
+# significant part of the time that it takes to run a simple command.
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+REGISTRY_FILE = os.path.join(_PACKAGE_DIR, ".registry")
+
+_registry = None
+
+def _module_names():
+    return sorted(entry.name[:-3] for entry in os.scandir(_PACKAGE_DIR)
+        if entry.name.endswith(".py") and entry.name != "__init__.py")
+
+def _is_stale():
+    try:
+        registry_mtime = os.stat(REGISTRY_FILE).st_mtime_ns
+    except OSError:
+        return True
+
+    # The mtime of the directory changes when modules are added, removed or renamed
+    return os.stat(_PACKAGE_DIR).st_mtime_ns > registry_mtime or any(
+        entry.stat().st_mtime_ns > registry_mtime for entry in os.scandir(_PACKAGE_DIR) if entry.name.endswith(".py"))
+
+def generate_registry():
+    """
+    Imports all the modules of the package and gathers the information of their subcommands.
+
+    The result is written to REGISTRY_FILE (if possible) so that the next calls don't need to do it.
+    """
+    from .subcommand import SubCommand
+
+    exports = {}
+    for module_name in _module_names():
+        module = importlib.import_module(f"{__package__}.{module_name}")
+        exports[module_name] = list(getattr(module, "__all__", []))
+
+    commands = {}
+    for name, command in SubCommand.get_all().items():
+        commands[name] = {
+            "module": command.function.__module__.rpartition(".")[-1],
+            "help": command._add_parser_kwargs.get("help", ""),
+            "served": command.served,
+        }
+
+    registry = {"commands": commands, "exports": exports}
+
+    try:
+        tmp_file = f"{REGISTRY_FILE}.{os.getpid()}"
+        with open(tmp_file, "wb") as f:
+            marshal.dump(registry, f)
+        os.replace(tmp_file, REGISTRY_FILE)
+        # Writing the registry has changed the mtime of the directory, that's not a reason to regenerate it
+        mtime = max(os.stat(_PACKAGE_DIR).st_mtime_ns, os.stat(REGISTRY_FILE).st_mtime_ns)
+        os.utime(REGISTRY_FILE, ns=(mtime, mtime))
+    except OSError:
+        pass
+
+    return registry
+
+def load_registry():
+    """Returns the registry, regenerating it if needed"""
+    global _registry
+
+    if _registry is None:
+        if _is_stale():
+            _registry = generate_registry()
+        else:
+            with open(REGISTRY_FILE, "rb") as f:
+                _registry = marshal.load(f)
+
+    return _registry
+
+def get_subcommand(name):
+    """
+    Gets a subcommand, importing only the module where it is defined.
+
+    Parameters
+    -----------
+    name: str
+        The name of the subcommand, as called from the CLI.
+    """
+    from .subcommand import SubCommand
+
+    if name not in SubCommand.get_all():
+        importlib.import_module(f"{__package__}.{load_registry()['commands'][name]['module']}")
+
+    return SubCommand.get_all()[name]
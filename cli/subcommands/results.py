@@ -0,0 +1,256 @@
+"""
+Gathering results (energies, forces...) from many calculations without reading the outputs through the mounts.
+
+The values are extracted in the host, with a single ssh session per host: a `sed` script picks the lines
+that matter from each output and a single `awk` reduces them to one row per file. Only those rows travel
+back. Rows are cached (in CLUSTER_UTILS_ROOT/.cache/results) with the modification time and size of the
+file, so outputs that didn't change are not read again.
+"""
+import csv
+import json
+import os
+import subprocess
+import sys
+
+from .host_management import DEFAULT_JOBS, get_hosts, run_for_hosts
+from .jobs import _quote_pattern, _resolve_patterns
+from .mounting import get_local_path
+from .path import get_path
+from .subcommand import SubCommand
+from .connections import ssh_command
+from . import processes
+
+__all__ = ["collect", "EXTRACTORS"]
+
+# Builtin extractors for SIESTA outputs: {name: (mode, regex)}. Modes:
+#   - "last": the first group of the regex in the last line that matches.
+#   - "count": number of lines that match.
+#   - "any": whether any line matches.
+EXTRACTORS = {
+    "energy": ("last", r"^siesta: +Total += *([^ ]+)"),
+    "free_energy": ("last", r"^siesta: +FreeEng += *([^ ]+)"),
+    "fermi": ("last", r"^siesta: +Fermi += *([^ ]+)"),
+    "max_force": ("last", r"^ +Max +([0-9.eEdD+-]+)"),
+    "scf_steps": ("count", r"^ *scf: *[0-9]+ "),
+    "finished": ("any", r"End of run"),
+}
+DEFAULT_EXTRACTORS = ["energy", "max_force", "scf_steps", "finished"]
+
+def _cache_file(host):
+    return get_path(".cache") / "results" / f"{host}.json"
+
+def _read_cache(host):
+    try:
+        return json.loads(_cache_file(host).read_text())
+    except (OSError, ValueError):
+        return {}
+
+def _write_cache(host, cache):
+    cache_file = _cache_file(host)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}")
+    tmp_file.write_text(json.dumps(cache))
+    os.replace(tmp_file, cache_file)
+
+def _sed_rule(name, mode, regex):
+    regex = regex.replace("/", r"\/")
+    if mode != "last":
+        return f"/{regex}/s/.*/={name} 1/p"
+    if "(" not in regex:
+        regex = f"({regex})"
+    return f"s/.*{regex}.*/={name} \\1/p"
+
+def _collect_script(patterns, rules, known):
+    """
+    Script that extracts the values in the host.
+
+    It prints "SAME <path>" for the files in `known` that didn't change and
+    "ROW <path> <mtime> <size> <value>..." (tab separated) for the others.
+    """
+    names = list(rules)
+    # Rules rewrite the line when they match, so the original line is kept in the hold space
+    # (h) and restored (g) after each rule, for the next one to see it.
+    sed = "\n".join(["h", *(f"{_sed_rule(name, *rules[name])}\ng" for name in names)])
+    known = "\n".join(f"{entry['mtime']}\t{entry['size']}\t{path}" for path, entry in known.items())
+    modes = ",".join(rules[name][0] for name in names)
+
+    return f"""
+shopt -s nullglob
+tmp=$(mktemp -d) || exit 1
+trap 'rm -rf "$tmp"' EXIT
+cat > "$tmp/sed" <<'CLU_EOF'
+{sed}
+CLU_EOF
+cat > "$tmp/known" <<'CLU_EOF'
+{known}
+CLU_EOF
+
+files=()
+for path in {" ".join(_quote_pattern(pattern) for pattern in patterns)}; do
+    if [ -d "$path" ]; then files+=("$path"/*.out); elif [ -f "$path" ]; then files+=("$path"); fi
+done
+[ ${{#files[@]}} -gt 0 ] || exit 0
+
+(stat -c $'%Y\\t%s\\t%n' -- "${{files[@]}}" 2>/dev/null || stat -f $'%m\\t%z\\t%N' -- "${{files[@]}}") \\
+    | awk -F'\\t' 'NR == FNR {{ known[$0]; next }} ($0 in known) {{ print "SAME\\t" $3; next }} {{ print "FILE\\t" $3 "\\t" $1 "\\t" $2 }}' "$tmp/known" - \\
+    | while IFS=$'\\t' read -r kind path mtime size; do
+        printf '%s\\t%s\\t%s\\t%s\\n' "$kind" "$path" "$mtime" "$size"
+        [ "$kind" == FILE ] && sed -nEf "$tmp/sed" "$path"
+    done \\
+    | awk -v names={",".join(names)!r} -v modes={modes!r} '
+        BEGIN {{ n = split(names, name, ","); split(modes, mode, ","); for (i = 1; i <= n; i++) index_of[name[i]] = i }}
+        function flush(   row, i) {{
+            if (file == "") return
+            row = "ROW\\t" file
+            for (i = 1; i <= n; i++) row = row "\\t" ((i in value) ? value[i] : (mode[i] == "last" ? "" : 0))
+            print row
+            file = ""
+        }}
+        /^SAME\\t/ {{ flush(); print; next }}
+        /^FILE\\t/ {{ flush(); split($0, fields, "\\t"); file = fields[2] "\\t" fields[3] "\\t" fields[4]; split("", value); next }}
+        /^=/ {{
+            i = index_of[substr($1, 2)]
+            if (mode[i] == "count") value[i] += 1
+            else if (mode[i] == "any") value[i] = 1
+            else value[i] = substr($0, length($1) + 2)
+        }}
+        END {{ flush() }}
+    '
+"""
+
+def _parse_value(mode, value):
+    if mode == "count":
+        return int(value or 0)
+    if mode == "any":
+        return value == "1"
+    try:
+        return float(value.replace("D", "E").replace("d", "e"))
+    except ValueError:
+        return value or None
+
+def _collect_host(host, patterns, rules, refresh=False):
+    """
+    Extracts the values for the files of a host that match the patterns.
+
+    Parameters
+    -----------
+    patterns: dict
+        The patterns of each host, as returned by `_resolve_patterns`.
+
+    Returns
+    ---------
+    dict
+        The values ({name: value}) for each remote path.
+    """
+    cache = _read_cache(host)
+    known = {} if refresh else {path: entry for path, entry in cache.items()
+        if all(entry["rules"].get(name) == list(rule) for name, rule in rules.items())}
+
+    completed = processes.run(ssh_command(host, "bash -s"), input=_collect_script(patterns[host], rules, known).encode(),
+        stdout=subprocess.PIPE)
+    if completed.returncode != 0:
+        raise RuntimeError(f"the extraction failed in the host (exit code {completed.returncode})")
+
+    results = {}
+    for line in completed.stdout.decode(errors="replace").splitlines():
+        kind, path, *fields = line.split("\t")
+        if kind == "SAME" and path in known:
+            results[path] = {name: known[path]["values"][name] for name in rules}
+        elif kind == "ROW" and len(fields) == 2 + len(rules):
+            mtime, size, *values = fields
+            results[path] = {name: _parse_value(rules[name][0], value) for name, value in zip(rules, values)}
+            cache[path] = {"mtime": mtime, "size": size, "values": results[path],
+                "rules": {name: list(rule) for name, rule in rules.items()}}
+
+    processes.record_bytes(received=len(completed.stdout))
+    _write_cache(host, cache)
+
+    return results
+
+def collect(paths=None, host=None, extract=None, regex=None, format="table", refresh=False, timeout=None):
+    """
+    Extracts values from the outputs of many calculations, in the hosts.
+
+    Parameters
+    -----------
+    paths: list of str, optional
+        Output files or directories (their *.out files are used), which can contain glob patterns
+        (e.g. 'sweep/*'). If no host is given, they are local paths inside a mountpoint (the current
+        directory by default). Otherwise, they are relative to the mounted directory of the host.
+    host: str, optional
+        The name of the host, as understood by ssh (and cluster-utils).
+    extract: list of str, optional
+        Names of the builtin extractors to use (see `EXTRACTORS`).
+    regex: list of str, optional
+        Additional extractors, as "NAME=REGEX". The value is the first group of the regex (or the
+        whole match if it has no groups) in the last line that matches. Regexes are extended regular
+        expressions, as understood by sed -E.
+    format: {"table", "json", "csv"}, optional
+        How to print the results. With json, a JSON object is printed for each file.
+    refresh: bool, optional
+        Read all outputs again, ignoring the cached values.
+    timeout: float, optional
+        Maximum time (in seconds) to wait for each host.
+
+    Returns
+    ---------
+    list of dict
+        A row for each file, with its "host", "path" and the extracted values.
+    """
+    rules = {name: EXTRACTORS[name] for name in (extract or ([] if regex else DEFAULT_EXTRACTORS))}
+    for spec in regex or []:
+        name, sep, expression = spec.partition("=")
+        if not sep or not name.isidentifier():
+            raise ValueError(f"Custom extractors must be given as NAME=REGEX, got '{spec}'")
+        rules[name] = ("last", expression)
+
+    patterns = _resolve_patterns(paths, host=host)
+    results = run_for_hosts(_collect_host, list(patterns), jobs=min(len(patterns), DEFAULT_JOBS), timeout=timeout,
+        patterns=patterns, rules=rules, refresh=refresh)
+
+    rows = []
+    for result in results:
+        if result.status != "ok":
+            print(f"(cluster-utils) Could not collect the results of {result.host} ({result.error or result.status}).",
+                file=sys.stderr)
+            continue
+        for remote_path, values in sorted(result.value.items()):
+            path = get_local_path(result.host, remote_path) or f"{result.host}:{remote_path}"
+            rows.append({"host": result.host, "path": str(path), **values})
+
+    columns = ["host", "path", *rules]
+    if format == "json":
+        for row in rows:
+            print(json.dumps(row))
+    elif format == "csv":
+        writer = csv.DictWriter(sys.stdout, fieldnames=columns, lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        table = [[column.upper() for column in columns[1:]],
+            *([("" if row[column] is None else str(row[column])) for column in columns[1:]] for row in rows)]
+        widths = [max(len(line[i]) for line in table) for i in range(len(columns) - 1)]
+        for line in table:
+            print("  ".join(value.ljust(width) for value, width in zip(line, widths)).rstrip())
+
+    return rows
+
+def _arguments_collect(subparser):
+    subparser.add_argument("paths", nargs="*", help="Output files or directories (their *.out files are used), which can"\
+        " contain glob patterns (e.g. 'sweep/*', quote it so that your shell doesn't expand it). Local paths inside a"\
+        " mountpoint, or relative to the mounted directory if --host is given. Defaults to the current directory.")
+
+    subparser.add_argument("--host", help="The host of the outputs, if you are not inside its mountpoint."
+        ).completer = lambda *args, **kwargs: get_hosts()
+
+    subparser.add_argument("-e", "--extract", action="append", choices=list(EXTRACTORS), help="A value to extract"\
+        f" (can be repeated). Defaults to {', '.join(DEFAULT_EXTRACTORS)}.")
+    subparser.add_argument("-r", "--regex", action="append", metavar="NAME=REGEX", help="Extract also the first group"\
+        " of this (extended) regular expression, from the last line that matches it. E.g. -r 'spin=Total spin = *([^ ]+)'")
+
+    subparser.add_argument("-f", "--format", choices=["table", "json", "csv"], default="table", help="How to print the"\
+        " results. json prints an object per file.")
+    subparser.add_argument("--refresh", action="store_true", help="Read all outputs again, ignoring the cached values.")
+    subparser.add_argument("--timeout", type=float, help="Maximum time (in seconds) to wait for each host.")
+
+SubCommand(collect, _arguments_collect)
@@ -1,16 +1,41 @@
+import hashlib
+import io
+import json
 import os
 from pathlib import Path
+import re
+import shlex
+import stat
 import subprocess
+import tarfile
+import time
 
-from .host_management import _multiple_hosts, get_hosts
+from .host_management import _multiple_hosts
+from .inventory import get_inventory
 from .path import get_path
-from .mounting import get_mount_adress
 from .subcommand import SubCommand
+from .connections import ssh_command
+from . import processes
 
 __all__ = ["setup_host_scripts"]
 
 _TOCOPY = ["activate", "install", "uninstall"]
 
+# Files where the host keeps record of the scripts that it has (relative to its clusterutils_dir)
+_MANIFEST = ".manifest"
+_MANIFEST_ID = ".manifest_id"
+# Exit code used by the sync script when the host doesn't have the manifest that we expect
+_STALE_EXIT_CODE = 42
+# Index that `cluget` uses in the host to find scripts without looking for them in the filesystem
+_INDEX = "scripts/index.sh"
+# Command script with the configuration of the host that scripts in the host need to know
+_HOST_CONFIG = "scripts/commands/host_config.sh"
+# Keys of the host configuration that are available in the host: {key: environment variable}
+_EXPORTED_CONFIG = {"scratch_dir": "CLUSTER_UTILS_SCRATCH"}
+# Kinds of scripts that `cluget` can be asked for: {what: (directory, prefix)}
+# (keep it in sync with _cluparseget in scripts/generic/commands/clu.sh)
+_RESOLVABLE = {"runner": ("runners", "run"), "env_loader": ("env_loaders", "load")}
+
 def get_scripts_paths(host):
     # Get the cluster utils provided scripts and the user defined ones
     scripts_dir = get_path("scripts")
@@ -23,29 +48,242 @@ def get_scripts_paths(host):
 
     return candidates
 
+def get_scripts_tree(host):
+    """
+    Gets all the files that should be present in the cluster-utils directory of the host.
+
+    Scripts are merged from all the candidates returned by `get_scripts_paths`, so
+    if some script is in more than one candidate the LAST ONE WINS.
+
+    Returns
+    ---------
+    dict
+        Keys are the paths relative to the remote cluster-utils directory and values
+        are either the local paths of the files or their contents (bytes).
+    """
+    tree = {name: get_path(name) for name in _TOCOPY}
+
+    for candidate in get_scripts_paths(host):
+        if not candidate.is_dir():
+            continue
+        for path in sorted(candidate.rglob("*")):
+            if path.is_file():
+                tree[(Path("scripts") / path.relative_to(candidate)).as_posix()] = path
+
+    return tree
+
+def build_index(tree):
+    """
+    Builds the index that `cluget` uses to resolve scripts in the host.
+
+    Since the tree has already been merged following the precedence of `get_scripts_paths`,
+    the index just needs to map each (what, name) to the path that ended up in the tree.
+
+    Returns
+    ---------
+    bytes
+        A shell script that defines a `_clu_index_<what>_<name>` variable with the path
+        (relative to the cluster-utils directory) of each script.
+    """
+    lines = ["# Generated by `clu setuphostscripts`, do not edit.", "_clu_index=1"]
+    for what, (directory, prefix) in _RESOLVABLE.items():
+        for rel_path in sorted(tree):
+            parent, _, filename = rel_path.rpartition("/")
+            if parent != f"scripts/{directory}" or not (filename.startswith(f"{prefix}_") and filename.endswith(".sh")):
+                continue
+            name = re.sub(r"\W", "_", filename[len(prefix) + 1:-3])
+            lines.append(f"_clu_index_{what}_{name}={shlex.quote(rel_path)}")
+
+    return ("\n".join(lines) + "\n").encode()
+
+def build_host_config(host_config):
+    """
+    Builds the command script that exports the configuration of the host (see _EXPORTED_CONFIG).
+
+    Values are double quoted, so that they can refer to variables of the host (e.g. $USER).
+
+    Returns
+    ---------
+    bytes
+        The contents of the script.
+    """
+    lines = ["# Generated by `clu setuphostscripts` from the configuration of the host, do not edit."]
+    for key, variable in _EXPORTED_CONFIG.items():
+        value = str(host_config.get(key) or "")
+        for char in '\\"`':
+            value = value.replace(char, f"\\{char}")
+        lines.append(f'{variable}="{value}"')
+
+    return ("\n".join(lines) + "\n").encode()
+
+def build_manifest(tree):
+    """
+    Builds the manifest of a scripts tree.
+
+    Returns
+    ---------
+    dict
+        Maps each relative path to a list containing the sha256 of its contents and its permissions.
+    """
+    manifest = {}
+    for rel_path, source in tree.items():
+        if isinstance(source, bytes):
+            content, mode = source, 0o644
+        else:
+            content, mode = source.read_bytes(), stat.S_IMODE(source.stat().st_mode)
+        manifest[rel_path] = [hashlib.sha256(content).hexdigest(), mode]
+
+    return manifest
+
+def manifest_id(manifest):
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+
+def _manifest_cache(host):
+    return get_path(".cache") / "manifests" / f"{host}.json"
+
+def _read_cached_manifest(host):
+    try:
+        return json.loads(_manifest_cache(host).read_text())
+    except (OSError, ValueError):
+        return None
+
+def _write_cached_manifest(host, manifest):
+    cache = _manifest_cache(host)
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    cache.write_text(json.dumps(manifest, sort_keys=True))
+
+def _fetch_remote_manifest(host, clu_dir):
+    """
+    Reads the manifest that was left in the host by the last sync.
+
+    Returns
+    ---------
+    dict or None
+        With the "id" and the "files" of the manifest. `None` if there is no manifest.
+    """
+    completed = processes.run(ssh_command(host, f"cat {clu_dir}/{_MANIFEST_ID} 2>/dev/null; echo; cat {clu_dir}/{_MANIFEST} 2>/dev/null"),
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    remote_id, _, files = completed.stdout.decode().partition("\n")
+    try:
+        return {"id": remote_id.strip(), "files": json.loads(files)}
+    except ValueError:
+        return None
+
+def _tar_stream(tree, rel_paths):
+    """Builds an in-memory compressed tarball with the requested files of the tree"""
+    now = time.time()
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode="w:gz", compresslevel=6) as tar:
+        for rel_path in rel_paths:
+            source = tree[rel_path]
+            if isinstance(source, bytes):
+                content, mode = source, 0o644
+            else:
+                content, mode = source.read_bytes(), stat.S_IMODE(source.stat().st_mode)
+            info = tarfile.TarInfo(rel_path)
+            info.size, info.mode, info.mtime = len(content), mode, now
+            tar.addfile(info, io.BytesIO(content))
+
+    return stream.getvalue()
+
+def _sync_script(clu_dir, expected_id, removed, send_tar, reinstall, full):
+    """
+    Shell script that runs on the host to apply the changes in a single session.
+
+    It exits with _STALE_EXIT_CODE (without touching anything) if the host is not in the state we expected.
+    """
+    lines = [
+        f"mkdir -p {clu_dir} && cd {clu_dir} || exit 1",
+        f'if [ "$(cat {_MANIFEST_ID} 2>/dev/null)" != "{expected_id or ""}" ]; then exit {_STALE_EXIT_CODE}; fi',
+    ]
+    if reinstall:
+        lines.append("if [ -f .installed ]; then ./uninstall > /dev/null; fi")
+    if full:
+        lines.append("rm -rf " + " ".join([*_TOCOPY, "scripts"]))
+    if removed:
+        lines.append("rm -f -- " + " ".join(shlex.quote(rel_path) for rel_path in removed))
+    if send_tar:
+        lines.append("tar xzmf - || exit 1")
+    lines.append("if [ ! -f .installed ]; then ./install; fi")
+    if send_tar:
+        # Leave the activation bundle (see activate) ready, instead of having the next login rebuild it
+        lines.append("CLUSTER_UTILS_ROOT=\"$PWD\" bash -c 'source ./activate' > /dev/null 2>&1 || true")
+
+    return "\n".join(lines)
+
 @_multiple_hosts()
-def setup_host_scripts(host):
+def setup_host_scripts(host, force=False):
     """
     Makes sure that the scripts on the host are updated.
 
-    Also, runs the install script if cluster-utils is not installed.
+    Only the files that changed since the last sync are sent (in a single compressed stream)
+    and the install/uninstall scripts are only run if they changed. Also, runs the install
+    script if cluster-utils is not installed.
+
+    Parameters
+    -----------
+    force: bool, optional
+        Don't trust the local record of what was sent last time, ask the host for its manifest instead.
     """
-    host_config = get_hosts().get(host)
+    host_config = get_inventory().hosts.get(host)
 
     clu_dir = host_config["clusterutils_dir"]
 
-    subprocess.run(["ssh", host, f"if [ -f {clu_dir}/.installed ]; then {clu_dir}/uninstall > /dev/null; fi;"\
-        f"if [ -d {clu_dir} ]; then rm -r {clu_dir}/" + "{" + f"{','.join(_TOCOPY)}"+ ",scripts}" + f"; fi;"\
-        f"mkdir -p {clu_dir}/scripts"]
-    )
-    
-    cluster_utils_remote = get_mount_adress(host, mount_target=host_config["clusterutils_dir"])
-    # Copy files
-    subprocess.run(["scp", "-r", *[str(get_path(d)) for d in _TOCOPY], cluster_utils_remote])
-    # Copy scripts
-    subprocess.run(["scp", "-r", *[str(path) for dr in get_scripts_paths(host) for path in dr.glob("*")], cluster_utils_remote + "/scripts"])
+    with processes.phase("build manifest"):
+        tree = get_scripts_tree(host)
+        tree[_HOST_CONFIG] = build_host_config(host_config)
+        tree[_INDEX] = build_index(tree)
+        manifest = build_manifest(tree)
+
+    new_id = manifest_id(manifest)
+
+    # Even if the local record says that the host is up to date, the sync script runs to
+    # check it (it's a single round trip), since its directory may have been wiped or modified.
+    remote = None if force else _read_cached_manifest(host)
+
+    for attempt in range(2):
+        if remote is None:
+            remote = _fetch_remote_manifest(host, clu_dir)
+
+        full = remote is None
+        old = {} if full else remote["files"]
+
+        changed = [rel_path for rel_path, entry in manifest.items() if old.get(rel_path) != entry]
+        removed = [rel_path for rel_path in old if rel_path not in manifest]
+        reinstall = full or any(rel_path in ("install", "uninstall") for rel_path in changed)
+
+        tree_to_send = {**tree, _MANIFEST: json.dumps(manifest, sort_keys=True).encode(), _MANIFEST_ID: new_id.encode()}
+        to_send = [*changed, _MANIFEST, _MANIFEST_ID] if (changed or removed) else []
+
+        completed = processes.run(
+            ssh_command(host, _sync_script(clu_dir, None if full else remote["id"], removed, bool(to_send), reinstall, full)),
+            input=_tar_stream(tree_to_send, to_send) if to_send else None,
+        )
+
+        if completed.returncode == _STALE_EXIT_CODE:
+            # The host was not in the state we thought it was, ask it.
+            remote = None
+            continue
+        elif completed.returncode != 0:
+            print(f"(cluster-utils) Failed to sync the scripts in {host}.")
+            return False
+
+        if not to_send:
+            print(f"(cluster-utils) Scripts in {host} are up to date.")
+            return True
+
+        _write_cached_manifest(host, {"id": new_id, "files": manifest})
+        print(f"(cluster-utils) Scripts in {host}: {len(changed)} files updated, {len(removed)} removed.")
+        return True
+
+    print(f"(cluster-utils) The scripts in {host} changed while syncing them, try again.")
+    return False
+
+def _arguments_setup_host_scripts(subparser):
+    setup_host_scripts.argument_gen(subparser)
 
-    subprocess.run(["ssh", host, f"if [ ! -f {clu_dir}/.installed ]; then {clu_dir}/install; fi"])
+    subparser.add_argument("--force", action="store_true", help="Check the scripts present in the host instead"\
+        " of trusting the record of the last sync.")
 
 # def set_script(what, target, path, host=None, global_=False):
 #     """
@@ -69,6 +307,6 @@ def setup_host_scripts(host):
 #         " you pretend to share it with others by submitting a pull request to https://github.com/pfebrer/cluster-utils"
 #     )
 
-SubCommand(setup_host_scripts, setup_host_scripts.argument_gen, name="setuphostscripts")
+SubCommand(setup_host_scripts, _arguments_setup_host_scripts, name="setuphostscripts")
 # SubCommand(set_script, _arguments_setscript, name="setscript")
 
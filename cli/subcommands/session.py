@@ -0,0 +1,398 @@
+"""
+Python API of cluster-utils.
+
+A `Session` gives access to the hosts, mounts and connections from python code (scripts,
+notebooks...) without going through `clu`, and returns objects instead of printing. It is
+meant to be long-lived: the inventory is only parsed again if hosts.yaml changes and the
+master connections that it opens are kept until the session is closed.
+
+    import os, sys
+    sys.path.append(os.path.join(os.environ["CLUSTER_UTILS_ROOT"], "cli"))
+    from subcommands import Session
+
+    with Session() as session:
+        for host in session.hosts(group="siesta"):
+            print(host.name, session.run(host.name, "squeue -u $USER -h | wc -l").stdout)
+
+The modules that do the actual work are only imported when they are first needed, so that
+the commands that use a session (e.g. `clu lshosts`) stay fast.
+"""
+from collections import namedtuple
+import subprocess
+import time
+
+from .inventory import get_inventory, _as_list
+
+__all__ = ["Session", "Host", "Mount", "RemotePath"]
+
+# A path in a host, as returned by `Session.locate`
+RemotePath = namedtuple("RemotePath", ["host", "path"])
+
+class Host:
+    """
+    A host known by cluster-utils.
+
+    `config` is its configuration in hosts.yaml. It is a copy, so modifying it doesn't
+    change the inventory.
+    """
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+
+    @property
+    def groups(self):
+        return _as_list(self.config.get("groups"))
+
+    @property
+    def tags(self):
+        return _as_list(self.config.get("tags"))
+
+    @property
+    def jump_through(self):
+        return self.config.get("jump_through") or None
+
+    @property
+    def mount_point(self):
+        """Where the host is (or would be) mounted"""
+        from .mounting import get_mounts_dir
+
+        return get_mounts_dir() / self.name
+
+    def __repr__(self):
+        return f"Host({self.name!r})"
+
+class Mount:
+    """
+    The mountpoint of a host.
+
+    `state` is one of "healthy", "stale" (mounted, but not answering) or "unmounted".
+    """
+
+    def __init__(self, host, path, state, watched=False):
+        self.host = host
+        self.path = path
+        self.state = state
+        self.watched = watched
+
+    @property
+    def healthy(self):
+        from .mounting import HEALTHY
+
+        return self.state == HEALTHY
+
+    def __repr__(self):
+        return f"Mount({self.host!r}, {self.state!r}{', watched' if self.watched else ''})"
+
+class Session:
+    """
+    Entry point to use cluster-utils from python.
+
+    Parameters
+    -----------
+    status_ttl: float, optional
+        Seconds during which the state of all mountpoints (see `mounts`) is reused instead of
+        checking them again. It is checked again anyway if the mounted hosts change.
+    """
+
+    def __init__(self, status_ttl=0):
+        self.status_ttl = status_ttl
+        # Hosts for which this session started a master connection
+        self._connected = set()
+        # (time, mounted hosts, mounts) of the last check of all mountpoints
+        self._status = None
+
+    @property
+    def inventory(self):
+        """The parsed hosts.yaml. It is only parsed again if the file changed."""
+        return get_inventory()
+
+    # ---------------------------------------------
+    #                   Hosts
+    # ---------------------------------------------
+
+    def hosts(self, group=None, tag=None, via=None):
+        """
+        Gets the hosts known by cluster-utils.
+
+        Parameters
+        -----------
+        group: str or list of str, optional
+            Only hosts that belong to one of these groups.
+        tag: str or list of str, optional
+            Only hosts that have one of these tags.
+        via: str or list of str, optional
+            Only hosts that jump through one of these hosts.
+
+        Returns
+        ---------
+        list of Host
+        """
+        inventory = self.inventory
+        if group or tag or via:
+            names = inventory.select(groups=group, tags=tag, jump_through=via)
+        else:
+            names = list(inventory)
+
+        return [self.host(name) for name in names]
+
+    def host(self, name):
+        """Gets a host by its name, raises a KeyError if it is not known"""
+        hosts = self.inventory.hosts
+        if name not in hosts:
+            raise KeyError(f"'{name}' is not a host known by cluster-utils")
+
+        return Host(name, dict(hosts[name] or {}))
+
+    # ---------------------------------------------
+    #                   Mounts
+    # ---------------------------------------------
+
+    def mounted(self):
+        """
+        Gets the names of the hosts that are mounted.
+
+        It only reads the mount table, so it never blocks on a dead mount (but it
+        doesn't tell whether the mounts work, see `mounts` for that).
+        """
+        from .mounting import get_mounted
+
+        return get_mounted()
+
+    def mounts(self, hosts=None, timeout=None, refresh=False):
+        """
+        Checks the state of the mountpoints, without ever blocking on a dead mount.
+
+        Parameters
+        -----------
+        hosts: str or list of str, optional
+            The hosts to check. If not provided, all mountpoints are checked.
+        timeout: float, optional
+            Seconds that each mountpoint has to answer. Defaults to CLUSTER_UTILS_MOUNT_TIMEOUT (or 3).
+        refresh: bool, optional
+            Check them even if the last check is younger than `status_ttl`.
+
+        Returns
+        ---------
+        list of Mount
+        """
+        from .mounting import get_mount_status, get_mounted, get_mounts_dir, _read_watched
+
+        check_all = hosts is None and timeout is None
+        if check_all and not refresh and self._status is not None:
+            checked, mounted, mounts = self._status
+            if time.monotonic() - checked < self.status_ttl and mounted == get_mounted():
+                return mounts
+
+        watched = _read_watched()
+        status = get_mount_status(None if hosts is None else _as_list(hosts), timeout=timeout)
+        mounts = [Mount(host, get_mounts_dir() / host, state, watched=host in watched) for host, state in status.items()]
+
+        if check_all and self.status_ttl:
+            self._status = (time.monotonic(), get_mounted(), mounts)
+        return mounts
+
+    def mount(self, hosts, args=(), watch=False, jobs=None):
+        """
+        Mounts hosts into the mounts directory.
+
+        Parameters
+        -----------
+        hosts: str or list of str
+            The hosts to mount.
+        args: list of str, optional
+            Extra arguments for sshfs.
+        watch: bool, optional
+            Keep remounting the hosts in the background whenever their mount goes stale.
+        jobs: int, optional
+            Maximum number of hosts to mount at the same time.
+
+        Returns
+        ---------
+        list of Mount
+            The state of the mountpoints afterwards.
+        """
+        from .mounting import mount
+
+        hosts = _as_list(hosts)
+        mount(host=hosts, args=list(args), watch=watch, jobs=jobs)
+        return self.mounts(hosts)
+
+    def unmount(self, hosts, jobs=None):
+        """
+        Unmounts hosts.
+
+        Returns
+        ---------
+        list of Mount
+            The state of the mountpoints afterwards.
+        """
+        from .mounting import unmount
+
+        hosts = _as_list(hosts)
+        unmount(host=hosts, jobs=jobs)
+        return self.mounts(hosts)
+
+    def locate(self, path=""):
+        """
+        Given a local path inside a mountpoint, finds the host and the path in the host.
+
+        Parameters
+        -----------
+        path: str or Path, optional
+            The local path. Defaults to the current directory.
+
+        Returns
+        ---------
+        RemotePath
+            A (host, path) tuple. Raises a ValueError if the path is not inside the mounts directory.
+        """
+        from .mounting import get_host_from_path
+
+        return RemotePath(*get_host_from_path(path))
+
+    def local_path(self, host, remote_path):
+        """
+        The inverse of `locate`: the local path (inside the mountpoint) of a path in a host.
+
+        Returns None if the path is not inside the directory that is mounted.
+        """
+        from .mounting import get_local_path
+
+        return get_local_path(host, remote_path)
+
+    # ---------------------------------------------
+    #                Connections
+    # ---------------------------------------------
+
+    def connect(self, host):
+        """
+        Makes sure that there is a master connection to the host.
+
+        All the commands run by cluster-utils for this host (from this session or not) go
+        through it. Connections that the session opens are closed by `close`.
+
+        Returns
+        ---------
+        bool
+            Whether the connection is available.
+        """
+        from .connections import master_alive, open_master
+
+        if host in self._connected or master_alive(host):
+            return True
+
+        opened = open_master(host)
+        if opened:
+            self._connected.add(host)
+        return opened
+
+    def reachable(self, hosts=None, timeout=None, refresh=False):
+        """
+        Finds out which hosts are reachable, probing all of them at the same time.
+
+        Parameters
+        -----------
+        hosts: str or list of str, optional
+            The hosts to probe. Defaults to all the known hosts.
+        timeout: float, optional
+            Seconds that each host has to answer. Defaults to CLUSTER_UTILS_PROBE_TIMEOUT (or 3).
+        refresh: bool, optional
+            Probe them even if they were probed recently (see CLUSTER_UTILS_LIVENESS_TTL).
+
+        Returns
+        ---------
+        dict
+            The Liveness of each host, whose `reachable` attribute tells whether it is worth connecting to it.
+        """
+        from .liveness import probe
+
+        return probe(None if hosts is None else _as_list(hosts), timeout=timeout, refresh=refresh)
+
+    def run(self, host, command, input=None, timeout=None, check=False):
+        """
+        Runs a command in a host, through its master connection.
+
+        Parameters
+        -----------
+        host: str
+            The name of the host.
+        command: str
+            The command, it is interpreted by the shell of the host.
+        input: str, optional
+            What to send to the standard input of the command.
+        timeout: float, optional
+            Maximum number of seconds that the command can take.
+        check: bool, optional
+            Raise a CalledProcessError if the command fails.
+
+        Returns
+        ---------
+        subprocess.CompletedProcess
+            With the output of the command in `stdout` and `stderr` (as text).
+        """
+        from .connections import ssh_command
+        from . import processes
+
+        self.connect(host)
+        return processes.run(ssh_command(host, command), input=input, timeout=timeout, check=check,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=None if input is not None else subprocess.DEVNULL,
+            universal_newlines=True)
+
+    def setup_scripts(self, hosts, force=False, jobs=None, timeout=None):
+        """
+        Makes sure that the scripts on the hosts are updated.
+
+        Parameters
+        -----------
+        hosts: str or list of str
+            The hosts to update.
+        force: bool, optional
+            Don't trust the local record of what was sent last time, check the hosts instead.
+        jobs: int, optional
+            Maximum number of hosts to update at the same time.
+        timeout: float, optional
+            Maximum time (in seconds) that each host is given.
+
+        Returns
+        ---------
+        list of HostResult
+            The outcome for each host.
+        """
+        from .host_management import run_for_hosts
+        from .script_management import setup_host_scripts
+
+        hosts = _as_list(hosts)
+        for host in hosts:
+            self.connect(host)
+
+        return run_for_hosts(setup_host_scripts.__wrapped__, hosts,
+            jobs=setup_host_scripts.default_jobs if jobs is None else jobs, timeout=timeout, force=force)
+
+    def close(self):
+        """Closes the master connections that were opened by this session"""
+        from .connections import close_master
+
+        for host in sorted(self._connected):
+            close_master(host)
+        self._connected.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+_default_session = None
+
+def default_session():
+    """
+    The session that the commands of the CLI use.
+
+    Each call to `clu` gets a new one, but the daemon keeps the same one for all the commands that it serves.
+    """
+    global _default_session
+
+    if _default_session is None:
+        _default_session = Session()
+    return _default_session
@@ -0,0 +1,20 @@
+"""
+Helpers to show and parse sizes in bytes, in the same units that `ls -h` and `du -h` use.
+"""
+
+__all__ = []
+
+_UNITS = ("", "K", "M", "G", "T")
+
+def human_size(size):
+    """Formats a size in bytes, e.g. 1536 -> 1.5K"""
+    for unit in _UNITS:
+        if size < 1024 or unit == _UNITS[-1]:
+            return f"{size:.0f}{unit}" if unit == "" else f"{size:.1f}{unit}"
+        size /= 1024
+
+def parse_size(size):
+    """Converts sizes like 10M or 2G to bytes"""
+    units = {unit.lower(): 1 << (10 * i) for i, unit in enumerate(_UNITS) if unit}
+    factor = units.get(size[-1].lower(), 1)
+    return float(size[:-1] if size[-1].lower() in units else size) * factor
@@ -0,0 +1,354 @@
+"""
+Structured editing of the ssh config file (~/.ssh/config).
+
+The file is parsed into blocks (one per Host/Match line) that keep their lines verbatim,
+so that everything that cluster-utils doesn't touch is written back exactly as it was.
+The comments and empty lines right before a Host/Match line belong to its block (they
+usually introduce it), not to the block before it, except for the ones at the top of the file.
+Changes are accumulated in memory and the file is written once, atomically, when the
+outermost `editing` context exits. This allows commands that act on many hosts to
+write the file a single time.
+"""
+from contextlib import contextmanager
+import os
+from pathlib import Path
+import re
+import tempfile
+import threading
+
+from .processes import phase
+
+__all__ = []
+
+_HEADER_RE = re.compile(r"^(\s*)(host|match)(\s*=\s*|\s+)(.*?)\s*$", re.IGNORECASE)
+_PATTERN_RE = re.compile(r'"[^"]*"|\S+')
+_KEY_RE = re.compile(r"[\s=]")
+
+def get_ssh_config_path():
+    return Path("~/.ssh/config").expanduser()
+
+def _is_filler(line):
+    """Whether a line is empty or a comment"""
+    return line.strip() == "" or line.lstrip().startswith("#")
+
+def _option_key(line):
+    """The (lowercase) keyword of an option line, None for empty lines and comments"""
+    if _is_filler(line):
+        return None
+    return _KEY_RE.split(line.strip(), 1)[0].lower()
+
+class _Block:
+    """
+    A piece of the ssh config file.
+
+    The first block of the file (before any Host or Match line) has no header. In the
+    others, `header` is the index of the Host/Match line (the lines before it are the
+    comments and empty lines that precede it).
+    """
+
+    def __init__(self, lines, keyword=None, patterns=(), header=0):
+        self.lines = lines
+        self.keyword = keyword
+        self.patterns = list(patterns)
+        self.header = header
+
+    @property
+    def is_host(self):
+        return self.keyword is not None and self.keyword.lower() == "host"
+
+    def _body_end(self, comments=True):
+        """Index where the trailing empty lines (and comments) of the block start"""
+        start = self.header + 1 if self.keyword is not None else 0
+        is_trailing = _is_filler if comments else (lambda line: line.strip() == "")
+        end = len(self.lines)
+        while end > start and is_trailing(self.lines[end - 1]):
+            end -= 1
+        return end
+
+    def split_trailing(self, comments=True):
+        """Removes the trailing empty lines (and comments) from the block and returns them"""
+        end = self._body_end(comments)
+        trailing = self.lines[end:]
+        del self.lines[end:]
+        return trailing
+
+    def set_patterns(self, patterns):
+        """Rewrites the header of the block, keeping its indentation and keyword"""
+        indent, keyword, sep, _ = _HEADER_RE.match(self.lines[self.header]).groups()
+        self.lines[self.header] = f"{indent}{keyword}{sep}{' '.join(patterns)}"
+        self.patterns = list(patterns)
+
+    def set_options(self, options, managed=()):
+        """
+        Sets the values of some options, keeping all the other lines of the block.
+
+        Parameters
+        -----------
+        options: list of tuples
+            (key, value) pairs. Options that are already in the block are replaced where they
+            are, the rest are added after the last option.
+        managed: list of str, optional
+            Other keys whose lines are removed if they are not in `options`.
+
+        Returns
+        ---------
+        list of str
+            The new lines of the block.
+        """
+        pending = {key.lower(): (key, value) for key, value in options}
+        managed = {key.lower() for key in managed} | set(pending)
+
+        start, end = self.header + 1, self._body_end()
+        lines = self.lines[:start]
+        for line in self.lines[start:end]:
+            key = _option_key(line)
+            if key not in managed:
+                lines.append(line)
+            elif key in pending:
+                # Replace the first occurrence (which is the one ssh uses), drop the others
+                indent = line[:len(line) - len(line.lstrip())]
+                lines.append(f"{indent}{' '.join(pending.pop(key))}")
+
+        lines += [f" {key} {value}" for key, value in pending.values()]
+        return lines + self.lines[end:]
+
+class SSHConfig:
+    """
+    Parsed ssh config file.
+
+    Parameters
+    -----------
+    text: str, optional
+        The contents of the file.
+    """
+
+    def __init__(self, text=""):
+        self._lock = threading.RLock()
+        self.blocks = self._parse(text)
+        self.modified = False
+
+    @classmethod
+    def read(cls, path=None):
+        path = Path(path or get_ssh_config_path()).expanduser()
+        with phase("read ssh config"):
+            try:
+                return cls(path.read_text())
+            except FileNotFoundError:
+                return cls()
+
+    @staticmethod
+    def _parse(text):
+        blocks = [_Block([])]
+        for line in text.splitlines():
+            match = _HEADER_RE.match(line)
+            if match and not line.lstrip().startswith("#"):
+                patterns = [p.strip('"') for p in _PATTERN_RE.findall(match.group(4))]
+                # The comments at the top of the file stay there, even if they are right before a Host line
+                leading = blocks[-1].split_trailing(comments=blocks[-1].keyword is not None)
+                blocks.append(_Block([*leading, line], keyword=match.group(2), patterns=patterns, header=len(leading)))
+            else:
+                blocks[-1].lines.append(line)
+        return blocks
+
+    def __str__(self):
+        lines = [line for block in self.blocks for line in block.lines]
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def host_blocks(self, host):
+        """All the Host blocks that explicitly list this host"""
+        return [block for block in self.blocks if block.is_host and host in block.patterns]
+
+    @property
+    def hosts(self):
+        """Index {host: [blocks]} of all the hosts that appear in Host lines"""
+        index = {}
+        for block in self.blocks:
+            if block.is_host:
+                for pattern in block.patterns:
+                    index.setdefault(pattern, []).append(block)
+        return index
+
+    def set_host(self, host, options, managed=()):
+        """
+        Adds or updates the block of a host.
+
+        If there is a block dedicated to this host (Host line with only this host), the options
+        are updated there and the rest of its lines (other options, comments) are kept. Otherwise,
+        a new block is added at the end.
+
+        Parameters
+        -----------
+        host: str
+            The name of the host.
+        options: list of tuples
+            (key, value) pairs with the options for the host (e.g. ("User", "me")).
+        managed: list of str, optional
+            Other keys that belong to whoever calls this, which are removed from the block of
+            the host if they are not in `options` (e.g. a ProxyJump that is not needed anymore).
+        """
+        with self._lock:
+            dedicated = [block for block in self.host_blocks(host) if block.patterns == [host]]
+            if dedicated:
+                block = dedicated[0]
+                new_lines = block.set_options(options, managed)
+                if new_lines != block.lines:
+                    block.lines = new_lines
+                    self.modified = True
+                return
+
+            last = self.blocks[-1]
+            last.lines = _rstrip_lines(last.lines)
+            leading = [""] if any(block.lines for block in self.blocks) else []
+            body = [f" {key} {value}" for key, value in options]
+            self.blocks.append(_Block([*leading, f"Host {host}", *body], keyword="Host", patterns=[host],
+                header=len(leading)))
+            self.modified = True
+
+    def remove_host(self, host):
+        """
+        Removes a host from the config.
+
+        Blocks that only apply to this host are removed, while in blocks that are shared
+        with other hosts, only the host is removed from the Host line.
+
+        Returns
+        ---------
+        bool
+            Whether the host was found.
+        """
+        with self._lock:
+            blocks = self.host_blocks(host)
+            for block in blocks:
+                remaining = [p for p in block.patterns if p != host]
+                if remaining:
+                    block.set_patterns(remaining)
+                else:
+                    was_last = block is self.blocks[-1]
+                    self.blocks.remove(block)
+                    if was_last:
+                        # Don't leave the separation that was added for the removed block
+                        self.blocks[-1].lines = _rstrip_lines(self.blocks[-1].lines)
+            if blocks:
+                self.modified = True
+            return bool(blocks)
+
+    def snapshot(self, host):
+        """Saves the state of the blocks that list the host, so that changes to it can be undone with `restore`"""
+        with self._lock:
+            return [(self.blocks.index(block), block, list(block.lines), list(block.patterns))
+                for block in self.host_blocks(host)]
+
+    def restore(self, host, snapshot):
+        """Undoes the changes made to the blocks of the host since the snapshot was taken"""
+        with self._lock:
+            saved = [block for _, block, _, _ in snapshot]
+            for block in self.host_blocks(host):
+                if block not in saved:
+                    self.blocks.remove(block)
+                    self.modified = True
+
+            for index, block, lines, patterns in snapshot:
+                if block not in self.blocks:
+                    self.blocks.insert(min(index, len(self.blocks)), block)
+                elif block.lines == lines and block.patterns == patterns:
+                    continue
+                block.lines, block.patterns = lines, patterns
+                self.modified = True
+
+    def write(self, path=None):
+        """Writes the config atomically (to a temporary file that then replaces the original one)"""
+        path = Path(path or get_ssh_config_path()).expanduser()
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+        with self._lock, phase("write ssh config"):
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write(str(self))
+                os.chmod(tmp_path, path.stat().st_mode & 0o777 if path.exists() else 0o600)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self.modified = False
+
+def _rstrip_lines(lines):
+    lines = list(lines)
+    while lines and lines[-1].strip() == "":
+        lines.pop()
+    return lines
+
+_open_configs = {}
+_open_lock = threading.Lock()
+
+@contextmanager
+def _open(path, load):
+    path = Path(path or get_ssh_config_path()).expanduser()
+
+    with _open_lock:
+        entry = _open_configs.get(path)
+        if entry is None:
+            # [config, number of users, whether something failed]
+            entry = _open_configs[path] = [None, 0, False]
+        entry[1] += 1
+
+    try:
+        if load:
+            with _open_lock:
+                if entry[0] is None:
+                    entry[0] = SSHConfig.read(path)
+        yield entry[0]
+    except BaseException:
+        # Only an exception that leaves the last user cancels the write (see inventory._open_registry)
+        with _open_lock:
+            if entry[1] == 1:
+                entry[2] = True
+        raise
+    finally:
+        with _open_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _open_configs[path]
+                if not entry[2] and entry[0] is not None and entry[0].modified:
+                    entry[0].write(path)
+
+@contextmanager
+def editing(path=None):
+    """
+    Gives access to the parsed ssh config to modify it.
+
+    Nested (or concurrent) uses for the same file share the same SSHConfig object,
+    and the file is only written when the last of them exits (and only if something
+    changed).
+
+    Parameters
+    -----------
+    path: str or Path, optional
+        The path to the ssh config file. Defaults to ~/.ssh/config.
+    """
+    with _open(path, load=True) as config:
+        yield config
+
+@contextmanager
+def batch(path=None):
+    """
+    Groups all the edits done inside it, so that the ssh config is written only once at the end.
+
+    The file is not read unless something inside the batch edits it. If an exception leaves
+    the batch, nothing is written (exceptions handled inside it don't prevent the write).
+    """
+    with _open(path, load=False):
+        yield
+
+def flush(path=None):
+    """
+    Writes the pending changes of an open batch now.
+
+    Useful when the changes need to be visible to ssh before the batch finishes.
+    """
+    path = Path(path or get_ssh_config_path()).expanduser()
+
+    with _open_lock:
+        entry = _open_configs.get(path)
+        if entry is not None and entry[0] is not None and entry[0].modified:
+            entry[0].write(path)
@@ -6,6 +6,8 @@ class SubCommand:
     def __init__(self, function, add_arguments=None, **kwargs):
 
         self.name = kwargs.pop("name", function.__name__)
+        # Whether the daemon can run it (see the `daemon` module)
+        self.served = kwargs.pop("served", False)
         self.__class__._all[self.name] = self
 
         self.function = function
@@ -0,0 +1,518 @@
+"""
+Keeping a directory of a host up to date with a local working copy (`clu watch`).
+
+Editing directly on the mount is slow with editors that fsync and stat a lot. Instead, files are
+edited locally and `clu watch` pushes them as soon as they change:
+    - Changes are detected with inotify (on linux, through ctypes) or, if it is not available,
+    by scanning the directory periodically.
+    - Changes are debounced, so that a burst of writes (e.g. an editor saving, a `git checkout`)
+    is pushed at once.
+    - The changed files are sent as tar batches to a single process in the host, which is started
+    once (through the master connection) and acknowledges each batch after extracting it.
+When it starts, the files that differ from the ones in the host (by size and modification time)
+are pushed, so the host is up to date even with what changed while nobody was watching.
+"""
+from contextlib import contextmanager
+from fnmatch import fnmatch
+import os
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+from .inventory import get_inventory
+from .mounting import get_host_from_path
+from .sizes import human_size
+from .subcommand import SubCommand
+from .transfer import _list_remote, _plan
+from .connections import ssh_command, quote_remote_path
+from . import processes
+
+__all__ = ["watch"]
+
+# Seconds without changes before the pending changes are pushed
+DEFAULT_DEBOUNCE = 0.5
+# Seconds between scans of the directory, when inotify can't be used
+DEFAULT_INTERVAL = 1
+# Changes are never held for longer than this (in seconds), even if more keep coming
+_MAX_DELAY = 5
+# Maximum size of each batch, in bytes (larger files are sent alone)
+_BATCH_SIZE = 32 << 20
+# Maximum number of seconds between reconnection attempts
+_MAX_BACKOFF = 30
+# Files that are never pushed (editor swap files, caches...)
+DEFAULT_IGNORE = [".git", "__pycache__", ".ipynb_checkpoints", "*.swp", "*.swx", "*~", ".#*", "4913", "*.clu-part"]
+
+# Runs in the host. Reads frames "<kind> <size>\n" followed by <size> bytes: a tar archive ("T")
+# or NUL separated paths to remove ("D"), and answers OK or FAILED to each one.
+_RECEIVER_SCRIPT = r"""
+tmp=$(mktemp) || exit 1
+trap 'rm -f "$tmp"' EXIT
+echo READY
+while read -r kind size; do
+    head -c "$size" > "$tmp"
+    [ "$(wc -c < "$tmp")" -eq "$size" ] || exit 1
+    case "$kind" in
+        T) tar xf "$tmp" ;;
+        D) xargs -0 -r rm -rf -- < "$tmp" ;;
+        *) exit 1 ;;
+    esac && echo OK || echo FAILED
+done
+"""
+
+def _ignored(rel, patterns):
+    """Whether a path (relative to the watched directory) matches any of the patterns, or is inside a directory that does"""
+    return any(fnmatch(rel, pattern) or any(fnmatch(part, pattern) for part in rel.split("/")) for pattern in patterns)
+
+def _entry(path):
+    """Same information as the entries of `transfer._list_local`, None if the path doesn't exist (anymore)"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    type_ = "l" if os.path.islink(path) else "d" if os.path.isdir(path) else "f" if os.path.isfile(path) else None
+    if type_ is None:
+        return None
+    return {"type": type_, "size": st.st_size if type_ == "f" else 0, "mtime": st.st_mtime, "mode": st.st_mode & 0o7777}
+
+def _scan(local_dir, ignore, rel_dir=""):
+    """Entries under a directory, without going into the ignored ones"""
+    entries = {}
+    for dirpath, dirnames, filenames in os.walk(os.path.join(local_dir, rel_dir)):
+        rel_path = os.path.relpath(dirpath, local_dir).replace(os.sep, "/")
+        rel_path = "" if rel_path == "." else rel_path
+        dirnames[:] = [name for name in dirnames if not _ignored(f"{rel_path}/{name}".lstrip("/"), ignore)]
+        for name in (*dirnames, *filenames):
+            rel = f"{rel_path}/{name}".lstrip("/")
+            entry = _entry(os.path.join(dirpath, name))
+            if entry is not None and not _ignored(rel, ignore):
+                entries[rel] = entry
+    return entries
+
+class _PollingWatcher:
+    """Finds out what changed by scanning the directory every `interval` seconds"""
+
+    def __init__(self, local_dir, ignore, interval=DEFAULT_INTERVAL):
+        self.local_dir, self.ignore, self.interval = local_dir, ignore, interval
+        self._snapshot = _scan(local_dir, ignore)
+        self._last_scan = time.monotonic()
+
+    def changes(self, timeout):
+        """
+        Waits (at most `timeout` seconds) for changes.
+
+        Returns
+        ---------
+        dict or None
+            {path: whether it exists} for the paths that changed. None if changes could have been missed.
+        """
+        time.sleep(max(0, min(timeout, self._last_scan + self.interval - time.monotonic())))
+        if time.monotonic() - self._last_scan < self.interval:
+            return {}
+
+        snapshot = _scan(self.local_dir, self.ignore)
+        self._last_scan = time.monotonic()
+        changes = {rel: True for rel, entry in snapshot.items() if self._snapshot.get(rel) != entry}
+        changes.update({rel: False for rel in self._snapshot if rel not in snapshot})
+        self._snapshot = snapshot
+        return changes
+
+    def close(self):
+        pass
+
+class _InotifyWatcher:
+    """Finds out what changed from the events of inotify (linux only), with a watch for each directory"""
+
+    _IN_ATTRIB, _IN_CLOSE_WRITE = 0x4, 0x8
+    _IN_MOVED_FROM, _IN_MOVED_TO, _IN_CREATE, _IN_DELETE = 0x40, 0x80, 0x100, 0x200
+    _IN_Q_OVERFLOW, _IN_IGNORED, _IN_ONLYDIR, _IN_ISDIR = 0x4000, 0x8000, 0x01000000, 0x40000000
+    _MASK = _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_ONLYDIR
+
+    def __init__(self, local_dir, ignore):
+        import ctypes
+
+        self.local_dir, self.ignore = local_dir, ignore
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # {watch descriptor: directory relative to local_dir}
+        self._dirs = {}
+        self._add_tree("")
+
+    def _add_watch(self, rel_dir):
+        import ctypes
+
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(os.path.join(self.local_dir, rel_dir)), self._MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if errno == 28:
+                raise OSError(errno, "Too many directories to watch (see /proc/sys/fs/inotify/max_user_watches)")
+            # The directory disappeared in the meantime
+            return
+        self._dirs[wd] = rel_dir
+
+    def _add_tree(self, rel_dir):
+        """Watches a directory and all the ones inside it, returns the entries found in it"""
+        self._add_watch(rel_dir)
+        entries = _scan(self.local_dir, self.ignore, rel_dir)
+        for rel, entry in entries.items():
+            if entry["type"] == "d":
+                self._add_watch(rel)
+        return entries
+
+    def changes(self, timeout):
+        """Same as `_PollingWatcher.changes`"""
+        import select
+        import struct
+
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return {}
+
+        changes = {}
+        try:
+            data = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return changes
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = os.fsdecode(data[offset + 16: offset + 16 + length].rstrip(b"\0"))
+            offset += 16 + length
+
+            if mask & self._IN_Q_OVERFLOW:
+                return None
+            if mask & self._IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            if wd not in self._dirs or not name:
+                continue
+
+            rel = f"{self._dirs[wd]}/{name}".lstrip("/")
+            if _ignored(rel, self.ignore):
+                continue
+
+            if mask & (self._IN_DELETE | self._IN_MOVED_FROM):
+                changes[rel] = False
+            elif mask & self._IN_ISDIR and mask & (self._IN_CREATE | self._IN_MOVED_TO):
+                # Things may have been created inside before we started watching it
+                changes[rel] = True
+                changes.update({path: True for path in self._add_tree(rel)})
+            else:
+                changes[rel] = True
+
+        return changes
+
+    def close(self):
+        os.close(self._fd)
+
+class _Receiver:
+    """The process in the host that receives the batches, through a single ssh session"""
+
+    def __init__(self, host, remote_dir):
+        self.host, self.remote_dir = host, remote_dir
+        self._process = None
+
+    def _start(self):
+        script = f"mkdir -p {quote_remote_path(self.remote_dir)} && cd {quote_remote_path(self.remote_dir)} &&"\
+            f" bash -c {shlex.quote(_RECEIVER_SCRIPT)}"
+        self._process = processes.Popen(ssh_command(self.host, script,
+            options=["-o", "ServerAliveInterval=15", "-o", "ServerAliveCountMax=3"]),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        if self._process.stdout.readline() != b"READY\n":
+            self.close()
+            raise ConnectionError(f"could not start the receiver in {self.host}")
+
+    def send(self, kind, data, size=None):
+        """
+        Sends a frame and waits for the host to process it.
+
+        `data` is either bytes or a file, which is streamed from its current position (then `size` must be given).
+
+        Raises ConnectionError if the connection dropped (the frame should be sent again).
+        Returns whether the host could process it.
+        """
+        if self._process is None or self._process.poll() is not None:
+            self._start()
+
+        if size is None:
+            size = len(data)
+        try:
+            self._process.stdin.write(f"{kind} {size}\n".encode())
+            if isinstance(data, bytes):
+                self._process.stdin.write(data)
+            else:
+                shutil.copyfileobj(data, self._process.stdin)
+            self._process.stdin.flush()
+            answer = self._process.stdout.readline()
+        except OSError as e:
+            self.close()
+            raise ConnectionError(str(e))
+
+        if answer not in (b"OK\n", b"FAILED\n"):
+            self.close()
+            raise ConnectionError(f"lost the connection to {self.host}")
+
+        processes.record_bytes(sent=size, host=self.host)
+        return answer == b"OK\n"
+
+    def close(self):
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+            try:
+                self._process.wait(5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+            self._process = None
+
+def _batches(local_dir, rels):
+    """Groups the paths in batches of (at most, unless a file is larger) _BATCH_SIZE bytes"""
+    batch, size = [], 0
+    for rel in sorted(rels):
+        entry = _entry(os.path.join(local_dir, rel))
+        if entry is None:
+            continue
+        if batch and size + entry["size"] > _BATCH_SIZE:
+            yield batch
+            batch, size = [], 0
+        batch.append(rel)
+        size += entry["size"]
+    if batch:
+        yield batch
+
+@contextmanager
+def _tar(local_dir, rels):
+    """
+    A tar archive with the paths (the ones that vanished in the meantime are skipped).
+
+    Yields the temporary file where it was written (positioned at the start) and its size.
+    """
+    with tempfile.TemporaryFile() as f:
+        with tarfile.open(fileobj=f, mode="w") as tar:
+            for rel in rels:
+                try:
+                    tar.add(os.path.join(local_dir, rel), arcname=rel, recursive=False)
+                except OSError:
+                    pass
+        size = f.tell()
+        f.seek(0)
+        yield f, size
+
+def _parse_target(target):
+    """Host and remote directory of a target, given as HOST:DIR or as a directory inside the mounts"""
+    host, sep, remote_dir = target.partition(":")
+    if sep and host in get_inventory().hosts:
+        return host, remote_dir
+
+    host, remote_dir = get_host_from_path(target)
+    return host, str(remote_dir)
+
+class _Status:
+    """The status line: rewritten in place if stdout is a terminal, one line per push otherwise"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.tty = sys.stdout.isatty()
+        self._last = ""
+
+    def show(self, message, persistent=False):
+        line = f"(cluster-utils) {self.prefix} | {message}"
+        if self.tty:
+            sys.stdout.write(f"\r\033[K{line}")
+            if persistent:
+                sys.stdout.write("\n")
+        elif persistent and line != self._last:
+            sys.stdout.write(f"{line}\n")
+        self._last = line
+        sys.stdout.flush()
+
+def watch(local_dir, target, ignore=None, delete=False, debounce=DEFAULT_DEBOUNCE, poll=False, interval=DEFAULT_INTERVAL,
+    once=False):
+    """
+    Pushes the changes of a local directory to a directory of a host, as soon as they happen.
+
+    Parameters
+    -----------
+    local_dir: str
+        The local directory.
+    target: str
+        The directory of the host, as HOST:DIR (relative to the home directory if it is not
+        absolute) or as a path inside the mounts.
+    ignore: list of str, optional
+        Patterns (as understood by fnmatch) of the files and directories that shouldn't be pushed,
+        besides the default ones (DEFAULT_IGNORE). Patterns are matched with the relative path and
+        with each of its components.
+    delete: bool, optional
+        Also remove from the host the files that are removed locally while watching. Files
+        are never removed from the host when the watch starts.
+    debounce: float, optional
+        Seconds without changes before pushing them.
+    poll: bool, optional
+        Scan the directory periodically instead of using inotify.
+    interval: float, optional
+        Seconds between scans of the directory, when polling.
+    once: bool, optional
+        Just push what differs and exit, without watching.
+    """
+    local_dir = os.path.realpath(local_dir)
+    if not os.path.isdir(local_dir):
+        raise ValueError(f"{local_dir} is not a directory")
+    host, remote_dir = _parse_target(target)
+    ignore = [*DEFAULT_IGNORE, *(ignore or [])]
+
+    receiver = _Receiver(host, remote_dir)
+    status = _Status(f"{local_dir} -> {host}:{remote_dir or '~'}")
+    # {path: whether it exists} of the changes that haven't been pushed yet
+    pending = {}
+
+    def resync():
+        """Marks as pending everything that differs from the host"""
+        with processes.phase("compare"):
+            remote = _list_remote(host, remote_dir, ["."])
+            local = _scan(local_dir, ignore)
+            to_send, _ = _plan(local, remote, False, None, None)
+        pending.update({rel: True for rel in to_send})
+
+    def pending_bytes():
+        return sum((_entry(os.path.join(local_dir, rel)) or {"size": 0})["size"] for rel, exists in pending.items() if exists)
+
+    def push():
+        """Pushes the pending changes. Raises ConnectionError if the connection dropped (what is left stays pending)."""
+        removed = [rel for rel, exists in pending.items() if not exists]
+        if removed and delete:
+            if not receiver.send("D", "\0".join(removed).encode(errors="surrogateescape")):
+                status.show(f"could not remove {len(removed)} files in the host", persistent=True)
+        for rel in removed:
+            pending.pop(rel, None)
+
+        files, size = 0, 0
+        for batch in _batches(local_dir, [rel for rel, exists in pending.items() if exists]):
+            with _tar(local_dir, batch) as (archive, archive_size):
+                ok = receiver.send("T", archive, archive_size)
+            for rel in batch:
+                pending.pop(rel, None)
+            if not ok:
+                status.show(f"the host could not extract {len(batch)} files", persistent=True)
+                continue
+            files += len(batch)
+            size += archive_size
+
+        # Paths that vanished before they could be pushed
+        for rel in [rel for rel, exists in pending.items() if exists and _entry(os.path.join(local_dir, rel)) is None]:
+            pending.pop(rel)
+
+        status.show(f"{time.strftime('%H:%M:%S')} pushed {files} files ({human_size(size)})"\
+            f"{f', removed {len(removed)}' if removed and delete else ''}", persistent=True)
+
+    # Being terminated is handled like Ctrl+C: what is pending is pushed before exiting
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    watcher = None
+    backoff, retry_at = 1, 0
+    first_change = last_change = None
+    try:
+        if not once:
+            # Started before comparing with the host, so that nothing that changes meanwhile is missed
+            try:
+                watcher = _PollingWatcher(local_dir, ignore, interval) if poll else _InotifyWatcher(local_dir, ignore)
+            except (OSError, AttributeError) as e:
+                print(f"(cluster-utils) Can't use inotify ({e}), scanning the directory every {interval}s instead.")
+                watcher = _PollingWatcher(local_dir, ignore, interval)
+        # Whether `pending` has everything that differs from the host (it can't be compared while it is unreachable)
+        compared = False
+
+        while True:
+            if not compared and time.monotonic() >= retry_at:
+                try:
+                    resync()
+                except ConnectionError as e:
+                    if once:
+                        status.show(f"{e}, nothing was pushed", persistent=True)
+                        return False
+                    status.show(f"{e}, trying again in {backoff}s", persistent=True)
+                    retry_at = time.monotonic() + backoff
+                    backoff = min(2 * backoff, _MAX_BACKOFF)
+                else:
+                    compared, backoff = True, 1
+                    if pending:
+                        last_change = time.monotonic()
+                        first_change = first_change or last_change
+                    else:
+                        status.show("up to date", persistent=True)
+
+            now = time.monotonic()
+            due = compared and pending and now >= retry_at and (once or now - last_change >= debounce or now - first_change >= _MAX_DELAY)
+            if due:
+                try:
+                    push()
+                    backoff = 1
+                    first_change = last_change = None
+                except ConnectionError as e:
+                    if once:
+                        status.show(f"{e}, {len(pending)} changes were not pushed", persistent=True)
+                        return False
+                    status.show(f"{e}, trying again in {backoff}s ({len(pending)} pending, {human_size(pending_bytes())})",
+                        persistent=True)
+                    retry_at = time.monotonic() + backoff
+                    backoff = min(2 * backoff, _MAX_BACKOFF)
+
+            if once:
+                if compared and not pending:
+                    return True
+                time.sleep(max(0, retry_at - time.monotonic()))
+                continue
+
+            changes = watcher.changes(debounce if pending else 1)
+            if changes is None:
+                status.show("some changes may have been missed, comparing with the host again", persistent=True)
+                compared, changes = False, {}
+            if changes:
+                pending.update(changes)
+                last_change = time.monotonic()
+                first_change = first_change or last_change
+            if pending:
+                status.show(f"{len(pending)} pending ({human_size(pending_bytes())})")
+    except KeyboardInterrupt:
+        if pending:
+            try:
+                push()
+            except (ConnectionError, KeyboardInterrupt):
+                pass
+        if pending:
+            print(f"\n(cluster-utils) Stopped with {len(pending)} changes that were not pushed.")
+    finally:
+        if watcher is not None:
+            watcher.close()
+        receiver.close()
+
+def _arguments_watch(subparser):
+    subparser.add_argument("local_dir", help="The local directory to watch.")
+
+    subparser.add_argument("target", help="Where to push the changes: HOST:DIR (DIR is relative to the home directory"\
+        " if it is not absolute) or a directory inside the mounts.")
+
+    subparser.add_argument("-i", "--ignore", action="append", help="Don't push files or directories that match this"\
+        f" pattern (e.g. '*.out', 'runs'). Can be repeated. Always ignored: {' '.join(DEFAULT_IGNORE)}")
+
+    subparser.add_argument("--delete", action="store_true", help="Also remove from the host the files that are"\
+        " removed locally while watching.")
+
+    subparser.add_argument("--debounce", type=float, default=DEFAULT_DEBOUNCE,
+        help="Seconds without changes before pushing them.")
+
+    subparser.add_argument("--poll", action="store_true", help="Scan the directory periodically instead of using inotify"\
+        " (e.g. if it is on a network filesystem).")
+    subparser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL,
+        help="Seconds between scans of the directory, when polling.")
+
+    subparser.add_argument("--once", action="store_true", help="Push what differs and exit, without watching.")
+
+SubCommand(watch, _arguments_watch)
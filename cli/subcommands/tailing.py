@@ -0,0 +1,317 @@
+"""
+Reading (and following) files of the hosts without going through the mounts.
+
+Following a file through sshfs means polling it over FUSE, which is laggy, keeps the mount busy
+and hangs when the mount goes stale. Instead, for each host we start a single process in the host
+(through the master connection) that watches all the requested files of that host, and sends
+whatever is appended to them as frames:
+
+    O <index> <offset>            Position where the file starts being read.
+    D <index> <offset> <size>     Followed by <size> bytes of the file, starting at <offset>.
+    T <index>                     The file was truncated, it is read again from the start.
+    X <index>                     The file doesn't exist (yet).
+    F <index>                     There is nothing more to read from this file (only without --follow).
+
+Since we know the offset of each file, if the connection drops we reconnect and resume from there.
+"""
+import queue
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+from .mounting import get_host_from_path
+from .subcommand import SubCommand
+from .connections import ssh_command, quote_remote_path
+from . import processes
+
+__all__ = ["tail", "cat"]
+
+DEFAULT_LINES = 10
+# Seconds between checks of the files in the host
+DEFAULT_INTERVAL = 1
+# Maximum size of a frame, so that a big file doesn't keep the others waiting
+_CHUNK_SIZE = 1 << 20
+# Maximum number of seconds between reconnection attempts
+_MAX_BACKOFF = 30
+# Reconnection attempts before giving up, when not following the files
+_RETRIES = 3
+
+# Runs in the host. Arguments: follow (0/1), interval, lines, and then "offset path" for each file.
+# An offset of -1 means "start at the last <lines> lines".
+_STREAM_SCRIPT = r"""
+follow=$1; interval=$2; lines=$3; shift 3
+tmp=$(mktemp) || exit 1
+trap 'rm -f "$tmp"' EXIT
+n=0
+while [ $# -gt 0 ]; do offsets[n]=$1; files[n]=$2; missing[n]=0; n=$((n + 1)); shift 2; done
+
+send(){
+    local i=$1 size=$2 o=${offsets[$1]} chunk
+    while [ "$size" -gt "$o" ]; do
+        chunk=$((size - o)); [ "$chunk" -gt %(chunk)d ] && chunk=%(chunk)d
+        tail -c +$((o + 1)) "${files[i]}" | head -c "$chunk" > "$tmp"
+        chunk=$(wc -c < "$tmp")
+        [ "$chunk" -gt 0 ] || break
+        echo "D $i $o $chunk"; cat "$tmp"
+        o=$((o + chunk))
+    done
+    offsets[i]=$o
+}
+
+while true; do
+    for ((i = 0; i < n; i++)); do
+        if [ ! -f "${files[i]}" ]; then
+            [ "${missing[i]}" = 1 ] || echo "X $i"
+            missing[i]=1
+            [ "$follow" = 1 ] || echo "F $i"
+            continue
+        fi
+        missing[i]=0
+        size=$(wc -c < "${files[i]}")
+        if [ "${offsets[i]}" -lt 0 ]; then
+            offsets[i]=$((size - $(tail -n "$lines" "${files[i]}" | wc -c)))
+            echo "O $i ${offsets[i]}"
+        elif [ "$size" -lt "${offsets[i]}" ]; then
+            echo "T $i"; offsets[i]=0
+        fi
+        send $i $size
+        [ "$follow" = 1 ] || echo "F $i"
+    done
+    [ "$follow" = 1 ] || exit 0
+    sleep "$interval"
+done
+""" % {"chunk": _CHUNK_SIZE}
+
+def _stream_command(files, offsets, follow, interval, lines):
+    args = " ".join(f"{offset} {quote_remote_path(path)}" for path, offset in zip(files, offsets))
+    return f"bash -c {shlex.quote(_STREAM_SCRIPT)} clu-tail {int(follow)} {interval} {lines} {args}"
+
+def _read_frames(stream):
+    """Parses the frames sent by _STREAM_SCRIPT, yields (kind, index, offset, data)"""
+    while True:
+        header = stream.readline()
+        if not header.endswith(b"\n"):
+            return
+        kind, index, *numbers = header.decode().split()
+        offset = int(numbers[0]) if numbers else None
+        data = b""
+        if kind == "D":
+            data = stream.read(int(numbers[1]))
+            if len(data) < int(numbers[1]):
+                return
+        yield kind, int(index), offset, data
+
+def _stream_host(host, files, events, follow, interval, lines):
+    """
+    Streams the files of a host, reconnecting whenever the connection drops.
+
+    All that happens is put in the `events` queue as (global index, kind, data) tuples.
+
+    Parameters
+    -----------
+    files: list of tuple
+        (global index, remote path, initial offset) for each file of this host.
+    """
+    offsets = {index: offset for index, _, offset in files}
+    finished = set()
+    backoff, retries = 1, 0
+
+    while True:
+        pending = [(index, path) for index, path, _ in files if index not in finished]
+        process = processes.Popen(
+            ssh_command(host, _stream_command([path for _, path in pending], [offsets[index] for index, _ in pending],
+                follow, interval, lines), options=["-o", "ServerAliveInterval=15", "-o", "ServerAliveCountMax=3"]),
+            stdout=subprocess.PIPE, stdin=subprocess.DEVNULL,
+        )
+        received = False
+        for kind, local_index, offset, data in _read_frames(process.stdout):
+            received = True
+            index = pending[local_index][0]
+            if kind == "D":
+                offsets[index] = offset + len(data)
+                processes.record_bytes(received=len(data), host=host)
+                events.put((index, "data", data))
+                backoff, retries = 1, 0
+            elif kind == "O":
+                offsets[index] = offset
+            elif kind == "T":
+                offsets[index] = 0
+                events.put((index, "truncated", None))
+            elif kind == "X":
+                events.put((index, "missing", None))
+            elif kind == "F":
+                finished.add(index)
+                events.put((index, "finished", None))
+        returncode = process.wait()
+
+        if len(finished) == len(files) or (returncode == 0 and not follow):
+            return
+        if returncode > 0 and returncode != 255 and not received:
+            # Not a connection problem (ssh exits with 255 then) and the script in the
+            # host didn't even start, so trying again won't help.
+            events.put((None, "failed", f"(cluster-utils) Failed to read files from {host} (exit code {returncode})."))
+            return
+        retries += 1
+        if not follow and retries > _RETRIES:
+            events.put((None, "failed", f"(cluster-utils) Gave up reading files from {host}, it can't be reached."))
+            return
+        events.put((None, "reconnecting", f"(cluster-utils) Lost the connection to {host}, reconnecting in {backoff}s..."))
+        time.sleep(backoff)
+        backoff = min(2 * backoff, _MAX_BACKOFF)
+
+def _stream(paths, follow=False, lines=None, interval=DEFAULT_INTERVAL, prefix=False, ordered=False):
+    """
+    Writes the contents of the files to stdout.
+
+    Parameters
+    -----------
+    paths: list of str
+        Files inside the mounts.
+    follow: bool, optional
+        Keep writing what is appended to the files.
+    lines: int, optional
+        Start at this number of lines from the end of each file. If not provided, files are read from the start.
+    interval: float, optional
+        Seconds between checks of the files in the host.
+    prefix: bool, optional
+        Prefix each line with the path of the file that it comes from.
+    ordered: bool, optional
+        Write the files one after the other, in the order they were given (i.e. like `cat`).
+        Otherwise, contents are written as soon as they arrive.
+    """
+    by_host = {}
+    for index, path in enumerate(paths):
+        host, remote_path = get_host_from_path(path)
+        by_host.setdefault(host, []).append((index, str(remote_path), -1 if lines is not None else 0))
+
+    events = queue.Queue()
+    def stream_host(host, *args):
+        with processes.host_context(host):
+            _stream_host(host, *args)
+
+    threads = [threading.Thread(target=stream_host, args=(host, files, events, follow, interval, lines or 0), daemon=True)
+        for host, files in by_host.items()]
+    for thread in threads:
+        thread.start()
+
+    out = sys.stdout.buffer
+    # Pieces of lines that haven't been written yet (when prefixing)
+    partial = {}
+    # Output of the files that can't be written yet (when ordered)
+    held = {index: [] for index in range(len(paths))}
+    finished = set()
+    current = 0
+    ok = True
+
+    def write(index, data):
+        if not prefix:
+            out.write(data)
+            return
+        data = partial.pop(index, b"") + data
+        *complete, rest = data.split(b"\n")
+        for line in complete:
+            out.write(f"{paths[index]}: ".encode() + line + b"\n")
+        if rest:
+            partial[index] = rest
+
+    def flush_partial(index):
+        if prefix and partial.get(index):
+            write(index, b"\n")
+
+    try:
+        while any(thread.is_alive() for thread in threads) or not events.empty():
+            try:
+                index, kind, data = events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            if kind in ("reconnecting", "failed"):
+                print(data, file=sys.stderr)
+                ok &= kind != "failed"
+            elif kind == "data":
+                if ordered and index != current:
+                    held[index].append(data)
+                else:
+                    write(index, data)
+            elif kind == "truncated":
+                print(f"(cluster-utils) {paths[index]}: file truncated", file=sys.stderr)
+            elif kind == "missing":
+                print(f"(cluster-utils) {paths[index]}: no such file{', waiting for it' if follow else ''}", file=sys.stderr)
+                ok &= follow
+            elif kind == "finished":
+                finished.add(index)
+                if ordered:
+                    while current in finished:
+                        flush_partial(current)
+                        current += 1
+                        for data in held.pop(current, []):
+                            write(current, data)
+            out.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Files that never finished (e.g. their host failed) would keep the ones after
+        # them waiting forever, so write whatever arrived, still in order.
+        for index in sorted(held):
+            for data in held.pop(index):
+                write(index, data)
+            flush_partial(index)
+        for index in range(len(paths)):
+            flush_partial(index)
+        out.flush()
+
+    return ok
+
+def tail(paths, follow=False, lines=DEFAULT_LINES, interval=DEFAULT_INTERVAL, quiet=False):
+    """
+    Shows the end of files of the hosts (and follows them), without going through the mounts.
+
+    Parameters
+    -----------
+    paths: list of str
+        Files inside the mounts. They can be from different hosts.
+    follow: bool, optional
+        Keep showing what is appended to the files. If the connection drops, it reconnects
+        and continues where it was.
+    lines: int, optional
+        Number of lines to show from the end of each file.
+    interval: float, optional
+        Seconds between checks of the files in the host.
+    quiet: bool, optional
+        Don't prefix the lines with the name of the file, even if there are multiple files.
+    """
+    return _stream(paths, follow=follow, lines=lines, interval=interval, prefix=len(paths) > 1 and not quiet)
+
+def _arguments_tail(subparser):
+    subparser.add_argument("paths", nargs="+", help="Files inside the mounts, they can be from different hosts.")
+
+    subparser.add_argument("-f", "--follow", action="store_true", help="Keep showing what is appended to the files.")
+
+    subparser.add_argument("-n", "--lines", type=int, default=DEFAULT_LINES,
+        help="Number of lines to show from the end of each file.")
+
+    subparser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL,
+        help="Seconds between checks of the files in the host.")
+
+    subparser.add_argument("-q", "--quiet", action="store_true",
+        help="Don't prefix the lines with the name of the file when there are multiple files.")
+
+def cat(paths):
+    """
+    Writes files of the hosts to stdout, without going through the mounts.
+
+    Parameters
+    -----------
+    paths: list of str
+        Files inside the mounts. They can be from different hosts, all of them are read
+        at the same time, but they are written in the order given.
+    """
+    return _stream(paths, ordered=True)
+
+def _arguments_cat(subparser):
+    subparser.add_argument("paths", nargs="+", help="Files inside the mounts, they can be from different hosts.")
+
+SubCommand(tail, _arguments_tail)
+SubCommand(cat, _arguments_cat)
@@ -0,0 +1,546 @@
+"""
+Bulk transfers between the local computer and the hosts, without going through sshfs.
+
+Files are moved over ssh streams (through the master connection of the host):
+    - Small files are packed in tar streams, split among several parallel streams.
+    - Large files are split in chunks, which are also sent in parallel. Finished chunks are
+    recorded (in CLUSTER_UTILS_ROOT/.cache/transfers), so an interrupted transfer is resumed
+    by running the same command again.
+Files whose size and modification time (or checksum) already match are skipped.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path, PurePosixPath
+import shlex
+import subprocess
+import tarfile
+import threading
+import time
+import zlib
+
+from .inventory import get_inventory
+from .mounting import get_host_from_path, get_mounts_dir
+from .path import get_path
+from .sizes import human_size
+from .subcommand import SubCommand
+from .connections import ssh_command, quote_remote_path
+from . import processes
+
+__all__ = ["pull", "push"]
+
+DEFAULT_STREAMS = 4
+# Files larger than this (in MiB) are sent in chunks of this size
+DEFAULT_CHUNK_SIZE = 64
+
+# Format of the entries listed in the host: type, size, mtime, permissions and path
+_LIST_FORMAT = r"%y\t%s\t%T@\t%m\t%p\0"
+# Suffix of the files that are being received
+_PART_SUFFIX = ".clu-part"
+_BLOCK_SIZE = 1 << 20
+
+def _rel(path):
+    path = str(PurePosixPath(path))
+    return "" if path == "." else path[2:] if path.startswith("./") else path
+
+def _list_remote(host, remote_dir, names):
+    """
+    Lists entries in the host, under `remote_dir`.
+
+    Returns
+    ---------
+    dict
+        Maps the paths (relative to `remote_dir`) to dicts with their "type" ('f', 'd', 'l'...),
+        "size", "mtime" and "mode". Empty if `remote_dir` doesn't exist. Raises ConnectionError if
+        the host can't be reached.
+    """
+    script = f"cd {quote_remote_path(remote_dir)} 2>/dev/null || exit 0\n"\
+        f"find {' '.join(shlex.quote(name) for name in names)} -printf '{_LIST_FORMAT}' 2>/dev/null; true"
+    completed = processes.run(ssh_command(host, script), stdout=subprocess.PIPE)
+    if completed.returncode == 255:
+        # ssh failed (the script itself always exits with 0)
+        raise ConnectionError(f"could not list {host}:{remote_dir or '~'}")
+
+    entries = {}
+    for record in completed.stdout.split(b"\0"):
+        fields = record.decode(errors="surrogateescape").split("\t", 4)
+        if len(fields) == 5 and _rel(fields[4]):
+            type_, size, mtime, mode, path = fields
+            entries[_rel(path)] = {"type": type_, "size": int(size) if type_ == "f" else 0,
+                "mtime": float(mtime), "mode": int(mode, 8)}
+
+    return entries
+
+def _list_local(local_dir, names):
+    """Same as `_list_remote`, for a local directory"""
+    entries = {}
+
+    def _add(path):
+        st = os.lstat(path)
+        type_ = "d" if os.path.isdir(path) and not os.path.islink(path) else "l" if os.path.islink(path) else "f"
+        if type_ == "f" and not os.path.isfile(path):
+            return
+        rel = _rel(Path(path).relative_to(local_dir).as_posix())
+        if rel:
+            entries[rel] = {"type": type_, "size": st.st_size if type_ == "f" else 0,
+                "mtime": st.st_mtime, "mode": st.st_mode & 0o7777}
+
+    for name in names:
+        top = Path(local_dir) / name
+        if not os.path.lexists(top):
+            continue
+        _add(top)
+        if top.is_dir() and not top.is_symlink():
+            for dirpath, dirnames, filenames in os.walk(top):
+                for entry in (*dirnames, *filenames):
+                    _add(os.path.join(dirpath, entry))
+
+    return entries
+
+def _local_checksums(local_dir, rels):
+    checksums = {}
+    for rel in rels:
+        sha = hashlib.sha256()
+        with open(Path(local_dir) / rel, "rb") as f:
+            for block in iter(lambda: f.read(_BLOCK_SIZE), b""):
+                sha.update(block)
+        checksums[rel] = sha.hexdigest()
+    return checksums
+
+def _remote_checksums(host, remote_dir, rels):
+    if not rels:
+        return {}
+    script = f"cd {quote_remote_path(remote_dir)} && xargs -0 sha256sum --"
+    completed = processes.run(ssh_command(host, script), input="\0".join(rels).encode(), stdout=subprocess.PIPE)
+    checksums = {}
+    for line in completed.stdout.decode(errors="surrogateescape").splitlines():
+        checksum, _, rel = line.partition("  ")
+        checksums[rel] = checksum
+    return checksums
+
+def _plan(sources, destinations, checksum, source_checksums, destination_checksums):
+    """
+    Decides which entries need to be sent.
+
+    Returns
+    ---------
+    dict
+        The entries to send.
+    int
+        The number of files that are skipped because they are up to date.
+    """
+    to_send, candidates = {}, []
+    for rel, entry in sources.items():
+        existing = destinations.get(rel)
+        if entry["type"] == "d":
+            if existing is None or existing["type"] != "d":
+                to_send[rel] = entry
+        elif existing is None or existing["type"] != entry["type"] or existing["size"] != entry["size"]:
+            to_send[rel] = entry
+        elif checksum and entry["type"] == "f":
+            candidates.append(rel)
+        elif int(existing["mtime"]) != int(entry["mtime"]):
+            to_send[rel] = entry
+
+    skipped = len([rel for rel, entry in sources.items() if entry["type"] != "d" and rel not in to_send])
+    if candidates:
+        source_sums, destination_sums = source_checksums(candidates), destination_checksums(candidates)
+        for rel in candidates:
+            if source_sums.get(rel) is None or source_sums.get(rel) != destination_sums.get(rel):
+                to_send[rel] = sources[rel]
+                skipped -= 1
+
+    return to_send, skipped
+
+class _Transfer:
+    """
+    Moves entries between a local directory and a directory of a host.
+
+    Parameters
+    -----------
+    host: str
+        The name of the host.
+    remote_dir: str
+        The directory of the host.
+    local_dir: Path
+        The local directory.
+    pull: bool
+        Whether the entries go from the host to the local directory (otherwise, the other way around).
+    streams: int
+        Number of ssh streams used at the same time.
+    chunk_size: int
+        Size of the chunks of large files, in bytes.
+    compress: bool
+        Whether to compress the data (with gzip).
+    """
+
+    def __init__(self, host, remote_dir, local_dir, pull, streams=DEFAULT_STREAMS, chunk_size=DEFAULT_CHUNK_SIZE << 20, compress=False):
+        self.host, self.remote_dir, self.local_dir, self.pull = host, str(remote_dir), Path(local_dir), pull
+        self.streams, self.chunk_size, self.compress = max(streams, 1), chunk_size, compress
+
+        self.transferred = 0
+        self.failed = []
+        self._lock = threading.Lock()
+
+        key = hashlib.sha1(f"{host}:{self.remote_dir}:{self.local_dir.resolve()}:{pull}".encode()).hexdigest()[:16]
+        self._progress_file = get_path(".cache") / "transfers" / f"{key}.json"
+        try:
+            self._progress = json.loads(self._progress_file.read_text())
+        except (OSError, ValueError):
+            self._progress = {}
+
+    @property
+    def _remote_cd(self):
+        return f"cd {quote_remote_path(self.remote_dir)}"
+
+    def _save_progress(self):
+        self._progress_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self._progress_file.with_name(f"{self._progress_file.name}.{os.getpid()}")
+        tmp_file.write_text(json.dumps(self._progress))
+        os.replace(tmp_file, self._progress_file)
+
+    def _count(self, nbytes):
+        with self._lock:
+            self.transferred += nbytes
+        processes.record_bytes(**{"received" if self.pull else "sent": nbytes}, host=self.host)
+
+    def run(self, entries):
+        """Transfers the entries (as returned by `_plan`)"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        large = {rel: entry for rel, entry in entries.items() if entry["type"] == "f" and entry["size"] > self.chunk_size}
+        small = [rel for rel in entries if rel not in large]
+
+        # Small files are distributed among the streams, balancing their sizes.
+        groups, sizes = [[] for _ in range(self.streams)], [0] * self.streams
+        for rel in sorted(small, key=lambda rel: entries[rel]["size"], reverse=True):
+            i = sizes.index(min(sizes))
+            groups[i].append(rel)
+            sizes[i] += entries[rel]["size"]
+        tasks = [(size, self._send_tar, (group,)) for size, group in zip(sizes, groups) if group]
+
+        self._prepare_large(large)
+        for rel, entry in large.items():
+            done = self._progress[rel]["done"]
+            for start in range(0, entry["size"], self.chunk_size):
+                if start not in done:
+                    length = min(self.chunk_size, entry["size"] - start)
+                    tasks.append((length, self._send_chunk, (rel, start, length)))
+
+        with ThreadPoolExecutor(max_workers=self.streams) as executor:
+            futures = [executor.submit(self._run_task, function, *args)
+                for _, function, args in sorted(tasks, key=lambda task: task[0], reverse=True)]
+            for future in futures:
+                future.result()
+
+        self._finish_large(large)
+
+    def _run_task(self, function, *args):
+        try:
+            if not function(*args):
+                raise RuntimeError("the stream was interrupted")
+        except Exception as e:
+            with self._lock:
+                self.failed.append(f"{args[0] if isinstance(args[0], str) else f'{len(args[0])} files'}: {e}")
+
+    # ------------------------------
+    #  Small files
+    # ------------------------------
+
+    def _send_tar(self, rels):
+        flags = "z" if self.compress else ""
+        mode = "gz" if self.compress else ""
+
+        if self.pull:
+            script = f"{self._remote_cd} && tar c{flags}f - --null --no-recursion -T -"
+            process = processes.Popen(ssh_command(self.host, script), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+            # The list is written from another thread, since tar starts writing before it has read all of it.
+            def _write_list():
+                process.stdin.write("\0".join(rels).encode(errors="surrogateescape"))
+                process.stdin.close()
+            writer = threading.Thread(target=_write_list, daemon=True)
+            writer.start()
+
+            extract_kwargs = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+            with tarfile.open(fileobj=process.stdout, mode=f"r|{mode}") as tar:
+                for member in tar:
+                    if os.path.isabs(member.name) or ".." in PurePosixPath(member.name).parts:
+                        continue
+                    tar.extract(member, self.local_dir, **extract_kwargs)
+                    self._count(member.size)
+            writer.join()
+        else:
+            script = f"mkdir -p {quote_remote_path(self.remote_dir)} && {self._remote_cd} && tar x{flags}f -"
+            process = processes.Popen(ssh_command(self.host, script), stdin=subprocess.PIPE)
+            with tarfile.open(fileobj=process.stdin, mode=f"w|{mode}") as tar:
+                for rel in rels:
+                    tar.add(self.local_dir / rel, arcname=rel, recursive=False)
+                    self._count(os.lstat(self.local_dir / rel).st_size)
+            process.stdin.close()
+
+        return process.wait() == 0
+
+    # ------------------------------
+    #  Large files
+    # ------------------------------
+
+    def _prepare_large(self, large):
+        """Initializes the record of the chunks of large files, creating the files that receive them"""
+        remote_dirs = set()
+        for rel, entry in large.items():
+            record = self._progress.get(rel)
+            part = self.local_dir / f"{rel}{_PART_SUFFIX}"
+            if record != {**(record or {}), "size": entry["size"], "mtime": entry["mtime"], "chunk_size": self.chunk_size}\
+                    or (self.pull and not part.exists()):
+                # The file is new or something changed since the last attempt, start over.
+                self._progress[rel] = {"size": entry["size"], "mtime": entry["mtime"], "chunk_size": self.chunk_size, "done": []}
+                if self.pull:
+                    part.parent.mkdir(parents=True, exist_ok=True)
+                    with open(part, "wb") as f:
+                        f.truncate(entry["size"])
+            remote_dirs.add(str(PurePosixPath(rel).parent))
+
+        if not self.pull and remote_dirs:
+            # The chunks that were sent in a previous attempt are only trusted if the part in the host is still
+            # there and big enough to contain them (otherwise we would put a file with holes in place).
+            resumed = [rel for rel in large if self._progress[rel]["done"]]
+            sizes = "".join(f"\n{{ wc -c < {shlex.quote(f'{rel}{_PART_SUFFIX}')} || echo -1; }} 2>/dev/null"
+                for rel in resumed)
+            dirs = " ".join(shlex.quote(remote_dir) for remote_dir in sorted(remote_dirs))
+            completed = processes.run(ssh_command(self.host,
+                f"mkdir -p {quote_remote_path(self.remote_dir)} && {self._remote_cd} && mkdir -p {dirs} || exit 1{sizes}"),
+                stdout=subprocess.PIPE)
+
+            remote_sizes = completed.stdout.decode(errors="replace").split()
+            for i, rel in enumerate(resumed):
+                record = self._progress[rel]
+                sent = max(start + min(record["chunk_size"], record["size"] - start) for start in record["done"])
+                try:
+                    remote_size = int(remote_sizes[i])
+                except (IndexError, ValueError):
+                    remote_size = -1
+                if remote_size < sent:
+                    record["done"] = []
+
+        if large:
+            self._save_progress()
+
+    def _send_chunk(self, rel, start, length):
+        part = f"{rel}{_PART_SUFFIX}"
+
+        if self.pull:
+            script = f"{self._remote_cd} && tail -c +{start + 1} {shlex.quote(rel)} | head -c {length}"
+            if self.compress:
+                script += " | gzip -1"
+            process = processes.Popen(ssh_command(self.host, script), stdout=subprocess.PIPE)
+
+            decompressor = zlib.decompressobj(wbits=31) if self.compress else None
+            written = 0
+            with open(self.local_dir / part, "r+b") as f:
+                f.seek(start)
+                for block in iter(lambda: process.stdout.read(_BLOCK_SIZE), b""):
+                    data = decompressor.decompress(block) if decompressor else block
+                    f.write(data)
+                    written += len(data)
+                    self._count(len(data))
+                if decompressor:
+                    data = decompressor.flush()
+                    f.write(data)
+                    written += len(data)
+            ok = process.wait() == 0 and written == length
+        else:
+            script = f"{self._remote_cd} && {'gzip -dc | ' if self.compress else ''}"\
+                f"dd of={shlex.quote(part)} bs=1M conv=notrunc oflag=seek_bytes seek={start} status=none"
+            process = processes.Popen(ssh_command(self.host, script), stdin=subprocess.PIPE)
+
+            compressor = zlib.compressobj(1, wbits=31) if self.compress else None
+            with open(self.local_dir / rel, "rb") as f:
+                f.seek(start)
+                remaining = length
+                while remaining > 0:
+                    block = f.read(min(_BLOCK_SIZE, remaining))
+                    if not block:
+                        break
+                    remaining -= len(block)
+                    process.stdin.write(compressor.compress(block) if compressor else block)
+                    self._count(len(block))
+                if compressor:
+                    process.stdin.write(compressor.flush())
+            process.stdin.close()
+            ok = process.wait() == 0 and remaining == 0
+
+        if ok:
+            with self._lock:
+                self._progress[rel]["done"].append(start)
+                self._save_progress()
+
+        return ok
+
+    def _finish_large(self, large):
+        """Puts the large files whose chunks were all received in place, with their original mtime and permissions"""
+        finished = [rel for rel, entry in large.items()
+            if len(self._progress[rel]["done"]) == len(range(0, entry["size"], self.chunk_size))]
+
+        if self.pull:
+            for rel in finished:
+                entry, path = large[rel], self.local_dir / rel
+                os.replace(self.local_dir / f"{rel}{_PART_SUFFIX}", path)
+                os.chmod(path, entry["mode"])
+                os.utime(path, (entry["mtime"], entry["mtime"]))
+        elif finished:
+            lines = [self._remote_cd + " || exit 1"]
+            for rel in finished:
+                entry, path = large[rel], shlex.quote(rel)
+                part = shlex.quote(f"{rel}{_PART_SUFFIX}")
+                lines.append(f"mv -f {part} {path} && chmod {entry['mode']:o} {path} && touch -d @{entry['mtime']} {path}"
+                    f" || echo {shlex.quote(rel)}")
+            completed = processes.run(ssh_command(self.host, "\n".join(lines)), stdout=subprocess.PIPE)
+            failed = set(completed.stdout.decode(errors="surrogateescape").splitlines())
+            self.failed.extend(f"{rel}: could not be put in place" for rel in failed)
+            finished = [rel for rel in finished if rel not in failed]
+
+        for rel in finished:
+            del self._progress[rel]
+        if large:
+            self._save_progress()
+
+def _transfer(host, remote_dir, local_dir, names, pull, checksum=False, **kwargs):
+    """Plans and runs the transfer of some entries of a directory"""
+    transfer = _Transfer(host, remote_dir, local_dir, pull, **kwargs)
+
+    remote = _list_remote(host, remote_dir, names)
+    local = _list_local(local_dir, names)
+    sources, destinations = (remote, local) if pull else (local, remote)
+    if not sources:
+        raise ValueError(f"Nothing found to {'pull' if pull else 'push'}: {', '.join(names)}")
+
+    checksums = (lambda rels: _remote_checksums(host, remote_dir, rels), lambda rels: _local_checksums(local_dir, rels))
+    to_send, skipped = _plan(sources, destinations, checksum, *(checksums if pull else checksums[::-1]))
+
+    n_files = len([entry for entry in to_send.values() if entry["type"] != "d"])
+    total = sum(entry["size"] for entry in to_send.values())
+    print(f"(cluster-utils) {'Pulling' if pull else 'Pushing'} {n_files} files ({human_size(total)})"\
+        f" {'from' if pull else 'to'} {host}. {skipped} files are already up to date.", flush=True)
+
+    start = time.perf_counter()
+    if to_send:
+        local_dir.mkdir(parents=True, exist_ok=True)
+        transfer.run(to_send)
+    elapsed = time.perf_counter() - start
+
+    print(f"(cluster-utils) Transferred {human_size(transfer.transferred)} in {elapsed:.1f}s"\
+        f" ({human_size(transfer.transferred / max(elapsed, 1e-9))}/s)")
+
+    for failure in transfer.failed:
+        print(f"(cluster-utils) FAILED {failure}")
+    if transfer.failed:
+        print("(cluster-utils) Run the same command again to resume.")
+
+    return not transfer.failed
+
+def _add_transfer_arguments(subparser):
+    subparser.add_argument("-s", "--streams", type=int, default=DEFAULT_STREAMS,
+        help="Number of parallel ssh streams. Note that ssh servers usually limit them to 10 per connection.")
+
+    subparser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+        help="Files larger than this (in MiB) are sent in chunks of this size, in parallel and resumable.")
+
+    subparser.add_argument("-z", "--compress", action="store_true", help="Compress the data before sending it.")
+
+    subparser.add_argument("-c", "--checksum", action="store_true", help="Skip files whose size and checksum match,"\
+        " instead of their size and modification time.")
+
+def pull(paths=None, to=None, streams=DEFAULT_STREAMS, chunk_size=DEFAULT_CHUNK_SIZE, compress=False, checksum=False):
+    """
+    Copies files or directories from a host to your computer, without going through the mount.
+
+    Parameters
+    -----------
+    paths: list of str, optional
+        Files or directories inside a mountpoint. Defaults to the current directory.
+    to: str, optional
+        Local directory where they should be copied. Defaults to the current directory,
+        which must then be outside the mounts directory.
+    streams: int, optional
+        Number of parallel ssh streams.
+    chunk_size: int, optional
+        Files larger than this (in MiB) are sent in chunks of this size.
+    compress: bool, optional
+        Compress the data before sending it.
+    checksum: bool, optional
+        Skip files whose size and checksum match, instead of their size and modification time.
+    """
+    to = Path(to or ".").resolve()
+    mounts_dir = get_mounts_dir().resolve()
+    if to == mounts_dir or mounts_dir in to.parents:
+        raise ValueError("The destination is inside the mounts directory, use --to to pull somewhere else.")
+
+    # Group the paths by the directory where they are, to transfer them together
+    groups = {}
+    for path in paths or ["."]:
+        host, remote_path = get_host_from_path(path)
+        remote_path = PurePosixPath(remote_path)
+        if _rel(remote_path.name) and _rel(remote_path) != _rel((get_inventory().hosts.get(host) or {}).get("mount_target", "")):
+            groups.setdefault((host, str(remote_path.parent), to), []).append(remote_path.name)
+        else:
+            # The whole mountpoint, it goes into a directory with the name of the host.
+            groups.setdefault((host, str(remote_path), to / host), []).append(".")
+
+    ok = True
+    for (host, remote_dir, local_dir), names in groups.items():
+        ok &= _transfer(host, remote_dir, local_dir, names, pull=True, checksum=checksum,
+            streams=streams, chunk_size=chunk_size << 20, compress=compress)
+
+    return ok
+
+def _arguments_pull(subparser):
+    subparser.add_argument("paths", nargs="*", help="Files or directories inside a mountpoint. Defaults to the current directory.")
+
+    subparser.add_argument("-t", "--to", help="Local directory where they should be copied. Defaults to the current directory.")
+
+    _add_transfer_arguments(subparser)
+
+def push(paths, to=None, streams=DEFAULT_STREAMS, chunk_size=DEFAULT_CHUNK_SIZE, compress=False, checksum=False):
+    """
+    Copies local files or directories to a host, without going through the mount.
+
+    Parameters
+    -----------
+    paths: list of str
+        Local files or directories.
+    to: str, optional
+        Directory inside a mountpoint where they should be copied. Defaults to the current directory.
+    streams: int, optional
+        Number of parallel ssh streams.
+    chunk_size: int, optional
+        Files larger than this (in MiB) are sent in chunks of this size.
+    compress: bool, optional
+        Compress the data before sending it.
+    checksum: bool, optional
+        Skip files whose size and checksum match, instead of their size and modification time.
+    """
+    host, remote_dir = get_host_from_path(to or "")
+
+    groups = {}
+    for path in paths:
+        path = Path(path).resolve()
+        groups.setdefault(path.parent, []).append(path.name)
+
+    ok = True
+    for local_dir, names in groups.items():
+        ok &= _transfer(host, str(remote_dir), local_dir, names, pull=False, checksum=checksum,
+            streams=streams, chunk_size=chunk_size << 20, compress=compress)
+
+    return ok
+
+def _arguments_push(subparser):
+    subparser.add_argument("paths", nargs="+", help="Local files or directories.")
+
+    subparser.add_argument("-t", "--to", help="Directory inside a mountpoint where they should be copied."\
+        " Defaults to the current directory.")
+
+    _add_transfer_arguments(subparser)
+
+SubCommand(pull, _arguments_pull)
+SubCommand(push, _arguments_push)
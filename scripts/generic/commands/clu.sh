@@ -8,7 +8,7 @@ cluload(){
     if [ ! -z "${env_loader// }" ]; then
         _clureport "Loading environment <$1> from ${env_loader}..."
         source "${env_loader}"
-        if $?; 
+        if [ $? -eq 0 ];
         then _clureport "Succeeded." 
             else _clureport "Failed"
         fi
@@ -18,18 +18,24 @@ cluload(){
 }
 
 _clugethost(){
-    HOSTNAME=$(hostname)
-
     _cluparsehost $HOSTNAME
 }
 
 _cluparsehost(){
-    case $1 in
+    local CLUSTER_UTILS_HOST
+    _clusethost $1
+    echo $CLUSTER_UTILS_HOST
+}
+
+# Sets CLUSTER_UTILS_HOST from the name of the machine ($HOSTNAME by default, which
+# bash already knows, so that activating doesn't need to run anything)
+_clusethost(){
+    case ${1:-$HOSTNAME} in
         hpcq*)
-            echo hpcq
+            CLUSTER_UTILS_HOST=hpcq
         ;;
         *)
-            echo unknown
+            CLUSTER_UTILS_HOST=unknown
         ;;
     esac
 }
@@ -39,48 +45,63 @@ cluget(){
     local what=$1
 
     # Call .parsedir, which will define the following variables:
-    # $directory, $userdirectory, $prefix
+    # $directory, $prefix
     _cluparseget "$what"
 
+    # In the hosts, `clu setuphostscripts` leaves an index with the script that
+    # should be used for each request, so there's no need to look for it
+    # (this runs at the start of every job, and filesystems can be very slow).
+    if [ -z "${_clu_index}" ] && [ -f "$(_clupath scripts/index.sh)" ]; then
+        source "$(_clupath scripts/index.sh)"
+    fi
+    local indexed
+    eval "indexed=\${_clu_index_${what//[^a-zA-Z0-9_]/_}_${2//[^a-zA-Z0-9_]/_}}"
+    if [ ! -z "${indexed}" ]; then
+        _clureport debug "Requested ${what} <$2> on ${CLUSTER_UTILS_HOST}. Found in the index: ${indexed}"
+        echo "$(_clupath ${indexed})"
+        return
+    fi
+
     # Define all the candidates (the order of the candidates matter)
     # The order defined here is:
     # 	1. User directory, cluster-specific
     #	2. Cluster-utils provided, cluster-specific
     #	3. User directory, generic
     #	4. Cluster-utils provided, generic.
-    #	5. spec provided was a full path to the file
-    # local candidates=" ${userdirectory}/${CLUSTER_UTILS_HOST}/${prefix}_$2.sh"
-    # candidates+=" $(_clupath ${directory}/${CLUSTER_UTILS_HOST}/${prefix}_$2.sh)"
-    # candidates+=" ${userdirectory}/${prefix}_$2.sh"
-    # candidates+=" $(_clupath ${directory}/${prefix}_$2.sh)"
-    # candidates+=" $2"
-
-    # local winner=
-
-    # for candidate in $candidates; do
-    #     if [ -f $candidate ]; then
-    #         winner=$candidate
-    #         break
-    #     fi
-    # done
+    #	5. Cluster-utils provided, already merged (this is how scripts are in the hosts)
+    #	6. spec provided was a full path to the file
+    local candidates="${CLUSTER_UTILS_USERSCRIPTS}/host-specific/${CLUSTER_UTILS_HOST}/${directory}/${prefix}_$2.sh"
+    candidates+=" $(_clupath scripts/host-specific/${CLUSTER_UTILS_HOST}/${directory}/${prefix}_$2.sh)"
+    candidates+=" ${CLUSTER_UTILS_USERSCRIPTS}/generic/${directory}/${prefix}_$2.sh"
+    candidates+=" $(_clupath scripts/generic/${directory}/${prefix}_$2.sh)"
+    candidates+=" $(_clupath scripts/${directory}/${prefix}_$2.sh)"
+    candidates+=" $2"
+
+    local winner=
+
+    for candidate in $candidates; do
+        if [ -f $candidate ]; then
+            winner=$candidate
+            break
+        fi
+    done
 
-    #_clureport debug "Requested ${what} <$2> on ${CLUSTER_UTILS_HOST}. Found: ${winner}. Candidates were: ${candidates}"
+    _clureport debug "Requested ${what} <$2> on ${CLUSTER_UTILS_HOST}. Found: ${winner}. Candidates were: ${candidates}"
 
-    echo "$(_clupath ${directory}/${prefix}_$2.sh)"
+    echo "${winner}"
 }
 
 _cluparseget(){
+    # Keep it in sync with _RESOLVABLE in cli/subcommands/script_management.py
     directory=
     prefix=
     case $1 in
         runner)
-            directory=scripts/runners
-            userdirectory="$CLUSTER_UTILS_USERSCRIPTS"/runners
+            directory=runners
             prefix=run
         ;;
         env_loader)
-            directory=scripts/env_loaders
-            userdirectory="$CLUSTER_UTILS_USERSCRIPTS"/env_loaders
+            directory=env_loaders
             prefix=load
         ;;
     esac
@@ -96,16 +117,23 @@ _clupyoptions(){
 }
 
 _clupycomplete(){
+    # Defines _clucompletion with the code that provides tab completion for clu, taken
+    # from the first python that has argcomplete (which is stored in _clupython).
+    # It is not evaluated here so that activate can save it.
     local bin_dir
     local py_bin
     local argcomplete_bin
 
+    _clucompletion=
+    _clupython=
     for possiblepy in $(_clupyoptions); do
         py_bin="$(which "${possiblepy}" 2>/dev/null)"
         bin_dir="$(dirname "${py_bin}")"
         argcomplete_bin="${bin_dir}/register-python-argcomplete"
         if [ -x "${argcomplete_bin}" ]; then
-            eval "$("${argcomplete_bin}" clu)"
+            _clupython="${py_bin}"
+            _clucompletion="$("${argcomplete_bin}" clu)"
+            break
         fi
     done
 
@@ -115,4 +143,16 @@ clucd(){
     cd "${CLUSTER_UTILS_MOUNTS}/$1"
 }
 
+clu(){
+    # A command can't change the directory of the shell that calls it,
+    # so "clu jobcd JOBID" is handled here.
+    if [ "$1" == "jobcd" ]; then
+        shift
+        local dir
+        dir=$(command clu jobdir "$@") && cd "${dir}"
+    else
+        command clu "$@"
+    fi
+}
+
 
@@ -7,16 +7,7 @@ siestasub(){
 	# Get the fdf file name 
         if [ $# == 0 ] || [[ ! "$(ls *.fdf)" =~ "$1" ]];
         then
-		local fdfs=$(ls *.fdf)
-                local SYSTEM=${fdfs//.fdf}
-		for f in $fdfs; do
-                        included=$(grep include $f)
-                        included=${included//%include/}
-                        included=${included//.fdf/}
-                        for word in $included; do
-                                SYSTEM=${SYSTEM//${word}/};
-                        done
-                done
+		local SYSTEM=$(_siestasystem)
 		_clureport "$(echo $SYSTEM) will be used as the input fdf."
         else
                 SYSTEM=$1
@@ -28,3 +19,19 @@ siestasub(){
 
         ENV_LOADER=$ENV_LOADER SYSTEM=$SYSTEM JOB_NAME=$SYSTEM jobsub "$@" $SIESTA_RUN_SCRIPT
 }
+
+_siestasystem(){
+	# Prints the name of the main fdf of the current directory (without extension),
+	# i.e. the fdf that is not included by any other fdf.
+	local fdfs=$(ls *.fdf 2>/dev/null)
+	local SYSTEM=${fdfs//.fdf}
+	for f in $fdfs; do
+		included=$(grep include $f 2>/dev/null)
+		included=${included//%include/}
+		included=${included//.fdf/}
+		for word in $included; do
+			SYSTEM=${SYSTEM//${word}/};
+		done
+	done
+	echo $SYSTEM
+}
@@ -0,0 +1,133 @@
+#!/bin/bash
+
+# Staging of calculations in the scratch directory of the host (CLUSTER_UTILS_SCRATCH,
+# which is set from the scratch_dir of the host's configuration). Runners use it like:
+#
+#	SCR=$(clustagein $SYSTEM) || exit 1
+#	cd $SCR
+#	... run ...
+#	clustageout $SCR $SUBMIT_DIR
+
+clustagein(){
+	# Copies the inputs of a siesta calculation (see _clufdfinputs) and any other files given
+	# to a new directory in the scratch, and prints its path. If the host has no scratch,
+	# nothing is copied and the current directory is printed.
+	local system=${1%.fdf}
+	shift
+
+	if [ -z "${CLUSTER_UTILS_SCRATCH// }" ]; then
+		pwd
+		return
+	fi
+
+	local scratch="${CLUSTER_UTILS_SCRATCH}/${JOB_NAME:-${system}}-${SLURM_JOB_ID:-${PBS_JOBID:-$$}}"
+	mkdir -p "${scratch}" || return 1
+	: > "${scratch}/.clustage"
+
+	{ _clufdfinputs "${system}.fdf"; for file in "$@"; do echo "${file}"; done; } | sort -u | tr '\n' '\0' \
+		| _clustagecopy "${PWD}" "${scratch}" "" >> "${scratch}/.clustage" || return 1
+
+	echo "${scratch}"
+}
+
+clustageout(){
+	# Copies back to $2 the files in the scratch directory $1 that are new or have changed since
+	# clustagein, verifying each copy. The scratch directory is only removed if all of them succeeded.
+	local scratch=$1
+	local destination=$2
+
+	if [ "$(cd "${scratch}" && pwd)" == "$(cd "${destination}" && pwd)" ]; then
+		# The calculation didn't run in a scratch directory
+		return
+	fi
+
+	if ! (cd "${scratch}" && find . -type f ! -name .clustage ! -name "*.clu-part" -print0) \
+		| _clustagecopy "${scratch}" "${destination}" "${scratch}/.clustage" > /dev/null; then
+		echo "(cluster-utils) Some files could not be copied back, they are still in ${scratch}" >&2
+		return 1
+	fi
+
+	rm -rf "${scratch}"
+}
+
+_clustagecopy(){
+	# Copies the files in $1 listed in stdin (NUL separated relative paths) to $2, in parallel
+	# (CLUSTER_UTILS_STAGE_JOBS at a time). Each copy is verified with cksum before giving it
+	# its final name, and files whose checksum is in the manifest $3 are skipped.
+	# Prints the manifest of the copied files (one "checksum size path" per line).
+	xargs -0 -n 1 -P "${CLUSTER_UTILS_STAGE_JOBS:-4}" bash -c '
+		file=${4#./}
+		sum=$(cksum < "$1/${file}") || exit 1
+		if [ -n "$3" ] && grep -qxF "${sum} ${file}" "$3"; then exit 0; fi
+		if mkdir -p "$2/$(dirname "${file}")" && cp -p "$1/${file}" "$2/${file}.clu-part" \
+			&& [ "$(cksum < "$2/${file}.clu-part")" == "${sum}" ] && mv -f "$2/${file}.clu-part" "$2/${file}"; then
+			echo "${sum} ${file}"
+		else
+			rm -f "$2/${file}.clu-part"
+			echo "(cluster-utils) Failed to copy $1/${file} to $2" >&2
+			exit 1
+		fi
+	' clu-stage "$1" "$2" "$3"
+}
+
+_clufdfinputs(){
+	# Prints the files of the current directory that a siesta calculation needs: the fdf, the fdfs
+	# that it includes, any other file named in them (e.g. "%block ... < file" or DM.File), the
+	# pseudopotentials of its species and the restart files of its SystemLabel.
+	local queue="$1 $(_clurestartfiles ${1%.fdf})"
+	local seen=" "
+	local file
+	local name
+
+	for file in ${queue}; do
+		[ -f "${file}" ] && [[ "${seen}" != *" ${file} "* ]] && seen+="${file} "
+	done
+
+	while [ -n "${queue// }" ]; do
+		file=${queue%% *}
+		queue=${queue#"${file}"}
+		queue=${queue# }
+		[ -f "${file}" ] || continue
+		[[ "${file}" == *.fdf ]] || continue
+
+		for name in $(_clufdfnames "${file}"); do
+			if [ -f "${name}" ] && [[ "${seen}" != *" ${name} "* ]]; then
+				seen+="${name} "
+				queue+=" ${name}"
+			fi
+		done
+	done
+
+	for file in ${seen}; do
+		echo "${file}"
+	done
+}
+
+_clurestartfiles(){
+	# Files that siesta can restart from, for a given SystemLabel
+	local ext
+	for ext in DM XV CG LWF TSDE TSHS; do
+		echo "$1.${ext}"
+	done
+}
+
+_clufdfnames(){
+	# Prints all the words of an fdf that could be file names, plus the pseudopotentials
+	# of the species and the restart files of the SystemLabel that it defines.
+	awk '
+		{ sub(/#.*/, "") }
+		NF == 0 { next }
+		{ key = tolower($1); gsub(/[._-]/, "", key) }
+		key == "%block" { block = tolower($2); gsub(/[._-]/, "", block) }
+		key == "%endblock" { block = "" }
+		block == "chemicalspecieslabel" && NF >= 3 && key != "%block" { print $3 ".psf"; print $3 ".psml" }
+		key == "systemlabel" && NF >= 2 { print "LABEL " $2 }
+		{ for (i = 1; i <= NF; i++) if ($i ~ /^[A-Za-z0-9_+.\/-]+$/ && $i !~ /\.\./ && $i !~ /^\//) print $i }
+	' "$1" | while read -r name label; do
+		if [ "${name}" == "LABEL" ]; then
+			_clurestartfiles "${label}"
+		else
+			echo "${name}"
+		fi
+	done
+}
@@ -10,4 +10,12 @@ SIESTA=${SIESTA:-siesta}
 SYSTEM=${SYSTEM:-$1}
 SIESTA_MPIRUN=${SIESTA_MPIRUN:mpirun}
 
+# Run in the scratch directory of the host, if it has one (see clustagein)
+SUBMIT_DIR=$PWD
+type clustagein > /dev/null 2>&1 || source "${CLUSTER_UTILS_ROOT}/activate"
+SCR=$(clustagein $SYSTEM) || exit 1
+cd $SCR
+
 ${SIESTA_MPIRUN} $SIESTA < $SYSTEM'.fdf' > $SYSTEM'.out' 
+
+clustageout $SCR $SUBMIT_DIR
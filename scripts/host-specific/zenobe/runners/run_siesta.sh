@@ -28,16 +28,21 @@ echo "------------------ Work dir --------------------"
 echo $PBS_O_WORKDIR
 cd ${PBS_O_WORKDIR}
 
-# Define the scratch directory
-#
-SCR=/SCRATCH/icn2/2019089_HPCCOM_ICN2/$PBS_JOBNAME-$PBS_JOBID
-
-mkdir $SCR
-# Copy relevant data files only to the master node's scratch.
+# Stage the calculation in the scratch directory of the host (its scratch_dir,
+# e.g. clu updatehostconfig zenobe --scratch_dir /SCRATCH/icn2/2019089_HPCCOM_ICN2).
+# Only the files that siesta needs are copied to the master node's scratch.
 # In SIESTA only the master node should be allowed to do I/O.
 # Your mileage might vary with other codes.
 #
-cp * $SCR
+type clustagein > /dev/null 2>&1 || source "${CLUSTER_UTILS_ROOT}/activate"
+# This runner used to hard-code the scratch. Running in the submit directory instead
+# would fill the home quota, so refuse to run until the host has its scratch_dir.
+if [ -z "${CLUSTER_UTILS_SCRATCH// }" ]; then
+    echo "(cluster-utils) This host has no scratch directory, set it (from your computer) with:" >&2
+    echo "    clu updatehostconfig <host> --scratch_dir /SCRATCH/icn2/2019089_HPCCOM_ICN2" >&2
+    exit 1
+fi
+SCR=$(clustagein $SYSTEM) || exit 1
 #
 #
 echo "$SCR" >> WHERE_TO_FIND_FILES
@@ -46,5 +51,5 @@ cd $SCR
 
 mpirun -np $CORES $SIESTA < $SYSTEM.fdf > $SYSTEM.out
 
-mv $SCR/* $PBS_O_WORKDIR
-rmdir $SCR
+# Bring back only what is new or changed
+clustageout $SCR $PBS_O_WORKDIR
@@ -23,4 +23,44 @@ describe "Activate scripts"
 	describe "Cli"
 
 	end
+
+	describe "Scripts"
+		it "Finds scripts using the index of the host"
+			tmpdir=$(mktemp -d)
+			mkdir "${tmpdir}/scripts"
+			echo "_clu_index=1" > "${tmpdir}/scripts/index.sh"
+			echo "_clu_index_runner_siesta=scripts/runners/run_other.sh" >> "${tmpdir}/scripts/index.sh"
+			found=$(unset _clu_index; CLUSTER_UTILS_ROOT="${tmpdir}" cluget runner siesta)
+			assert equal "${found}" "${tmpdir}/scripts/runners/run_other.sh"
+			rm -r "${tmpdir}"
+		end
+
+		it "Prefers host specific scripts"
+			assert equal "$(CLUSTER_UTILS_HOST=zenobe cluget runner siesta)" "$(_clupath scripts/host-specific/zenobe/runners/run_siesta.sh)"
+		end
+	end
+
+	describe "Siesta"
+		it "Finds the main fdf of a directory"
+			tmpdir=$(mktemp -d)
+			echo "%include basis.fdf" > "${tmpdir}/main.fdf"
+			touch "${tmpdir}/basis.fdf"
+			assert equal "$(cd "${tmpdir}" && _siestasystem)" "main"
+			rm -r "${tmpdir}"
+		end
+
+		it "Stages the inputs of a calculation in the scratch and back"
+			tmpdir=$(mktemp -d)
+			mkdir "${tmpdir}/scratch" "${tmpdir}/calc"
+			printf "%%include basis.fdf\n%%block ChemicalSpeciesLabel\n 1 6 C\n%%endblock ChemicalSpeciesLabel\n" > "${tmpdir}/calc/main.fdf"
+			touch "${tmpdir}/calc/basis.fdf" "${tmpdir}/calc/C.psf" "${tmpdir}/calc/main.DM" "${tmpdir}/calc/old.out"
+			scr=$(cd "${tmpdir}/calc" && CLUSTER_UTILS_SCRATCH="${tmpdir}/scratch" clustagein main)
+			assert equal "$(cd "${scr}" && ls | tr '\n' ' ')" "C.psf basis.fdf main.DM main.fdf "
+			echo "done" > "${scr}/main.out"
+			clustageout "${scr}" "${tmpdir}/calc"
+			assert equal "$(cat "${tmpdir}/calc/main.out")" "done"
+			assert test "[ ! -d ${scr} ]"
+			rm -r "${tmpdir}"
+		end
+	end
 end 
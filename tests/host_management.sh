@@ -13,6 +13,53 @@ describe "Host management"
 			assert equal "$(clu lshosts)" "cl1 cl2 cl3"
 			rm "${hosts_yaml}"
 		end
+
+		it "Selects hosts by group and tag"
+			printf "cl1:\n  groups: icn2\n  tags: gpu\ncl2:\n  groups: icn2, bsc\ncl3:\n  groups: [bsc]\n  tags: gpu" > "${hosts_yaml}"
+			assert equal "$(clu lshosts --group icn2)" "cl1 cl2"
+			assert equal "$(clu lshosts --group bsc --tag gpu)" "cl3"
+			rm "${hosts_yaml}"
+		end
+
+		it "Notices changes in hosts.yaml"
+			printf "cl1:\n  user: a\n" > "${hosts_yaml}"
+			assert equal "$(clu lshosts)" "cl1"
+			printf "cl1:\n  user: a\ncl2:\n  user: b\n" > "${hosts_yaml}"
+			assert equal "$(clu lshosts)" "cl1 cl2"
+			rm "${hosts_yaml}"
+		end
+
+		it "Lists hosts from python"
+			printf "cl1:\n  groups: icn2\ncl2:\n  groups: bsc\n" > "${hosts_yaml}"
+			assert equal "$(${CLUSTER_UTILS_PYTHON:-python3} -c "import sys; sys.path.append('$(_clupath cli)')
+from subcommands import Session
+print(*(host.name for host in Session().hosts(group='bsc')))")" "cl2"
+			rm "${hosts_yaml}"
+		end
+
+		it "Runs multi-host commands concurrently"
+			output=$(${CLUSTER_UTILS_PYTHON:-python3} -c "import sys, time; sys.path.append('$(_clupath cli)')
+from subcommands.host_management import _multiple_hosts
+from subcommands import processes
+@_multiple_hosts()
+def work(host):
+    print('start')
+    processes.run(['sleep', '5' if host == 'cl3' else '1'])
+    print('end')
+start = time.monotonic()
+work(['cl1', 'cl2', 'cl3'], jobs=3, timeout=2)
+print(f'{time.monotonic() - start:.0f}s')")
+			# The output of each host is printed together, followed by a summary
+			assert equal "$(echo "${output}" | grep '^\[' | awk '{print $1}' | uniq | sort | tr '\n' ' ')" "[cl1] [cl2] [cl3] "
+			assert equal "$(echo "${output}" | grep '^(cluster-utils)')" "(cluster-utils) 2 ok, 0 failed, 1 timed out"
+			assert equal "$(echo "${output}" | tail -1)" "2s"
+		end
+
+		it "Doesn't hang probing hosts whose jump_through form a cycle"
+			printf "cl1:\n  jump_through: cl2\ncl2:\n  jump_through: cl1\n" > "${hosts_yaml}"
+			assert equal "$(clu status cl1 --refresh | awk 'NR == 2 {print $2}')" "unreachable"
+			rm "${hosts_yaml}"
+		end
 	end
 
 	describe "Setup and removal"
@@ -24,15 +71,79 @@ describe "Host management"
 			assert equal "$(clu lshosts)" "cl4 cl5 cl6"
 		end
 
+		it "Skips hosts that are not reachable"
+			assert equal "$(clu status cl4 --refresh | awk 'NR == 2 {print $2}')" "unreachable"
+			assert equal "$(clu removehost cl5 --only-reachable 2>&1)" "(cluster-utils) Skipping unreachable hosts: cl5"
+			assert equal "$(clu lshosts)" "cl4 cl5 cl6"
+		end
+
 		it "Removes one cluster succesfully"
 			clu removehost cl5
 			assert equal "$(clu lshosts)" "cl4 cl6"
 		end
 
+		it "Removes the known hosts even if others fail"
+			clu removehost cl4 not_a_host > /dev/null 2>&1
+			rc=$?
+			assert equal "${rc}" "1"
+			assert equal "$(clu lshosts)" "cl6"
+			assert equal "$(grep -c '^Host cl4$' ~/.ssh/config)" "0"
+		end
+
 		it "Removes all clusters succesfully"
 			clu removehost --all
 			assert equal "$(clu lshosts)" ""
 		end
+
+		it "Doesn't set up hosts whose jump_through form a cycle"
+			printf "cl7:\n  jump_through: cl8\ncl8:\n  jump_through: cl7\ncl9:\n  jump_through: cl9\ncl10:\n  hostname: hpc\n" > "${hosts_yaml}test1"
+			clu setuphost --config ${hosts_yaml}test1 --use-defaults --no-conn >/dev/null 2>/dev/null
+			rm ${hosts_yaml}test1
+			assert equal "$(clu lshosts)" "cl10"
+			assert equal "$(grep -c '^Host cl[789]$' ~/.ssh/config)" "0"
+		end
+
+		it "Keeps the ssh config as it was, except for the hosts it edits"
+			assert equal "$(${CLUSTER_UTILS_PYTHON:-python3} -c "import sys; sys.path.append('$(_clupath cli)')
+from subcommands.ssh_config import SSHConfig
+text = '# Global\nHost *\n    ServerAliveInterval 30\n\nHost = a \"b\"\n\tUser me\n\nMatch host c\n  User x\n'
+config = SSHConfig(text)
+print(str(config) == text, end=' ')
+config.set_host('b', [('User', 'other')])
+config.remove_host('a')
+print(str(config) == text.replace('Host = a \"b\"', 'Host = b') + '\nHost b\n User other\n', end=' ')
+config.remove_host('b')
+print(str(config) == '# Global\nHost *\n    ServerAliveInterval 30\n\nMatch host c\n  User x\n')")" "True True True"
+		end
+
+		it "Keeps the lines of the user around the hosts it edits"
+			assert equal "$(${CLUSTER_UTILS_PYTHON:-python3} -c "import sys; sys.path.append('$(_clupath cli)')
+from subcommands.ssh_config import SSHConfig
+text = 'Host a\n User me\n IdentityFile ~/.ssh/a\n ForwardAgent yes\n\n# --- Work machines ---\nHost b\n User x\n'
+config = SSHConfig(text)
+config.set_host('a', [('User', 'you'), ('HostName', 'a.org')], managed=['ProxyJump'])
+print(str(config) == text.replace('User me', 'User you').replace('yes\n', 'yes\n HostName a.org\n', 1), end=' ')
+config.remove_host('a')
+print(str(config) == '\n# --- Work machines ---\nHost b\n User x\n')")" "True True"
+		end
+
+		it "Undoes the changes of a host that fails"
+			printf "cl11:\n  hostname: hpc\n" > "${hosts_yaml}test1"
+			clu setuphost --config ${hosts_yaml}test1 --use-defaults --no-conn >/dev/null 2>/dev/null
+			rm ${hosts_yaml}test1
+			${CLUSTER_UTILS_PYTHON:-python3} -c "import sys; sys.path.append('$(_clupath cli)')
+from subcommands.host_management import _multiple_hosts, remove_host_ssh_config, remove_hosts_yaml
+@_multiple_hosts(edits_config=True)
+def remove(host):
+    remove_host_ssh_config(host)
+    if host == 'cl11':
+        raise RuntimeError('failed')
+    remove_hosts_yaml([host])
+remove(['cl10', 'cl11'])" >/dev/null
+			assert equal "$(clu lshosts)" "cl11"
+			assert equal "$(grep -c '^Host cl10$' ~/.ssh/config) $(grep -c '^Host cl11$' ~/.ssh/config)" "0 1"
+			clu removehost cl11
+		end
 	end
 	
 end
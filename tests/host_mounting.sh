@@ -33,6 +33,10 @@ describe "Mounting"
 			assert equal "$(clu lsmounts)" "fakeserver"
 		end
 
+		it "Reports the state of fakeserver"
+			assert equal "$(clu lsmounts --status)" "fakeserver           healthy"
+		end
+
 		it "Doesn't get fooled by unmounted dirs"
 			chmod +w "${CLUSTER_UTILS_MOUNTS}"
 			# Create some fake mountpoints
@@ -52,6 +56,141 @@ describe "Mounting"
 		chmod -w ${CLUSTER_UTILS_MOUNTS}
 	end
 
+	it "Lists the fake server from its index"
+		clu index fakeserver > /dev/null
+		assert equal "$(clu ls --host fakeserver)" "haha"
+		assert equal "$(cd ${CLUSTER_UTILS_MOUNTS}/fakeserver && clu find --type d)" "${CLUSTER_UTILS_MOUNTS}/fakeserver/haha"
+	end
+
+	it "Pushes and pulls files without going through the mount"
+		local_dir=$(_clupath transfer_test)
+		mkdir -p "${local_dir}/inputs" && echo "hello" > "${local_dir}/inputs/a.fdf"
+		clu push "${local_dir}/inputs" --to "${CLUSTER_UTILS_MOUNTS}/fakeserver/haha" > /dev/null
+		assert equal "$(ssh root@localhost -p 2222 cat haha/inputs/a.fdf)" "hello"
+		clu pull "${CLUSTER_UTILS_MOUNTS}/fakeserver/haha/inputs" --to "${local_dir}/pulled" > /dev/null
+		assert equal "$(cat ${local_dir}/pulled/inputs/a.fdf)" "hello"
+		rm -r "${local_dir}"
+		ssh root@localhost -p 2222 rm -r haha/inputs
+	end
+
+	it "Pushes the changes of a local directory"
+		local_dir=$(_clupath watch_test)
+		mkdir -p "${local_dir}/.git" && echo "hello" > "${local_dir}/a.fdf" && echo "x" > "${local_dir}/.git/HEAD"
+		clu watch "${local_dir}" fakeserver:haha/watched --once > /dev/null
+		assert equal "$(ssh root@localhost -p 2222 'cat haha/watched/a.fdf; ls -a haha/watched | wc -l')" "hello
+3"
+		rm -r "${local_dir}"
+		ssh root@localhost -p 2222 rm -r haha/watched
+	end
+
+	it "Reads files without going through the mount"
+		ssh root@localhost -p 2222 'mkdir -p haha && seq 1 20 > haha/out.txt'
+		assert equal "$(clu tail -n 2 ${CLUSTER_UTILS_MOUNTS}/fakeserver/haha/out.txt | tr '\n' ' ')" "19 20 "
+		assert equal "$(clu cat ${CLUSTER_UTILS_MOUNTS}/fakeserver/haha/out.txt | wc -l)" "20"
+		ssh root@localhost -p 2222 rm haha/out.txt
+	end
+
+	it "Collects results in the host"
+		ssh root@localhost -p 2222 'mkdir -p haha/calc && echo "siesta:         Total =   -10.5" > haha/calc/run.out'
+		assert equal "$(clu collect ${CLUSTER_UTILS_MOUNTS}/fakeserver/haha/calc -e energy -f csv | tail -1)" "fakeserver,${CLUSTER_UTILS_MOUNTS}/fakeserver/haha/calc/run.out,-10.5"
+		assert equal "$(clu collect ${CLUSTER_UTILS_MOUNTS}/fakeserver/haha/calc -e energy -r 'total=Total = *([^ ]+)' -f csv | tail -1)" "fakeserver,${CLUSTER_UTILS_MOUNTS}/fakeserver/haha/calc/run.out,-10.5,-10.5"
+		ssh root@localhost -p 2222 rm -r haha/calc
+	end
+
+	it "Lists the jobs of the fake server (which has no scheduler)"
+		assert equal "$(clu jobs fakeserver --refresh | awk '{print $1}')" "HOST"
+	end
+
+	it "Lists the jobs of a Slurm host and finds their directory"
+		ssh root@localhost -p 2222 'cat > /usr/local/bin/squeue && chmod +x /usr/local/bin/squeue' <<-'EOF'
+		#!/bin/sh
+		printf "123\tsiesta\tRUNNING\t1:00\tnode1\t%s/haha\n" "$HOME"
+		EOF
+		assert equal "$(clu jobs fakeserver --refresh | awk 'NR > 1 {print $1, $2, $3, $4, $6, $7}')" "fakeserver 123 siesta RUNNING node1 ${CLUSTER_UTILS_MOUNTS}/fakeserver/haha"
+		assert equal "$(clu jobdir 123 --host fakeserver)" "${CLUSTER_UTILS_MOUNTS}/fakeserver/haha"
+		ssh root@localhost -p 2222 rm /usr/local/bin/squeue
+	end
+
+	it "Lists the jobs of a PBS host and finds their directory"
+		ssh root@localhost -p 2222 'cat > /usr/local/bin/qstat && chmod +x /usr/local/bin/qstat' <<-'EOF'
+		#!/bin/sh
+		cat <<EOQ
+		Job Id: 456.pbs
+		    Job_Name = siesta
+		    Job_Owner = $USER@localhost
+		    job_state = R
+		    exec_host = node2/0
+		    Variable_List = PBS_O_HOME=$HOME,PBS_O_WORKDIR=$HOME/haha
+		EOQ
+		EOF
+		assert equal "$(clu jobs fakeserver --refresh | awk 'NR > 1 {print $1, $2, $3, $4, $6, $7}')" "fakeserver 456.pbs siesta RUNNING node2 ${CLUSTER_UTILS_MOUNTS}/fakeserver/haha"
+		assert equal "$(clu jobdir 456 --host fakeserver)" "${CLUSTER_UTILS_MOUNTS}/fakeserver/haha"
+		ssh root@localhost -p 2222 rm /usr/local/bin/qstat
+	end
+
+	it "Shares one connection per host"
+		clu connections fakeserver --close > /dev/null
+		assert equal "$(clu connections)" ""
+		# Any command for the host starts the master, which the following commands reuse
+		clu setuphostscripts fakeserver > /dev/null
+		assert equal "$(clu connections | awk '{print $1}')" "fakeserver"
+		clu connections fakeserver --close > /dev/null
+		assert equal "$(clu connections)" ""
+		CLUSTER_UTILS_CONTROL_PERSIST=no clu connections fakeserver --open
+		assert equal "$(clu connections)" ""
+	end
+
+	it "Limits the running jobs of PBS arrays"
+		ssh root@localhost -p 2222 'cat > /usr/local/bin/qsub && chmod +x /usr/local/bin/qsub' <<-'EOF'
+		#!/bin/sh
+		[ "$1" = --version ] && echo "pbs_version = 2022.1" && exit
+		echo "$@" > ~/qsub_args
+		echo "1234[].pbs"
+		EOF
+		ssh root@localhost -p 2222 'mkdir -p haha/sweep/a haha/sweep/b && touch haha/sweep/a/a.fdf haha/sweep/b/b.fdf'
+		assert equal "$(clu submit --host fakeserver 'haha/sweep/*' --limit 1 | awk '{print $1}' | tr '\n' ' ')" "1234[0].pbs 1234[1].pbs "
+		assert match "$(ssh root@localhost -p 2222 cat qsub_args)" "-J 0-1%1 "
+		ssh root@localhost -p 2222 rm -r /usr/local/bin/qsub qsub_args haha/sweep
+	end
+
+	it "Opens, reuses and closes tunnels"
+		assert equal "$(clu tunnel fakeserver 22)" "$(clu tunnel fakeserver 22)"
+		clu tunnels --all --close > /dev/null
+		assert equal "$(clu tunnels)" ""
+	end
+
+	it "Keeps tunnels open after the shared connection expires"
+		clu connections fakeserver --close > /dev/null
+		CLUSTER_UTILS_CONTROL_PERSIST=2s clu connections fakeserver --open
+		CLUSTER_UTILS_CONTROL_PERSIST=2s clu tunnel fakeserver 22 > /dev/null
+		sleep 4
+		assert equal "$(clu tunnels | awk '{print $NF}')" "open"
+		clu tunnels --all --close > /dev/null
+	end
+
+	it "Benchmarks the mount profiles"
+		assert match "$(clu mountbench --files 10 --size 1 fakeserver -p 2222)" "Suggested profile"
+	end
+
+	it "Only sends the scripts that changed"
+		clu setuphostscripts fakeserver > /dev/null
+		user_scripts="${CLUSTER_UTILS_USERSCRIPTS}/host-specific/fakeserver"
+		mkdir -p "${user_scripts}/commands" && echo "echo hi" > "${user_scripts}/commands/clutest.sh"
+		assert equal "$(clu setuphostscripts fakeserver)" "(cluster-utils) Scripts in fakeserver: 1 files updated, 0 removed."
+		assert equal "$(ssh root@localhost -p 2222 cat .cluster-utils/scripts/commands/clutest.sh)" "echo hi"
+		rm -r "${user_scripts}"
+		assert equal "$(clu setuphostscripts fakeserver)" "(cluster-utils) Scripts in fakeserver: 0 files updated, 1 removed."
+		assert equal "$(ssh root@localhost -p 2222 ls .cluster-utils/scripts/commands/clutest.sh 2>/dev/null)" ""
+	end
+
+	it "Syncs the scripts again if they were removed from the host"
+		clu setuphostscripts fakeserver > /dev/null
+		assert equal "$(clu setuphostscripts fakeserver)" "(cluster-utils) Scripts in fakeserver are up to date."
+		ssh root@localhost -p 2222 rm -rf .cluster-utils
+		clu setuphostscripts fakeserver > /dev/null
+		assert equal "$(ssh root@localhost -p 2222 ls .cluster-utils/activate)" ".cluster-utils/activate"
+	end
+
 	it "Removes the fake server"
 		clu removehost fakeserver
 		assert equal "$(clu lsmounts)" ""
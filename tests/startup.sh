@@ -0,0 +1,66 @@
+#!/bin/bash
+
+# Time budget (in ms) for commands that are run very often (e.g. on each TAB press). They take
+# 40-70 ms on a laptop (see benchmarks/bench.py), the margin is there so that slower machines don't fail.
+budget=${CLU_STARTUP_BUDGET_MS:-100}
+
+_clu_ms(){
+	local start=$(date +%s%N)
+	"$@" >/dev/null 2>/dev/null 8>/dev/null 9>/dev/null
+	echo $(( ($(date +%s%N) - start) / 1000000 ))
+}
+
+describe "Startup time"
+	# Make sure that the registry of subcommands is generated before measuring
+	clu lshosts >/dev/null
+
+	it "Lists hosts within budget"
+		assert test "[ $(_clu_ms clu lshosts) -lt ${budget} ]"
+	end
+
+	it "Completes subcommand names within budget"
+		assert test "[ $(_ARGCOMPLETE=1 COMP_LINE='clu mo' COMP_POINT=6 _clu_ms clu) -lt ${budget} ]"
+	end
+
+	it "Completes subcommand arguments within budget"
+		assert test "[ $(_ARGCOMPLETE=1 COMP_LINE='clu mount ' COMP_POINT=10 _clu_ms clu) -lt ${budget} ]"
+	end
+
+	it "Activates within budget"
+		# The first activation leaves the bundle, the second one just sources it
+		bash -c 'source "${CLUSTER_UTILS_ROOT}/activate"'
+		assert test "[ $(_clu_ms bash -c 'source "${CLUSTER_UTILS_ROOT}/activate"') -lt ${budget} ]"
+	end
+
+	it "Rebuilds the activation bundle when the commands change"
+		touch "$(_clupath scripts/generic/commands/clu.sh)"
+		assert equal "$(bash -c 'source "${CLUSTER_UTILS_ROOT}/.activation.sh"; echo $?')" "1"
+		bash -c 'source "${CLUSTER_UTILS_ROOT}/activate"'
+		assert equal "$(bash -c 'source "${CLUSTER_UTILS_ROOT}/.activation.sh"; echo $?')" "0"
+	end
+
+	it "Only imports the requested subcommand"
+		imported=$(python3 -X importtime "$(_clupath cli/clu)" path 2>&1 >/dev/null | grep -c "subcommands.mounting")
+		assert equal "${imported}" "0"
+	end
+
+	it "Doesn't load the profiler unless asked"
+		imported=$(python3 -X importtime "$(_clupath cli/clu)" lshosts 2>&1 >/dev/null | grep -c "subcommands.profiling")
+		assert equal "${imported}" "0"
+	end
+
+	it "Profiles a command when asked"
+		assert match "$(CLUSTER_UTILS_PROFILE=1 clu lshosts 2>&1 >/dev/null)" "Profile of"
+	end
+
+	it "Serves commands from the daemon"
+		export CLUSTER_UTILS_DAEMON_SOCKET=$(_clupath .test-daemon.sock)
+		expected=$(clu lshosts)
+		clu daemon >/dev/null
+		assert equal "$(clu lshosts)" "${expected}"
+		assert match "$(clu daemon --status)" "served 1 commands"
+		clu daemon --stop >/dev/null
+		assert equal "$(clu lshosts)" "${expected}"
+		unset CLUSTER_UTILS_DAEMON_SOCKET
+	end
+end